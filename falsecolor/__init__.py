@@ -1,4 +1,18 @@
 from .coloring import *
 from .dataobject import *
 from .savethread import *
-from .process import *
\ No newline at end of file
+from .process import *
+from .flatfield import *
+from .engine import *
+from .memory import *
+from .profiling import *
+from .manifest import *
+from .sharding import *
+from .chunked import *
+from .readers import *
+from .catalog import *
+from .cache import *
+from .store import *
+from .session import *
+from .sweep import *
+from .calibration import *
\ No newline at end of file
@@ -0,0 +1,304 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+"""
+
+import os
+import glob
+import threading
+import numpy
+from falsecolor.coloring import getIntensityMap, getBackgroundLevels
+from falsecolor.manifest import hashParameters
+from falsecolor.memory import parseMemory
+from falsecolor.sharding import savePrecomputed, loadPrecomputed
+
+
+# default cache folder, can be set with the FALSECOLOR_CACHE variable
+DEFAULT_CACHE_DIR = os.environ.get(
+                        'FALSECOLOR_CACHE',
+                        os.path.join(os.path.expanduser('~'), '.cache',
+                                     'falsecolor'))
+
+# metadata files whose changes mark a Zarr or N5 container as modified
+CONTAINER_METADATA = ('.zgroup', '.zattrs', 'zarr.json', 'attributes.json')
+
+
+def getFileIdentity(path):
+    """
+    Identifies a dataset by its absolute path, size and modification
+    time, so a cache entry is invalid once the dataset is rewritten. For
+    Zarr and N5 containers the metadata files at the top of the
+    container are used, chunks are not scanned.
+
+    Parameters
+    ----------
+
+    path : str or pathlike
+        HDF5 file, Zarr or N5 container.
+
+    Returns
+    -------
+
+    identity : dict
+
+    """
+
+    path = os.path.abspath(path)
+    stats = [os.stat(path)]
+
+    if os.path.isdir(path):
+        stats.extend(os.stat(os.path.join(path, name))
+                     for name in CONTAINER_METADATA
+                     if os.path.exists(os.path.join(path, name)))
+
+    return {'path': path,
+            'size': sum(stat.st_size for stat in stats),
+            'mtime': max(stat.st_mtime for stat in stats)}
+
+
+class ResultCache(object):
+    def __init__(self, folder=None, max_size='4G'):
+        """
+        On disk cache of arrays, e.g. intensity maps and background
+        levels, keyed by a hash of everything they are computed from.
+        Entries are .npz files written atomically, so several processes
+        can share a cache folder. Once the cache grows beyond max_size
+        the least recently used entries are removed.
+
+        Attributes
+        ----------
+
+        folder : None or str
+            Defaults to None, cache folder. None uses DEFAULT_CACHE_DIR.
+
+        max_size : int or str
+            Defaults to '4G', see parseMemory.
+
+        """
+
+        self.folder = folder or DEFAULT_CACHE_DIR
+        self.max_size = parseMemory(max_size)
+        self.lock = threading.Lock()
+
+    def getFilename(self, key):
+        """
+        Returns the file of a cache entry.
+        """
+
+        return os.path.join(self.folder, key + '.npz')
+
+    def get(self, key):
+        """
+        Returns the arrays stored under key, or None if there are none.
+        """
+
+        filename = self.getFilename(key)
+        try:
+            arrays = loadPrecomputed(filename)
+        except (OSError, ValueError):
+            # removed by another process or partially written by an
+            # older version
+            return None
+
+        if arrays is not None:
+            # modification time orders entries for eviction
+            try:
+                os.utime(filename)
+            except OSError:
+                pass
+
+        return arrays
+
+    def put(self, key, **arrays):
+        """
+        Stores arrays under key and evicts old entries.
+        """
+
+        savePrecomputed(self.getFilename(key), **arrays)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is no
+        larger than max_size.
+
+        Returns
+        -------
+
+        removed : list
+            Keys of the removed entries.
+
+        """
+
+        with self.lock:
+            entries = []
+            for filename in glob.glob(os.path.join(self.folder, '*.npz')):
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+
+            entries.sort()
+            total = sum(size for mtime, size, filename in entries)
+
+            removed = []
+            for mtime, size, filename in entries:
+                if total <= self.max_size:
+                    break
+
+                try:
+                    os.remove(filename)
+                except OSError:
+                    continue
+
+                total -= size
+                removed.append(os.path.basename(filename)[:-4])
+
+        return removed
+
+    def clear(self):
+        """
+        Removes every entry.
+        """
+
+        for filename in glob.glob(os.path.join(self.folder, '*.npz')):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def getSize(self):
+        """
+        Returns the size of all entries in bytes.
+        """
+
+        return sum(os.path.getsize(filename) for filename in
+                   glob.glob(os.path.join(self.folder, '*.npz')))
+
+
+def getCacheKey(identity, kind, **params):
+    """
+    Returns the key of a cached result, the hash of the dataset
+    identity, the kind of result and its parameters.
+    """
+
+    return hashParameters(dict(params, identity=identity, kind=kind))
+
+
+def getCachedIntensityMap(volume, identity, tileSize=256, blockSize=16,
+                          bgThreshold=50, precision='float64', cache=None,
+                          **key):
+    """
+    getIntensityMap with a persistent cache.
+
+    Parameters
+    ----------
+
+    volume : array like
+        Downsampled volume, only read if the map is not cached.
+
+    identity : dict or str
+        Dataset identity from getFileIdentity, or any string which
+        identifies the data.
+
+    tileSize, blockSize, bgThreshold, precision
+        See getIntensityMap.
+
+    cache : None or ResultCache
+        Defaults to None, which uses a ResultCache in DEFAULT_CACHE_DIR.
+
+    **key
+        Further values identifying the volume, e.g. channel, level and
+        timepoint.
+
+    Returns
+    -------
+
+    intensityMap : 3D numpy array
+
+    """
+
+    cache = cache or ResultCache()
+    cache_key = getCacheKey(identity, 'intensity_map', tileSize=tileSize,
+                            blockSize=blockSize, bgThreshold=bgThreshold,
+                            precision=precision, **key)
+
+    arrays = cache.get(cache_key)
+    if arrays is None:
+        arrays = {'intensity_map': getIntensityMap(volume, tileSize=tileSize,
+                                                   blockSize=blockSize,
+                                                   bgThreshold=bgThreshold,
+                                                   precision=precision)}
+        cache.put(cache_key, **arrays)
+
+    return arrays['intensity_map']
+
+
+def getCachedBackgroundLevels(volume, identity, threshold=50, cache=None,
+                              **key):
+    """
+    getBackgroundLevels with a persistent cache.
+
+    Parameters
+    ----------
+
+    volume : array like
+        Volume, only read if the levels are not cached.
+
+    identity : dict or str
+        See getCachedIntensityMap.
+
+    threshold : int
+        See getBackgroundLevels.
+
+    cache : None or ResultCache
+        Defaults to None, which uses a ResultCache in DEFAULT_CACHE_DIR.
+
+    **key
+        Further values identifying the volume.
+
+    Returns
+    -------
+
+    hi_val, background : float
+
+    """
+
+    cache = cache or ResultCache()
+    cache_key = getCacheKey(identity, 'background_levels',
+                            threshold=threshold, **key)
+
+    arrays = cache.get(cache_key)
+    if arrays is None:
+        arrays = {'levels': numpy.asarray(getBackgroundLevels(
+                                                volume, threshold=threshold),
+                                          dtype=numpy.float64)}
+        cache.put(cache_key, **arrays)
+
+    hi_val, background = arrays['levels']
+    return float(hi_val), float(background)
@@ -0,0 +1,306 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+"""
+
+import json
+import numpy
+from falsecolor.coloring import preProcess, falseColor, segmentNuclei, \
+    getColorSettings, getPrecisionType
+from falsecolor.session import BETA_NUCLEI, BETA_CYTO
+
+
+HSV_KEYS = ('Hue', 'Sat', 'Val')
+
+
+def loadHSVReference(filename):
+    """
+    Loads reference HSV statistics, e.g. example/Paper Data/Figures/
+    Figure 4/HSV Data/Histology_HEmedians.json, which holds the per
+    image medians of nuclear and cytoplasm regions.
+
+    Parameters
+    ----------
+
+    filename : str or pathlike
+
+    Returns
+    -------
+
+    reference : dict
+        Median of every list, keyed by 'nuclei' and 'cyto' and then
+        'Hue', 'Sat' and 'Val'.
+
+    """
+
+    with open(filename) as f:
+        data = json.load(f)
+
+    return {region: {key: float(numpy.median(data[region][key]))
+                     for key in HSV_KEYS}
+            for region in ('nuclei', 'cyto')}
+
+
+def rgbToHSV(RGB):
+    """
+    Converts RGB values in [0, 1] to HSV along the last axis, the same
+    conversion as skimage.color.rgb2hsv for arrays of any shape.
+    """
+
+    R, G, B = RGB[..., 0], RGB[..., 1], RGB[..., 2]
+    V = RGB.max(axis=-1)
+    delta = V - RGB.min(axis=-1)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        S = numpy.where(V > 0, delta/V, 0)
+
+        H = numpy.where(V == B, 4 + (R - G)/delta, 0)
+        H = numpy.where(V == G, 2 + (B - R)/delta, H)
+        H = numpy.where(V == R, (G - B)/delta, H)
+
+    H = numpy.where(delta > 0, (H/6) % 1, 0)
+
+    return numpy.stack([H, S, V], axis=-1)
+
+
+def sampleForeground(nuclei, cyto, n_samples=5000, seed=0,
+                     nuc_threshold=50,
+                     cyto_threshold=50,
+                     nuc_normfactor=5000,
+                     cyto_normfactor=2000,
+                     color_settings=None,
+                     precision='float64'):
+    """
+    Samples nuclear and cytoplasm pixels of a section for calibration.
+    The section is colored once, nuclei and cytoplasm are segmented
+    with segmentNuclei and pixels are drawn from each mask.
+
+    Parameters
+    ----------
+
+    nuclei, cyto : 2D numpy arrays
+        Channel images.
+
+    n_samples : int
+        Defaults to 5000, pixels per region.
+
+    seed : int
+        Defaults to 0, random seed.
+
+    nuc_threshold, cyto_threshold, nuc_normfactor, cyto_normfactor,
+    color_settings, precision
+        See falseColor, the preprocessing parameters are kept during
+        calibration.
+
+    Returns
+    -------
+
+    samples : dict
+        'nuclei' and 'cyto', each an array [2, n] of the preprocessed
+        nuclear and cytoplasm values of the sampled pixels.
+
+    """
+
+    RGB_image = falseColor(nuclei, cyto,
+                           nuc_threshold=nuc_threshold,
+                           cyto_threshold=cyto_threshold,
+                           nuc_normfactor=nuc_normfactor,
+                           cyto_normfactor=cyto_normfactor,
+                           color_settings=color_settings,
+                           precision=precision)
+
+    nuclei_mask, cyto_mask = segmentNuclei(RGB_image, return3D=False,
+                                           return_cyto=True)
+
+    float_type = getPrecisionType(precision)
+    channels = numpy.stack([
+                    preProcess(nuclei.astype(float_type),
+                               threshold=nuc_threshold,
+                               normfactor=nuc_normfactor,
+                               precision=precision),
+                    preProcess(cyto.astype(float_type),
+                               threshold=cyto_threshold,
+                               normfactor=cyto_normfactor,
+                               precision=precision)]).reshape(2, -1)
+
+    rng = numpy.random.RandomState(seed)
+    samples = {}
+    for region, mask in [('nuclei', nuclei_mask), ('cyto', cyto_mask)]:
+        indices = numpy.flatnonzero(mask.reshape(-1))
+        if indices.size == 0:
+            raise ValueError('no %s pixels found by segmentNuclei' % region)
+
+        indices = rng.choice(indices, min(n_samples, indices.size),
+                             replace=False)
+        samples[region] = channels[:, indices]
+
+    return samples
+
+
+def getModelHSVMedians(constants, samples):
+    """
+    Evaluates the Beer's law coloring model of falseColor on sampled
+    pixels for many color settings at once.
+
+    Parameters
+    ----------
+
+    constants : numpy array
+        [n_settings, 6], nuclear R, G, B and cytoplasm R, G, B
+        constants per setting.
+
+    samples : dict
+        From sampleForeground.
+
+    Returns
+    -------
+
+    medians : dict
+        'nuclei' and 'cyto', arrays [n_settings, 3] of the median hue,
+        saturation and value of the sampled pixels.
+
+    """
+
+    constants = numpy.atleast_2d(constants)
+    nuc_constants = constants[:, None, :3]*BETA_NUCLEI
+    cyto_constants = constants[:, None, 3:]*BETA_CYTO
+
+    medians = {}
+    for region, (nuclei, cyto) in samples.items():
+        # [setting, pixel, color]
+        RGB = numpy.exp(-(nuc_constants*nuclei[None, :, None] +
+                          cyto_constants*cyto[None, :, None]))
+
+        medians[region] = numpy.median(rgbToHSV(RGB), axis=1)
+
+    return medians
+
+
+def getCalibrationLoss(medians, reference, weights=(1, 1, 1)):
+    """
+    Squared distance of model medians to reference medians, summed over
+    regions and weighted per hue, saturation and value. Hue differences
+    wrap around.
+    """
+
+    weights = numpy.asarray(weights, dtype=float)
+    loss = 0
+    for region in ('nuclei', 'cyto'):
+        target = numpy.array([reference[region][key] for key in HSV_KEYS])
+        difference = medians[region] - target
+        difference[:, 0] = (difference[:, 0] + 0.5) % 1 - 0.5
+        loss = loss + (weights*difference**2).sum(axis=1)
+
+    return loss
+
+
+def calibrateColorSettings(samples, reference, color_settings=None,
+                           n_candidates=256, n_iterations=30,
+                           elite_fraction=0.1, weights=(1, 1, 1), seed=0):
+    """
+    Fits the RGB constants of the nuclear and cytoplasm channels so the
+    median hue, saturation and value of the sampled regions match a
+    reference. A cross entropy search in log space evaluates all
+    candidates of an iteration in one vectorized call of
+    getModelHSVMedians, images are never re-rendered.
+
+    Parameters
+    ----------
+
+    samples : dict
+        From sampleForeground.
+
+    reference : dict
+        From loadHSVReference, or the same structure.
+
+    color_settings : None or dict
+        Defaults to None, starting settings, None starts from
+        getColorSettings('HE').
+
+    n_candidates : int
+        Defaults to 256, settings evaluated per iteration.
+
+    n_iterations : int
+        Defaults to 30.
+
+    elite_fraction : float
+        Defaults to 0.1, fraction of best candidates which the search
+        distribution is refitted to.
+
+    weights : tuple
+        Defaults to (1, 1, 1), weights of hue, saturation and value.
+
+    seed : int
+        Defaults to 0, random seed.
+
+    Returns
+    -------
+
+    result : dict
+        'color_settings' with the fitted 'nuclei' and 'cyto' constants,
+        'loss', 'initial_loss' and the model 'medians' of the fitted
+        settings.
+
+    """
+
+    if color_settings is None:
+        color_settings = getColorSettings(key='HE')
+
+    initial = numpy.array(list(color_settings['nuclei']) +
+                          list(color_settings['cyto']), dtype=float)
+
+    rng = numpy.random.RandomState(seed)
+    mean = numpy.log(numpy.maximum(initial, 1e-3))
+    std = numpy.full(6, 0.5)
+    n_elite = max(2, int(n_candidates*elite_fraction))
+
+    best = initial
+    best_loss = getCalibrationLoss(getModelHSVMedians(initial, samples),
+                                   reference, weights)[0]
+    initial_loss = best_loss
+
+    for iteration in range(n_iterations):
+        candidates = numpy.exp(mean + std*rng.randn(n_candidates, 6))
+        losses = getCalibrationLoss(getModelHSVMedians(candidates, samples),
+                                    reference, weights)
+
+        order = numpy.argsort(losses)
+        if losses[order[0]] < best_loss:
+            best, best_loss = candidates[order[0]], losses[order[0]]
+
+        elite = numpy.log(candidates[order[:n_elite]])
+        mean = elite.mean(axis=0)
+        std = numpy.maximum(elite.std(axis=0), 1e-3)
+
+    medians = getModelHSVMedians(best, samples)
+
+    return {'color_settings': {'nuclei': [float(c) for c in best[:3]],
+                               'cyto': [float(c) for c in best[3:]]},
+            'loss': float(best_loss),
+            'initial_loss': float(initial_loss),
+            'medians': {region: dict(zip(HSV_KEYS, map(float, value[0])))
+                        for region, value in medians.items()}}
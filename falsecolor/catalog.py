@@ -0,0 +1,328 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+"""
+
+import os
+import json
+import fnmatch
+import traceback
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import numpy
+from falsecolor.readers import openVolume
+from falsecolor.manifest import writeJSONAtomic
+
+
+# files and containers found by scanDatasets
+DATASET_EXTENSIONS = ('.h5', '.zarr', '.n5')
+
+
+def describeDataset(path, timepoint=0):
+    """
+    Describes one timepoint of a dataset.
+
+    Parameters
+    ----------
+
+    path : str or pathlike
+        HDF5 file, Zarr or N5 container.
+
+    timepoint : int
+        Defaults to 0.
+
+    Returns
+    -------
+
+    entry : dict
+        'path', 'timepoint', 'format', 'channels', 'levels' with the
+        'shape', 'chunks' and 'dtype' of every resolution level of the
+        first channel, and 'n_voxels' of one full resolution channel.
+
+    """
+
+    with openVolume(path, timepoint=timepoint) as reader:
+        levels = []
+        for level in range(reader.n_levels):
+            volume = reader.getVolume(0, level)
+            levels.append({'shape': list(volume.shape),
+                           'chunks': None if volume.chunks is None
+                           else list(volume.chunks),
+                           'dtype': str(volume.dtype)})
+
+        return {'path': os.path.abspath(path),
+                'timepoint': timepoint,
+                'format': type(reader).__name__,
+                'channels': list(reader.channels),
+                'levels': levels,
+                'n_voxels': int(numpy.prod(levels[0]['shape']))}
+
+
+class DatasetCatalog(object):
+    def __init__(self, entries=(), errors=()):
+        """
+        List of the datasets and timepoints of a batch, see
+        scanDatasets.
+
+        Attributes
+        ----------
+
+        entries : list of dict
+            One entry per dataset and timepoint, see describeDataset.
+
+        errors : list of dict
+            'path' and 'error' of every dataset that could not be read.
+
+        """
+
+        self.entries = list(entries)
+        self.errors = list(errors)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def filter(self, pattern=None, timepoints=None, channels=None):
+        """
+        Returns a catalog with a subset of the entries.
+
+        Parameters
+        ----------
+
+        pattern : None or str
+            Defaults to None, shell pattern the path has to match.
+
+        timepoints : None or list
+            Defaults to None, timepoints to keep.
+
+        channels : None or int
+            Defaults to None, minimum number of channels.
+
+        Returns
+        -------
+
+        catalog : DatasetCatalog
+
+        """
+
+        entries = self.entries
+        if pattern is not None:
+            entries = [e for e in entries
+                       if fnmatch.fnmatch(e['path'], pattern)]
+        if timepoints is not None:
+            entries = [e for e in entries if e['timepoint'] in timepoints]
+        if channels is not None:
+            entries = [e for e in entries if len(e['channels']) >= channels]
+
+        return DatasetCatalog(entries, self.errors)
+
+    def save(self, filename):
+        """
+        Saves the catalog as JSON, see writeJSONAtomic.
+        """
+
+        writeJSONAtomic(filename, {'entries': self.entries,
+                                   'errors': self.errors})
+
+
+def loadCatalog(filename):
+    """
+    Loads a catalog saved with DatasetCatalog.save.
+    """
+
+    with open(filename) as f:
+        data = json.load(f)
+
+    return DatasetCatalog(data['entries'], data['errors'])
+
+
+def scanDatasets(root, extensions=DATASET_EXTENSIONS):
+    """
+    Scans a directory tree for datasets and catalogs every timepoint
+    of every dataset. Zarr and N5 containers are not searched further.
+
+    Parameters
+    ----------
+
+    root : str or pathlike
+        Folder to scan.
+
+    extensions : tuple
+        Defaults to ('.h5', '.zarr', '.n5').
+
+    Returns
+    -------
+
+    catalog : DatasetCatalog
+
+    """
+
+    paths = []
+    for folder, dirnames, filenames in os.walk(root):
+        containers = [d for d in dirnames if d.endswith(extensions)]
+        dirnames[:] = sorted(d for d in dirnames if d not in containers)
+
+        paths.extend(os.path.join(folder, name) for name in
+                     sorted(containers + [f for f in filenames
+                                          if f.endswith(extensions)]))
+
+    entries = []
+    errors = []
+    for path in paths:
+        try:
+            with openVolume(path) as reader:
+                timepoints = list(reader.timepoints)
+            for timepoint in timepoints:
+                entries.append(describeDataset(path, timepoint=timepoint))
+
+        except Exception as error:
+            errors.append({'path': os.path.abspath(path),
+                           'error': '%s: %s' % (type(error).__name__, error)})
+
+    return DatasetCatalog(entries, errors)
+
+
+def runJob(target, entry):
+    """
+    Runs target(entry) in a batch worker, exceptions are returned as
+    text so one failed dataset does not stop the batch.
+    """
+
+    try:
+        return target(entry), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def runBatch(target, entries, n_workers=1, callback=None):
+    """
+    Runs target once per catalog entry in a pool of worker processes
+    which live for the whole batch, so imports, compiled kernels and
+    caches of a worker are reused for every dataset it processes. The
+    largest datasets are started first.
+
+    A worker process which dies, e.g. killed for running out of memory
+    or by a segfault, breaks the pool. The pool is then recreated and
+    the jobs which were running are retried one at a time, so the job
+    which kills its worker again is recorded as failed and the rest of
+    the batch continues.
+
+    Parameters
+    ----------
+
+    target : callable
+        Module level function called as target(entry).
+
+    entries : iterable of dict
+        Catalog entries, e.g. a DatasetCatalog.
+
+    n_workers : int
+        Defaults to 1, worker processes.
+
+    callback : None or callable
+        Defaults to None, called as callback(entry, result, error) as
+        every job finishes.
+
+    Returns
+    -------
+
+    results : list
+        (entry, result, error) per job in the order they finished,
+        error is None or the traceback of a failed job.
+
+    """
+
+    pending = deque(sorted(entries, key=lambda entry: -entry['n_voxels']))
+
+    # jobs running when a worker died, retried one at a time
+    suspects = deque()
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    executor = None
+    running = {}
+    solo = False
+
+    def finish(entry, result, error):
+        results.append((entry, result, error))
+        if callback is not None:
+            callback(entry, result, error)
+
+    try:
+        while pending or suspects or running:
+            if executor is None:
+                executor = ProcessPoolExecutor(max_workers=n_workers,
+                                               mp_context=context)
+
+            # only submit as many jobs as there are workers, so every
+            # submitted job is running when a worker dies
+            if not running:
+                solo = bool(suspects)
+
+            if solo:
+                if not running:
+                    entry = suspects.popleft()
+                    running[executor.submit(runJob, target, entry)] = entry
+            else:
+                while pending and len(running) < n_workers:
+                    entry = pending.popleft()
+                    running[executor.submit(runJob, target, entry)] = entry
+
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+
+            broken = False
+            for future in done:
+                entry = running.pop(future)
+                try:
+                    result, error = future.result()
+                except BrokenProcessPool as exception:
+                    broken = True
+                    if solo:
+                        finish(entry, None, 'worker process died: %s: %s'
+                               % (type(exception).__name__, exception))
+                    else:
+                        suspects.append(entry)
+                    continue
+
+                finish(entry, result, error)
+
+            if broken:
+                # every other running job died with the pool
+                suspects.extend(running.values())
+                running.clear()
+                executor.shutdown(wait=True)
+                executor = None
+
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    return results
@@ -0,0 +1,450 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+Lazy coloring of chunked (Z, X, Y) volumes with dask. Volumes can be
+numpy arrays, h5py or zarr datasets or dask arrays, results are dask
+arrays which are computed in parallel by any dask scheduler, e.g.
+RGB.compute(scheduler='threads') or dask.array.store(RGB, dataset).
+
+"""
+
+import numpy
+from falsecolor.coloring import getPrecisionType, preProcess, \
+    sharpenImage, falseColorStack
+
+try:
+    import dask.array as da
+except ImportError:
+    da = None
+
+
+def requireDask():
+    """
+    Raises ImportError if dask is not installed.
+    """
+
+    if da is None:
+        raise ImportError('chunked coloring requires dask, install it with '
+                          'pip install "dask[array]"')
+
+
+def asChunkedArray(data, chunks='auto'):
+    """
+    Wraps a numpy array or an h5py/zarr dataset as a dask array.
+
+    Parameters
+    ----------
+
+    data : array like
+        Volume in the shape (Z, X, Y).
+
+    chunks : str, int or tuple
+        Defaults to 'auto', dask chunk shape when data is not already a
+        dask array. Whole sections (chunks=(n, -1, -1)) avoid splitting
+        the per section work.
+
+    Returns
+    -------
+
+    volume : dask array
+
+    """
+
+    requireDask()
+
+    if isinstance(data, da.Array):
+        return data
+
+    return da.from_array(data, chunks=chunks)
+
+
+def getChunkedBackgroundLevels(volume, threshold=50):
+    """
+    getBackgroundLevels for a whole chunked volume, computed with one
+    histogram reduction instead of sorting the volume in memory. Exact
+    for integer data of at most 16 bits, other data is compared to the
+    threshold chunk by chunk and only the foreground values are
+    gathered.
+
+    Parameters
+    ----------
+
+    volume : array like
+        Volume in the shape (Z, X, Y).
+
+    threshold : int
+        Defaults to 50, threshold above which is counted as foreground.
+
+    Returns
+    -------
+
+    hi_val : number
+        Foreground value.
+
+    background : float
+        Background value.
+
+    """
+
+    volume = asChunkedArray(volume)
+
+    if numpy.issubdtype(volume.dtype, numpy.integer) and \
+            volume.dtype.itemsize <= 2:
+
+        # histogram bins in the order of the sorted values
+        low = numpy.iinfo(volume.dtype).min
+        counts = da.bincount(volume.astype(numpy.int64).ravel() - low,
+                             minlength=2**(8*volume.dtype.itemsize))
+        counts = counts.compute()
+
+        values = (numpy.arange(len(counts)) + low).astype(volume.dtype)
+
+        # index into the sorted foreground values
+        foreground = counts*(values > threshold)
+        index = int(numpy.round(foreground.sum()*0.95))
+        cumulative = numpy.cumsum(foreground)
+        hi_val = values[numpy.searchsorted(cumulative, index, side='right')]
+
+    else:
+        foreground = volume[volume > threshold].compute()
+        foreground.sort()
+        hi_val = foreground[int(numpy.round(len(foreground)*0.95))]
+
+    return hi_val, hi_val/5
+
+
+def intensityMapBlock(block, background, midrange, cube, float_type):
+    """
+    Intensity map of one chunk, the median foreground value of every
+    cube, used by getChunkedIntensityMap.
+    """
+
+    shape = [int(numpy.ceil(n/cube)) for n in block.shape]
+    intensityMap = numpy.zeros(shape, dtype=float_type)
+
+    for i in range(shape[0]):
+        for j in range(shape[1]):
+            for k in range(shape[2]):
+                ROI_0 = block[i*cube:(i + 1)*cube,
+                              j*cube:(j + 1)*cube,
+                              k*cube:(k + 1)*cube]
+
+                foreground = ROI_0[ROI_0 > background]
+                if foreground.size == 0:
+                    intensityMap[i, j, k] = midrange
+                else:
+                    intensityMap[i, j, k] = numpy.median(foreground)
+
+    return intensityMap
+
+
+def getChunkedIntensityMap(image, tileSize=256, blockSize=16,
+                           bgThreshold=50, precision='float64'):
+    """
+    getIntensityMap for a chunked downsampled volume. Background levels
+    are computed once for the whole volume, then every chunk computes
+    the medians of its own cubes in parallel. Returns the same map as
+    getIntensityMap.
+
+    Parameters
+    ----------
+
+    image : array like
+        Downsampled volume, axes in the order of getIntensityMap.
+
+    tileSize : int
+        Default is 256, lateral size for data partition.
+
+    blockSize : int
+        Default is 16, the cube size is tileSize divided by blockSize.
+
+    bgThreshold : int
+        Default is 50, threshold for getChunkedBackgroundLevels.
+
+    precision : str
+        Default is 'float64', dtype of the intensity map.
+
+    Returns
+    -------
+
+    intensityMap : 3D numpy array
+
+    """
+
+    image = asChunkedArray(image)
+    float_type = getPrecisionType(precision)
+    cube = int(tileSize/blockSize)
+
+    midrange, background = getChunkedBackgroundLevels(image,
+                                                      threshold=bgThreshold)
+
+    # chunks made of whole cubes, so cubes never cross chunks
+    chunks = [max(cube, int(numpy.ceil(c/cube))*cube)
+              for c in image.chunksize]
+    image = image.rechunk(chunks)
+
+    out_chunks = tuple(tuple(int(numpy.ceil(c/cube)) for c in axis_chunks)
+                       for axis_chunks in image.chunks)
+
+    blocks = da.map_blocks(intensityMapBlock, image, background, midrange,
+                           cube, float_type, chunks=out_chunks,
+                           dtype=float_type).compute()
+
+    # same map shape as getIntensityMap, cubes past the data are midrange
+    shape = [len(numpy.arange(0, int(numpy.ceil(n/blockSize)*blockSize) +
+                              cube, cube)) - 1 for n in image.shape]
+    intensityMap = numpy.full(shape, midrange, dtype=float_type)
+
+    n = [min(a, b) for a, b in zip(shape, blocks.shape)]
+    intensityMap[:n[0], :n[1], :n[2]] = blocks[:n[0], :n[1], :n[2]]
+
+    return intensityMap
+
+
+def getChunkedNormfactors(volume, threshold=50):
+    """
+    Per section normalization factors as computed by preProcess and
+    falseColorStack when normfactor is None, reduced over chunks so
+    sections split into several chunks are normalized as a whole.
+
+    Parameters
+    ----------
+
+    volume : array like
+        Volume in the shape (Z, X, Y).
+
+    threshold : float or 1D array
+        Defaults to 50, background threshold, one value or one per
+        section.
+
+    Returns
+    -------
+
+    normfactors : 1D numpy array
+        One value per section.
+
+    """
+
+    volume = asChunkedArray(volume).astype(numpy.float64)
+
+    # per section thresholds broadcast along the section axis
+    threshold = numpy.asarray(threshold, dtype=numpy.float64)
+    if threshold.ndim == 1:
+        threshold = threshold[:, None, None]
+
+    image = da.maximum(volume - threshold, 0)**0.85
+    foreground = image > threshold
+
+    total = da.where(foreground, image, 0).sum(axis=(1, 2))
+    count = foreground.sum(axis=(1, 2))
+
+    total, count = da.compute(total, count)
+
+    return total/count*8
+
+
+def getBlockSections(value, block_info):
+    """
+    Slices a per section parameter for the sections of a block, scalars
+    are returned unchanged.
+    """
+
+    if numpy.ndim(value) == 0:
+        return value
+
+    z0, z1 = block_info[0]['array-location'][0]
+    return numpy.asarray(value)[z0:z1]
+
+
+def chunkedPreProcess(volume, threshold=50, normfactor=None,
+                      precision='float64'):
+    """
+    Lazy preProcess of every section of a chunked volume.
+
+    Parameters
+    ----------
+
+    volume : array like
+        Volume in the shape (Z, X, Y).
+
+    threshold : float or 1D array
+        Defaults to 50, background threshold, one value or one per
+        section.
+
+    normfactor : None, float or 1D array
+        Defaults to None, one value or one value per section. If None
+        it is computed per section with getChunkedNormfactors.
+
+    precision : str
+        Defaults to 'float64', 'float32' or 'float64'.
+
+    Returns
+    -------
+
+    processed : dask array
+
+    """
+
+    volume = asChunkedArray(volume)
+    float_type = getPrecisionType(precision)
+
+    if normfactor is None:
+        normfactor = getChunkedNormfactors(volume, threshold=threshold)
+
+    def preProcessBlock(block, block_info=None):
+        thresholds = numpy.broadcast_to(
+                            getBlockSections(threshold, block_info),
+                            (block.shape[0],))
+        normfactors = numpy.broadcast_to(
+                            getBlockSections(normfactor, block_info),
+                            (block.shape[0],))
+
+        # preProcess subtracts in place, never modify the source chunk
+        block = block.astype(float_type)
+        output = numpy.empty(block.shape, dtype=float_type)
+        for z in range(block.shape[0]):
+            preProcess(block[z], threshold=thresholds[z],
+                       normfactor=normfactors[z], precision=precision,
+                       out=output[z])
+        return output
+
+    return da.map_blocks(preProcessBlock, volume, dtype=float_type)
+
+
+def chunkedSharpenImage(volume, alpha=0.5, precision='float64'):
+    """
+    Lazy sharpenImage of every section of a chunked volume. Chunks are
+    extended by a one pixel halo from their neighbours, and by zeros at
+    the volume border like the convolution in sharpenImage, so the
+    result equals sharpening whole sections.
+
+    Parameters
+    ----------
+
+    volume : array like
+        Volume in the shape (Z, X, Y).
+
+    alpha : float
+        Defaults to 0.5, sharpening strength.
+
+    precision : str
+        Defaults to 'float64', 'float32' or 'float64'.
+
+    Returns
+    -------
+
+    sharpened : dask array
+
+    """
+
+    volume = asChunkedArray(volume)
+    float_type = getPrecisionType(precision)
+
+    def sharpenBlock(block):
+        output = numpy.empty(block.shape, dtype=float_type)
+        for z in range(block.shape[0]):
+            sharpenImage(block[z], alpha=alpha, precision=precision,
+                         out=output[z])
+        return output
+
+    return da.map_overlap(sharpenBlock, volume.astype(float_type),
+                          depth={0: 0, 1: 1, 2: 1}, boundary=0,
+                          dtype=float_type)
+
+
+def chunkedFalseColor(nuclei, cyto,
+                      nuc_threshold=50,
+                      cyto_threshold=50,
+                      nuc_normfactor=5000,
+                      cyto_normfactor=2000,
+                      color_key='HE',
+                      color_settings=None,
+                      precision='float64'):
+    """
+    Lazy falseColorStack of chunked (Z, X, Y) volumes. Every chunk is
+    colored independently, normalization factors which are None are
+    computed once per section over all of its chunks.
+
+    Parameters
+    ----------
+
+    nuclei, cyto : array like
+        Channel volumes in the shape (Z, X, Y), chunked the same way or
+        rechunked to the nuclei chunks.
+
+    nuc_threshold, cyto_threshold : float or 1D array
+        Defaults to 50, background thresholds, one value or one per
+        section.
+
+    nuc_normfactor, cyto_normfactor : None, float or 1D array
+        Defaults to 5000 and 2000, one value or one per section. If
+        None they are computed with getChunkedNormfactors.
+
+    color_key : str
+        Defaults to 'HE', key for getColorSettings.
+
+    color_settings : None or dict
+        Defaults to None, RGB constants which override color_key.
+
+    precision : str
+        Defaults to 'float64', 'float32' or 'float64'.
+
+    Returns
+    -------
+
+    RGB_image : dask array
+        uint8 array in the shape (Z, X, Y, 3).
+
+    """
+
+    nuclei = asChunkedArray(nuclei)
+    cyto = asChunkedArray(cyto).rechunk(nuclei.chunks)
+
+    if nuc_normfactor is None:
+        nuc_normfactor = getChunkedNormfactors(nuclei,
+                                               threshold=nuc_threshold)
+    if cyto_normfactor is None:
+        cyto_normfactor = getChunkedNormfactors(cyto,
+                                                threshold=cyto_threshold)
+
+    def colorBlock(nuclei_block, cyto_block, block_info=None):
+        return falseColorStack(
+                    nuclei_block, cyto_block,
+                    nuc_threshold=getBlockSections(nuc_threshold,
+                                                   block_info),
+                    cyto_threshold=getBlockSections(cyto_threshold,
+                                                    block_info),
+                    nuc_normfactor=getBlockSections(nuc_normfactor,
+                                                    block_info),
+                    cyto_normfactor=getBlockSections(cyto_normfactor,
+                                                     block_info),
+                    color_key=color_key,
+                    color_settings=color_settings,
+                    precision=precision)
+
+    return da.map_blocks(colorBlock, nuclei, cyto, dtype=numpy.uint8,
+                         chunks=nuclei.chunks + ((3,),), new_axis=3)
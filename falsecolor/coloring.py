@@ -35,6 +35,125 @@ import cv2
 import numpy
 from numba import cuda
 import math
+import threading
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+
+
+def getPrecisionType(precision='float64'):
+    """
+    Returns the numpy floating point type for a precision setting used
+    across the coloring and preprocessing methods.
+
+    float32 halves memory traffic and RAM compared to float64. For
+    uint8 output the two precisions produce identical pixels except
+    where a float64 result lies within float32 rounding error of an
+    integer level, those pixels differ by at most 1 intensity level
+    (absolute error <= 1, typically fewer than 0.1% of pixels).
+
+    Parameters
+    ----------
+
+    precision : str
+        Either 'float32' or 'float64', defaults to 'float64'.
+
+    Returns
+    -------
+
+    float_type : numpy dtype
+        numpy.float32 or numpy.float64
+    """
+
+    precision_dict = {'float32': numpy.float32,
+                      'float64': numpy.float64}
+
+    if precision not in precision_dict:
+        raise ValueError("precision must be 'float32' or 'float64', got %s"
+                         % precision)
+
+    return precision_dict[precision]
+
+
+def getOutputShape(out):
+    """
+    Returns the shape of a caller provided destination, either an array
+    or a (dataset, index) tuple.
+    """
+
+    if isinstance(out, tuple):
+        dataset, index = out
+        # index a zero strided array of the dataset shape, nothing is read
+        return numpy.broadcast_to(numpy.uint8(0), dataset.shape)[index].shape
+
+    return tuple(out.shape)
+
+
+def checkOutput(out, shape):
+    """
+    Checks that a caller provided destination has the expected shape.
+
+    Parameters
+    ----------
+
+    out : array like or tuple
+        numpy array, numpy.memmap slice, any writable array supporting
+        slice assignment such as a whole h5py or zarr dataset, or a
+        (dataset, index) tuple naming part of a dataset.
+
+    shape : tuple
+        Expected shape of out.
+
+    Returns
+    -------
+    """
+
+    out_shape = getOutputShape(out)
+    if out_shape != tuple(shape):
+        raise ValueError('out has shape %s, expected %s'
+                         % (out_shape, tuple(shape)))
+
+
+def writeOutput(result, out=None):
+    """
+    Writes a result into a caller provided destination so it does not
+    need to be copied again after it is returned.
+
+    Parameters
+    ----------
+
+    result : numpy array
+        Computed result.
+
+    out : None, array like or tuple
+        Defaults to None, destination of the same shape as result. Can
+        be a numpy array, numpy.memmap slice, any writable array
+        supporting slice assignment such as a whole h5py or zarr
+        dataset, or a (dataset, index) tuple, e.g. (dataset, k) for
+        section k. Slicing an h5py or zarr dataset returns a numpy
+        copy, so parts of a dataset have to be given as a tuple. Values
+        are cast to the dtype of out.
+
+    Returns
+    -------
+
+    out : array like
+        out if provided, otherwise result.
+    """
+
+    if out is None:
+        return result
+
+    checkOutput(out, result.shape)
+
+    if isinstance(out, numpy.ndarray):
+        numpy.copyto(out, result, casting='unsafe')
+    elif isinstance(out, tuple):
+        dataset, index = out
+        dataset[index] = result
+    else:
+        out[...] = result
+
+    return out
 
 
 @cuda.jit  # direct GPU compiling
@@ -104,6 +223,129 @@ def rapidFieldDivision(image, flat_field, output):
         output[row, col] = tmp
 
 
+@cuda.jit(device=True)
+def sampleIntensityMap(intensity_map, x0, x1, weight, row, col,
+                       scale_row, scale_col):
+    """
+    Evaluates the full resolution flat field at a single pixel from the
+    downsampled intensity map. Equivalent to reading pixel (row, col)
+    of interpolateDS(intensity_map, k), using the same linear zoom
+    coordinates as scipy.ndimage.zoom.
+
+    Parameters
+    ----------
+
+    intensity_map : 3D numpy array written to GPU
+
+    x0, x1 : int
+        Bracketing planes from getFlatFieldPlanes
+
+    weight : float
+        Weight of plane x1 from getFlatFieldPlanes
+
+    row, col : int
+        Full resolution pixel location
+
+    scale_row, scale_col : float
+        Ratio between downsampled and full resolution coordinates
+    """
+    n_rows = intensity_map.shape[0]
+    n_cols = intensity_map.shape[2]
+
+    # location in downsampled data
+    r = min(row*scale_row, n_rows - 1)
+    c = min(col*scale_col, n_cols - 1)
+    r0 = int(math.floor(r))
+    c0 = int(math.floor(c))
+    r1 = min(r0 + 1, n_rows - 1)
+    c1 = min(c0 + 1, n_cols - 1)
+    dr = r - r0
+    dc = c - c0
+
+    # bilinear interpolation within each bracketing plane
+    top = intensity_map[r0, x0, c0]*(1 - dc) + intensity_map[r0, x0, c1]*dc
+    bottom = intensity_map[r1, x0, c0]*(1 - dc) + \
+        intensity_map[r1, x0, c1]*dc
+    value0 = top*(1 - dr) + bottom*dr
+
+    top = intensity_map[r0, x1, c0]*(1 - dc) + intensity_map[r0, x1, c1]*dc
+    bottom = intensity_map[r1, x1, c0]*(1 - dc) + \
+        intensity_map[r1, x1, c1]*dc
+    value1 = top*(1 - dr) + bottom*dr
+
+    # linear blend between planes
+    return value0 + weight*(value1 - value0)
+
+
+@cuda.jit
+def rapidFieldDivisionDS(image, intensity_map, x0, x1, weight,
+                         scale_row, scale_col, row_offset, col_offset,
+                         output):
+    """
+    Used for rapidFalseColoring() when the flat field is given as a
+    downsampled intensity map. The flat field is evaluated per pixel so
+    no full resolution flat field image is created.
+
+    Parameters
+    ----------
+
+    image : numpy array written to GPU
+
+    intensity_map : 3D numpy array written to GPU
+
+    x0, x1, weight : int, int, float
+        Bracketing planes and weight from getFlatFieldPlanes
+
+    scale_row, scale_col : float
+        Ratio between downsampled and full resolution coordinates
+
+    row_offset, col_offset : int
+        Location of image[0, 0] in the full resolution section
+
+    output : numpy array written to GPU
+        result from computation
+
+    """
+    row, col = cuda.grid(2)
+
+    if row < output.shape[0] and col < output.shape[1]:
+        flat_field = sampleIntensityMap(intensity_map, x0, x1, weight,
+                                        row + row_offset, col + col_offset,
+                                        scale_row, scale_col)
+        output[row, col] = image[row, col]/flat_field
+
+
+def getIntensityMapScale(intensity_map, tileSize=256):
+    """
+    Returns the coordinate scaling used by scipy.ndimage.zoom when an
+    intensity map is zoomed by tileSize, used by rapidFieldDivisionDS.
+
+    Parameters
+    ----------
+
+    intensity_map : 3D numpy array
+        Downsampled intensity map
+
+    tileSize : int
+        Default = 256, block size for interpolation
+
+    Returns
+    -------
+
+    scale_row, scale_col : float
+        Downsampled coordinate per full resolution pixel
+    """
+
+    scales = []
+    for n in (intensity_map.shape[0], intensity_map.shape[2]):
+        if n > 1:
+            scales.append((n - 1)/(n*tileSize - 1))
+        else:
+            scales.append(0.0)
+
+    return tuple(scales)
+
+
 def rapidFalseColor(nuclei, cyto, nuc_settings, cyto_settings,
                     TPB=(32, 32),
                     nuc_normfactor=8500,
@@ -111,7 +353,12 @@ def rapidFalseColor(nuclei, cyto, nuc_settings, cyto_settings,
                     run_FlatField_nuc=False,
                     run_FlatField_cyto=False,
                     nuc_bg_threshold=50,
-                    cyto_bg_threshold=50):
+                    cyto_bg_threshold=50,
+                    section_index=None,
+                    tileSize=256,
+                    offset=(0, 0),
+                    precision='float64',
+                    out=None):
     """
     Parameters
     ----------
@@ -154,19 +401,48 @@ def rapidFalseColor(nuclei, cyto, nuc_settings, cyto_settings,
         defaults to 50, threshold level for calculating cytoplasmic
         background.
 
+    section_index : None or int
+        defaults to None. If an int, normfactors for channels with
+        run_FlatField are downsampled 3D intensity maps (e.g.
+        beta*getIntensityMap(data)) and the flat field for this section
+        is evaluated per pixel on the GPU instead of being passed as a
+        full resolution array from interpolateDS.
 
+    tileSize : int
+        defaults to 256, block size used to zoom the intensity maps when
+        section_index is given.
+
+    offset : tuple (int, int)
+        defaults to (0, 0), (row, col) location of the first pixel of
+        nuclei and cyto in the full section when they are a crop, e.g.
+        from getTissueBoundingBox. Only used with section_index.
+
+    precision : str
+        defaults to 'float64', floating point precision of the GPU
+        buffers, either 'float32' or 'float64'. See getPrecisionType
+        for error bounds on the RGB output.
+
+    out : None, array like or tuple
+        defaults to None, writable uint8 [X, Y, 3] destination for the
+        result, e.g. a numpy.memmap slice, a whole h5py/zarr dataset or
+        a (dataset, index) tuple, see writeOutput. If None a new array
+        is returned.
 
     Returns
     -------
     RGB_image : 3D numpy array
         Combined false colored image in the standard RGB format
-        [X, Y, C].
+        [X, Y, C]. This is out when provided.
 
     """
 
     # ensure float dtype
-    nuclei = numpy.ascontiguousarray(nuclei, dtype=float)
-    cyto = numpy.ascontiguousarray(cyto, dtype=float)
+    float_type = getPrecisionType(precision)
+    nuclei = numpy.ascontiguousarray(nuclei, dtype=float_type)
+    cyto = numpy.ascontiguousarray(cyto, dtype=float_type)
+
+    if out is not None:
+        checkOutput(out, nuclei.shape + (3,))
 
     # set mulciplicative constants
     k_nuclei = 1.0
@@ -178,21 +454,38 @@ def rapidFalseColor(nuclei, cyto, nuc_settings, cyto_settings,
     blockspergrid = (blockspergrid_x, blockspergrid_y)
 
     # allocate memory for background subtraction
-    pre_nuc_output = cuda.device_array(nuclei.shape)
+    pre_nuc_output = cuda.device_array(nuclei.shape, dtype=float_type)
     nuc_global_mem = cuda.to_device(nuclei)
 
-    pre_cyto_output = cuda.device_array(cyto.shape)
+    pre_cyto_output = cuda.device_array(cyto.shape, dtype=float_type)
     cyto_global_mem = cuda.to_device(cyto)
 
     # run background subtraction or normalization for nuclei
 
     # use intensity leveling
     if run_FlatField_nuc:
-        nuc_normfactor = numpy.ascontiguousarray(nuc_normfactor)
+        nuc_normfactor = numpy.ascontiguousarray(nuc_normfactor,
+                                                 dtype=float_type)
         nuc_norm_mem = cuda.to_device(nuc_normfactor)
 
-        rapidFieldDivision[blockspergrid, TPB](nuc_global_mem, nuc_norm_mem,
-                                               pre_nuc_output)
+        # evaluate flat field from downsampled intensity map
+        if section_index is not None:
+            x0, x1, weight = getFlatFieldPlanes(section_index,
+                                                nuc_normfactor.shape[1],
+                                                tileSize=tileSize)
+            scale_row, scale_col = getIntensityMapScale(nuc_normfactor,
+                                                        tileSize=tileSize)
+            rapidFieldDivisionDS[blockspergrid, TPB](nuc_global_mem,
+                                                     nuc_norm_mem,
+                                                     x0, x1, weight,
+                                                     scale_row, scale_col,
+                                                     offset[0], offset[1],
+                                                     pre_nuc_output)
+
+        else:
+            rapidFieldDivision[blockspergrid, TPB](nuc_global_mem,
+                                                   nuc_norm_mem,
+                                                   pre_nuc_output)
 
     # otherwise use standard background subtraction
     else:
@@ -207,10 +500,28 @@ def rapidFalseColor(nuclei, cyto, nuc_settings, cyto_settings,
 
     # use intensity leveling
     if run_FlatField_cyto:
-        cyto_normfactor = numpy.ascontiguousarray(cyto_normfactor)
+        cyto_normfactor = numpy.ascontiguousarray(cyto_normfactor,
+                                                  dtype=float_type)
         cyto_norm_mem = cuda.to_device(cyto_normfactor)
-        rapidFieldDivision[blockspergrid, TPB](cyto_global_mem,
-                                               cyto_norm_mem, pre_cyto_output)
+
+        # evaluate flat field from downsampled intensity map
+        if section_index is not None:
+            x0, x1, weight = getFlatFieldPlanes(section_index,
+                                                cyto_normfactor.shape[1],
+                                                tileSize=tileSize)
+            scale_row, scale_col = getIntensityMapScale(cyto_normfactor,
+                                                        tileSize=tileSize)
+            rapidFieldDivisionDS[blockspergrid, TPB](cyto_global_mem,
+                                                     cyto_norm_mem,
+                                                     x0, x1, weight,
+                                                     scale_row, scale_col,
+                                                     offset[0], offset[1],
+                                                     pre_cyto_output)
+
+        else:
+            rapidFieldDivision[blockspergrid, TPB](cyto_global_mem,
+                                                   cyto_norm_mem,
+                                                   pre_cyto_output)
 
     # otherwise use standard background subtraction
     else:
@@ -244,6 +555,9 @@ def rapidFalseColor(nuclei, cyto, nuc_settings, cyto_settings,
     # reorder array to dimmensional form [X,Y,C]
     RGB_image = numpy.moveaxis(RGB_image, 0, -1)
 
+    if out is not None:
+        return writeOutput(RGB_image, out)
+
     return RGB_image.astype(numpy.uint8)
 
 
@@ -300,7 +614,9 @@ def falseColor(nuclei, cyto,
                nuc_normfactor=5000,
                cyto_normfactor=2000,
                color_key='HE',
-               color_settings=None):
+               color_settings=None,
+               precision='float64',
+               out=None):
     """
     CPU-based two channel virtual H&E coloring using Beer's law method.
 
@@ -346,11 +662,24 @@ def falseColor(nuclei, cyto,
         color_key provided. If different color settings are desired the
         keys to the dictionary should be 'nuclei' and 'cyto'.
 
+    precision : str
+        defaults to 'float64', floating point precision of intermediate
+        arrays, either 'float32' or 'float64'. See getPrecisionType for
+        error bounds on the RGB output.
+
+    out : None, array like or tuple
+        defaults to None, writable [X, Y, 3] destination for the result,
+        e.g. a numpy.memmap slice, a whole h5py/zarr dataset or a
+        (dataset, index) tuple, see writeOutput. Its dtype takes the
+        place of output_dtype. If None a new array is
+        returned.
+
 
     Returns
     -------
     RGB_image : numpy array
-        Combined virtual H&E image in the standard RGB format [X, Y, C]
+        Combined virtual H&E image in the standard RGB format [X, Y, C].
+        This is out when provided.
 
     """
     beta_dict = {
@@ -371,16 +700,32 @@ def falseColor(nuclei, cyto,
     k_cytoplasm = beta_dict['K_cyto']
 
     # execute background subtraction
-    nuclei = nuclei.astype(float)
+    float_type = getPrecisionType(precision)
+    nuclei = nuclei.astype(float_type)
     nuclei = preProcess(nuclei, threshold=nuc_threshold,
-                        normfactor=nuc_normfactor)
+                        normfactor=nuc_normfactor, precision=precision)
 
-    cyto = cyto.astype(float)
+    cyto = cyto.astype(float_type)
     cyto = preProcess(cyto, threshold=cyto_threshold,
-                      normfactor=cyto_normfactor)
+                      normfactor=cyto_normfactor, precision=precision)
+
+    # write color channels straight into numpy destinations
+    if isinstance(out, numpy.ndarray):
+        checkOutput(out, nuclei.shape + (3,))
+
+        for i in range(3):
+            tmp_c = constants_cyto[i]*k_cytoplasm*cyto
+            tmp_n = constants_nuclei[i]*k_nuclei*nuclei
+            numpy.copyto(out[:, :, i],
+                         255*numpy.multiply(numpy.exp(-tmp_c),
+                                            numpy.exp(-tmp_n)),
+                         casting='unsafe')
+
+        return out
 
     # create array to store RGB image
-    RGB_image = numpy.zeros((3, nuclei.shape[0], nuclei.shape[1]))
+    RGB_image = numpy.zeros((3, nuclei.shape[0], nuclei.shape[1]),
+                            dtype=float_type)
 
     # iterate throough RGB constants and execute image multiplication
     for i in range(len(RGB_image)):
@@ -388,6 +733,9 @@ def falseColor(nuclei, cyto,
         tmp_n = constants_nuclei[i]*k_nuclei*nuclei
         RGB_image[i] = 255*numpy.multiply(numpy.exp(-tmp_c), numpy.exp(-tmp_n))
 
+    if out is not None:
+        return writeOutput(numpy.moveaxis(RGB_image, 0, -1), out)
+
     # reshape to [X,Y,C]
     RGB_image = numpy.moveaxis(RGB_image, 0, -1)
 
@@ -395,186 +743,751 @@ def falseColor(nuclei, cyto,
     return RGB_image.astype(output_dtype)
 
 
-def preProcess(image, threshold=50, normfactor=None):
+def falseColorStackChunk(nuclei, cyto, nuc_threshold, cyto_threshold,
+                         nuc_scale, cyto_scale, nuc_constants,
+                         cyto_constants, output, float_type):
     """
-    Method used for background subtracting data with a fixed value
+    Vectorized coloring of a chunk of sections for falseColorStack.
+    Applies the same operations as preProcess and falseColor, with per
+    section parameters broadcast along the first axis.
 
     Parameters
     ----------
 
-    image : 2D numpy array
-        image for processing
+    nuclei : 3D array
+        Nuclear channel chunk [Z, X, Y].
 
-    threshold : int
-        background level to subtract
+    cyto : 3D array
+        Cytoplasm channel chunk [Z, X, Y].
 
-    Returns
-    -------
+    nuc_threshold, cyto_threshold : 1D numpy array
+        Per section background levels.
 
-    processed_image : 2D numpy array
-        Background subtracted image.
-    """
+    nuc_scale, cyto_scale : 1D numpy array
+        Per section normalization factors, 65535/normfactor.
 
-    # background subtraction
-    image -= threshold
+    nuc_constants, cyto_constants : list
+        RGB constants multiplied by their channel k constant.
 
-    # no negative values
-    image[image < 0] = 0
+    output : 4D numpy array
+        uint8 array [Z, X, Y, 3] to store the result in.
 
-    # calculate normalization factor
-    image = numpy.power(image, 0.85)
-    if normfactor is None:
-        normfactor = numpy.mean(image[image > threshold])*8
+    float_type : numpy dtype
+    """
 
-    # convert into 8bit range
-    processed_image = image*(65535/normfactor)*(255/65535)
+    channels = []
+    for stack, threshold, scale in [(nuclei, nuc_threshold, nuc_scale),
+                                    (cyto, cyto_threshold, cyto_scale)]:
 
-    return processed_image
+        # background subtraction as in preProcess
+        image = numpy.array(stack, dtype=float_type)
+        image -= threshold[:, None, None]
+        numpy.maximum(image, 0, out=image)
+        numpy.power(image, 0.85, out=image)
+        image *= scale[:, None, None]
+        image *= (255/65535)
+        channels.append(image)
 
+    nuclei, cyto = channels
 
-@cuda.jit
-def Convolve2d(image, kernel, output):
+    # iterate through RGB constants and execute image multiplication
+    for i in range(3):
+        tmp_c = cyto_constants[i]*cyto
+        tmp_n = nuc_constants[i]*nuclei
+        numpy.copyto(output[..., i],
+                     255*numpy.multiply(numpy.exp(-tmp_c),
+                                        numpy.exp(-tmp_n)),
+                     casting='unsafe')
+
+
+def getStackParameter(value, n_sections, float_type):
     """
-    GPU based 2d convolution method.
+    Broadcasts a global or per section parameter to one value per
+    section, used by falseColorStack.
 
     Parameters
     ----------
 
-    image : 2D numpy array
-        Image for processing, written to GPU.
+    value : float or sequence
+        Single value for every section or one value per section.
 
-    kernel : 2D numpy array
-        kernel to convolve image with, written to GPU
+    n_sections : int
+        Number of sections in the stack.
 
-    output : 2D numpy array
-        Output array, storing result of convolution, written to GPU.
+    float_type : numpy dtype
 
     Returns
     -------
-    This method requires an output array as an argument, the results
-    of the compuation are stored there.
-    """
-
-    # create iterator
-    row, col = cuda.grid(2)
 
-    image_rows, image_cols = image.shape
+    values : 1D numpy array
+        One value per section.
+    """
 
-    delta_r = kernel.shape[0]//2
-    delta_c = kernel.shape[1]//2
+    values = numpy.asarray(value, dtype=float_type)
 
-    # ignore rows/cols outside image
-    if (row >= image_rows) or (col >= image_cols):
-        return
+    if values.ndim == 0:
+        return numpy.full(n_sections, values, dtype=float_type)
 
-    tmp = 0
-    for i in range(kernel.shape[0]):
-        for j in range(kernel.shape[1]):
-            # result should be sum of kernel*image as kernel is varied
-            row_i = row - i + delta_r
-            col_j = col - j + delta_c
-            if (row_i >= 0) and (row_i < image_rows):
-                if (col_j >= 0) and (col_j < image_cols):
-                    tmp += kernel[i, j]*image[row_i, col_j]
+    if values.shape != (n_sections,):
+        raise ValueError('expected a single value or %d per section values, '
+                         'got shape %s' % (n_sections, values.shape))
 
-    output[row, col] = tmp
+    return values
 
 
-def sharpenImage(input_image, alpha=0.5):
+def falseColorStack(nuclei, cyto,
+                    nuc_threshold=50,
+                    cyto_threshold=50,
+                    nuc_normfactor=5000,
+                    cyto_normfactor=2000,
+                    color_key='HE',
+                    color_settings=None,
+                    precision='float64',
+                    chunk_pixels=2**16,
+                    n_threads=1,
+                    out=None):
     """
-    Image sharpening algorithm to amplify edges.
+    Batched version of falseColor for [Z, X, Y] stacks. Sections are
+    colored in vectorized chunks with per section parameters broadcast
+    along Z, so per call setup and dispatch is paid once per chunk
+    instead of once per section. Results are identical to calling
+    falseColor on every section.
 
     Parameters
     ----------
+    nuclei : 3D numpy array
+        Nuclear stain stack [Z, X, Y].
 
-    input_image : 2D numpy array
-        Image to run sharpening algorithm on
+    cyto : 3D numpy array
+        Cytoplasm stain stack [Z, X, Y].
 
-    alpha : float or int
-        Multiplicative constant for final result.
+    nuc_threshold : float or sequence
+        defaults to 50, background level for every section or one per
+        section.
+
+    cyto_threshold : float or sequence
+        defaults to 50, background level for every section or one per
+        section.
+
+    nuc_normfactor : None, float or sequence
+        defaults to 5000, color saturation level for every section or
+        one per section. If None it is calculated per section as in
+        preProcess.
+
+    cyto_normfactor : None, float or sequence
+        defaults to 2000, as nuc_normfactor.
+
+    color_key : str
+        defaults to HE, color settings key for getColorSettings
+
+    color_settings : None or dict
+        defaults to None, dictionary with 'nuclei' and 'cyto' RGB
+        constants. If None getColorSettings(color_key) is used.
+
+    precision : str
+        defaults to 'float64', either 'float32' or 'float64'.
+
+    chunk_pixels : int
+        defaults to 2**16, approximate number of pixels colored per
+        vectorized chunk, bounds the size of temporary arrays.
+
+    n_threads : int
+        defaults to 1, number of threads coloring chunks concurrently.
+
+    out : None, array like or tuple
+        defaults to None, writable uint8 [Z, X, Y, 3] destination such
+        as a numpy.memmap, an h5py/zarr dataset or a (dataset, index)
+        tuple with integer indices, e.g. (dataset, timepoint). Chunks
+        are written to it as they finish, so the stack is never held
+        in memory as a whole.
 
     Returns
-    --------
+    -------
+    RGB_stack : 4D numpy array
+        Virtual H&E stack in the format [Z, X, Y, C]. This is out when
+        provided.
 
-    final_image : 2D numpy array
-        The sum of the input image and the resulting convolutions
     """
-    # create kernels to amplify edges
-    hkernel = numpy.array([[1, 1, 1], [0, 0, 0], [-1, -1, -1]])
-    vkernel = numpy.array([[1, 0, -1], [1, 0, -1], [1, 0, -1]])
 
-    # set grid/threads for GPU
-    blocks = (32, 32)
-    grid = (input_image.shape[0]//blocks[0] + 1,
-            input_image.shape[1]//blocks[1] + 1)
+    float_type = getPrecisionType(precision)
 
-    # run convolution
-    input_image = numpy.ascontiguousarray(input_image)
-    voutput = cuda.device_array(input_image.shape, dtype=numpy.float64)
-    houtput = cuda.device_array(input_image.shape, dtype=numpy.float64)
-    Convolve2d[grid, blocks](input_image, vkernel, voutput)
-    Convolve2d[grid, blocks](input_image, hkernel, houtput)
+    if nuclei.ndim != 3 or nuclei.shape != cyto.shape:
+        raise ValueError('nuclei and cyto must be [Z, X, Y] stacks of the '
+                         'same shape')
 
-    voutput = voutput.copy_to_host()
-    houtput = houtput.copy_to_host()
+    n_sections = nuclei.shape[0]
 
-    # calculate final result
-    final_image = input_image + alpha*numpy.sqrt(voutput**2 + houtput**2)
+    # same adjustment constants as falseColor
+    k_nuclei = 0.08
+    k_cytoplasm = 0.0120
 
-    return final_image
+    if color_settings is None:
+        color_settings = getColorSettings(key=color_key)
 
+    nuc_constants = [c*k_nuclei for c in color_settings['nuclei']]
+    cyto_constants = [c*k_cytoplasm for c in color_settings['cyto']]
+
+    nuc_threshold = getStackParameter(nuc_threshold, n_sections, float_type)
+    cyto_threshold = getStackParameter(cyto_threshold, n_sections,
+                                       float_type)
+
+    # per section normalization, computed from data when None
+    scales = []
+    for normfactor, stack, threshold in [
+            (nuc_normfactor, nuclei, nuc_threshold),
+            (cyto_normfactor, cyto, cyto_threshold)]:
+
+        if normfactor is None:
+            normfactor = []
+            for z in range(n_sections):
+                image = numpy.asarray(stack[z], dtype=float_type) - \
+                    threshold[z]
+                image = numpy.power(numpy.maximum(image, 0), 0.85)
+                normfactor.append(numpy.mean(image[image > threshold[z]])*8)
+
+        normfactor = getStackParameter(normfactor, n_sections, numpy.float64)
+        scales.append((65535/normfactor).astype(float_type))
+
+    # write straight into numpy destinations, other destinations
+    # receive every chunk as it finishes
+    output = None
+    if out is None:
+        output = numpy.zeros(nuclei.shape + (3,), dtype=numpy.uint8)
+    elif isinstance(out, numpy.ndarray):
+        checkOutput(out, nuclei.shape + (3,))
+        output = out
+    else:
+        checkOutput(out, nuclei.shape + (3,))
 
-def getColorSettings(key='HE'):
+    chunk = max(1, chunk_pixels//(nuclei.shape[1]*nuclei.shape[2]))
 
-    """Returns color parameters for false coloring data.
+    # h5py and zarr chunks may be shared by neighbouring section chunks
+    write_lock = threading.Lock()
+
+    def colorChunk(z0):
+        z1 = min(z0 + chunk, n_sections)
+
+        if output is not None:
+            destination = output[z0:z1]
+        else:
+            destination = numpy.empty((z1 - z0,) + nuclei.shape[1:] + (3,),
+                                      dtype=numpy.uint8)
+
+        falseColorStackChunk(nuclei[z0:z1], cyto[z0:z1],
+                             nuc_threshold[z0:z1], cyto_threshold[z0:z1],
+                             scales[0][z0:z1], scales[1][z0:z1],
+                             nuc_constants, cyto_constants,
+                             destination, float_type)
+
+        if output is None:
+            with write_lock:
+                if isinstance(out, tuple):
+                    dataset, index = out
+                    if not isinstance(index, tuple):
+                        index = (index,)
+                    dataset[index + (slice(z0, z1),)] = destination
+                else:
+                    out[z0:z1] = destination
+
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(colorChunk, range(0, n_sections, chunk)))
+    else:
+        for z0 in range(0, n_sections, chunk):
+            colorChunk(z0)
+
+    if output is None:
+        return out
+
+    return output
+
+
+def getStainParameter(value, n_stains):
+    """
+    Broadcasts a global or per stain parameter to one value per stain,
+    used by the multi stain coloring methods.
 
     Parameters
     ----------
 
-    key : str
-        Defaults to 'HE'. Which RGB settings to use, when 'HE' will use
-        RGB settings for virtual H&E staining.
-
-        'IHC' will return color settings for virtual IHC/DAB staining.
+    value : None, float or sequence
+        Single value for every stain or one value per stain.
 
+    n_stains : int
+        Number of stains.
 
     Returns
     -------
-    color_dict : dict
-        Dictionary with keys ('nuclei', 'cyto') or ('nuclei', 'anti'),
-        which correspond to lists containing empirically derived
-        RGB constants for false coloring.
-
 
+    values : list
+        One value per stain.
     """
 
-    color_dict = {
-                    'HE': {'nuclei': [0.17, 0.27, 0.105],
-                           'cyto': [0.05, 1.0, 0.54]},
+    if value is None or numpy.ndim(value) == 0:
+        return [value]*n_stains
 
-                    'IHC': {'nuclei': [0.65, 0.45, 0.15],
-                            'anti': [0.4, 0.7, 0.9]}
-                }
+    values = list(value)
+    if len(values) != n_stains:
+        raise ValueError('expected a single value or %d per stain values, '
+                         'got %d' % (n_stains, len(values)))
 
-    return color_dict[key]
+    return values
 
 
-def applyCLAHE(image, clahe=None,
-               tileGridSize=(8, 8),
-               input_dtype=numpy.uint16,
-               clipLimit=0.048):
+def multiStainFalseColor(channels, stain_settings, k_constants,
+                         thresholds=50,
+                         normfactors=None,
+                         output_dtype=numpy.uint8,
+                         precision='float64',
+                         out=None):
     """
-    Applies Contrast Limited Adaptive Histogram Equalization algorithm
-    from OpenCV.
+    CPU-based N channel virtual staining using Beer's law. Generalizes
+    falseColor to any number of fluorescence channels: the optical
+    density of every stain is summed per RGB channel and a single
+    exponential is evaluated, so three or four stain virtual IHC takes
+    one pass instead of several composited falseColor passes. For two
+    channels with falseColor's constants the result matches falseColor
+    to within 1 intensity level.
 
     Parameters
     ----------
+    channels : sequence of 2D numpy arrays or 3D numpy array
+        N fluorescence images [N, X, Y], one per stain.
 
-    image : 2D numpy array
-        Image for histogram equalization
+    stain_settings : sequence
+        N RGB attenuation vectors, e.g. getColorSettings('IHC') values,
+        in the same order as channels.
 
-    clahe : None or cv2.CLAHE object
-        CV2 object to use for equalization
+    k_constants : sequence
+        N multiplicative constants, falseColor uses 0.08 for nuclei and
+        0.012 for cyto.
+
+    thresholds : float or sequence
+        defaults to 50, background level for every channel or one per
+        channel.
+
+    normfactors : None, float or sequence
+        defaults to None, color saturation level for every channel or
+        one per channel, used in preProcess. None entries are computed
+        from the image.
+
+    output_dtype : numpy.uint8
+        output datatype for final RGB image
+
+    precision : str
+        defaults to 'float64', either 'float32' or 'float64'.
+
+    out : None or array like
+        defaults to None, writable [X, Y, 3] destination.
+
+    Returns
+    -------
+    RGB_image : numpy array
+        Combined virtual stain image in the standard RGB format
+        [X, Y, C]. This is out when provided.
+
+    """
+
+    float_type = getPrecisionType(precision)
+    n_stains = len(channels)
+
+    stain_settings = numpy.asarray(stain_settings, dtype=float)
+    if stain_settings.shape != (n_stains, 3):
+        raise ValueError('stain_settings must be %d RGB vectors' % n_stains)
+
+    k_constants = getStainParameter(k_constants, n_stains)
+    thresholds = getStainParameter(thresholds, n_stains)
+    normfactors = getStainParameter(normfactors, n_stains)
+
+    # background subtraction for every stain
+    processed = [preProcess(numpy.array(channels[j], dtype=float_type),
+                            threshold=thresholds[j],
+                            normfactor=normfactors[j],
+                            precision=precision)
+                 for j in range(n_stains)]
+
+    shape = processed[0].shape
+    if isinstance(out, numpy.ndarray):
+        checkOutput(out, shape + (3,))
+        RGB_image = out
+    else:
+        RGB_image = numpy.zeros(shape + (3,), dtype=output_dtype)
+
+    # sum optical density of every stain then exponentiate once
+    optical_density = numpy.zeros(shape, dtype=float_type)
+    tmp = numpy.zeros(shape, dtype=float_type)
+    for i in range(3):
+        optical_density[:] = 0
+        for j in range(n_stains):
+            numpy.multiply(processed[j], stain_settings[j, i]*k_constants[j],
+                           out=tmp)
+            optical_density += tmp
+
+        numpy.negative(optical_density, out=optical_density)
+        numpy.exp(optical_density, out=optical_density)
+        optical_density *= 255
+        numpy.copyto(RGB_image[:, :, i], optical_density, casting='unsafe')
+
+    if out is not None and RGB_image is not out:
+        return writeOutput(RGB_image, out)
+
+    return RGB_image
+
+
+@cuda.jit  # direct GPU compiling
+def rapidGetRGBframeN(channels, stain_settings, k_constants, output):
+    """
+    GPU based N stain exponential false coloring operation. Sums the
+    optical density of every stain and writes all three RGB values of a
+    pixel in one launch. Used by rapidMultiStainFalseColor().
+
+    Parameters
+    ----------
+    channels : 3D numpy array written to GPU
+        Preprocessed stain images [N, X, Y]
+
+    stain_settings : 2D numpy array written to GPU
+        RGB constants for every stain [N, 3]
+
+    k_constants : 1D numpy array written to GPU
+        Multiplicative constant for every stain
+
+    output : 3D numpy array written to GPU
+        uint8 result [X, Y, 3]
+    """
+    row, col = cuda.grid(2)
+
+    if row < output.shape[0] and col < output.shape[1]:
+        for i in range(3):
+            tmp = 0.0
+            for j in range(channels.shape[0]):
+                tmp += channels[j, row, col]*stain_settings[j, i] * \
+                    k_constants[j]
+            output[row, col, i] = 255*math.exp(-1*tmp)
+
+
+def rapidMultiStainFalseColor(channels, stain_settings, k_constants,
+                              TPB=(32, 32),
+                              normfactors=8500,
+                              bg_thresholds=50,
+                              precision='float64',
+                              out=None):
+    """
+    GPU-based N channel virtual staining using Beer's law, see
+    multiStainFalseColor. Each channel is background subtracted with
+    rapidPreProcess, then all stains are combined into the RGB image in
+    a single kernel launch.
+
+    Parameters
+    ----------
+
+    channels : sequence of 2D numpy arrays or 3D numpy array
+        N fluorescence images [N, X, Y], one per stain.
+
+    stain_settings : sequence
+        N RGB attenuation vectors in the same order as channels.
+
+    k_constants : sequence
+        N multiplicative constants, rapidFalseColor uses 0.08 for
+        nuclei and 0.012 for cyto.
+
+    TPB : tuple (int,int)
+        THREADS PER BLOCK: (x_threads,y_threads) used for GPU threads.
+
+    normfactors : float or sequence
+        Defaults to 8500, normalization constant for every channel or
+        one per channel.
+
+    bg_thresholds : int or sequence
+        defaults to 50, threshold level for calculating the background
+        of every channel or one per channel.
+
+    precision : str
+        defaults to 'float64', either 'float32' or 'float64'.
+
+    out : None or array like
+        defaults to None, writable uint8 [X, Y, 3] destination.
+
+    Returns
+    -------
+    RGB_image : 3D numpy array
+        Combined false colored image in the standard RGB format
+        [X, Y, C]. This is out when provided.
+
+    """
+
+    float_type = getPrecisionType(precision)
+    n_stains = len(channels)
+
+    stain_settings = numpy.ascontiguousarray(stain_settings,
+                                             dtype=float_type)
+    if stain_settings.shape != (n_stains, 3):
+        raise ValueError('stain_settings must be %d RGB vectors' % n_stains)
+
+    k_constants = numpy.ascontiguousarray(
+                        getStainParameter(k_constants, n_stains),
+                        dtype=float_type)
+    normfactors = getStainParameter(normfactors, n_stains)
+    bg_thresholds = getStainParameter(bg_thresholds, n_stains)
+
+    shape = numpy.shape(channels[0])
+
+    # create blockgrid for gpu
+    blockspergrid = (int(math.ceil(shape[0] / TPB[0])),
+                     int(math.ceil(shape[1] / TPB[1])))
+
+    # background subtraction for every stain
+    pre_output = cuda.device_array((n_stains,) + shape, dtype=float_type)
+    for j in range(n_stains):
+        image = numpy.ascontiguousarray(channels[j], dtype=float_type)
+        background = getBackgroundLevels(image,
+                                         threshold=bg_thresholds[j])[1]
+
+        rapidPreProcess[blockspergrid, TPB](cuda.to_device(image),
+                                             background, normfactors[j],
+                                             pre_output[j])
+
+    # combine all stains in one launch
+    output_global = cuda.device_array(shape + (3,), dtype=numpy.uint8)
+    rapidGetRGBframeN[blockspergrid, TPB](pre_output,
+                                          cuda.to_device(stain_settings),
+                                          cuda.to_device(k_constants),
+                                          output_global)
+
+    RGB_image = output_global.copy_to_host()
+
+    if out is not None:
+        return writeOutput(RGB_image, out)
+
+    return RGB_image
+
+
+def preProcess(image, threshold=50, normfactor=None, precision='float64',
+               out=None):
+    """
+    Method used for background subtracting data with a fixed value
+
+    Parameters
+    ----------
+
+    image : 2D numpy array
+        image for processing
+
+    threshold : int
+        background level to subtract
+
+    normfactor : None or float
+        defaults to None, color saturation level. If None it is
+        calculated from the mean foreground intensity.
+
+    precision : str
+        defaults to 'float64', either 'float32' or 'float64'. Arrays
+        already of this type are processed in place.
+
+    out : None, array like or tuple
+        defaults to None, writable destination of the image shape, e.g.
+        a numpy.memmap slice, a whole h5py/zarr dataset or a (dataset,
+        index) tuple, see writeOutput.
+
+    Returns
+    -------
+
+    processed_image : 2D numpy array
+        Background subtracted image. This is out when provided.
+    """
+
+    float_type = getPrecisionType(precision)
+    image = numpy.asarray(image, dtype=float_type)
+
+    # background subtraction
+    image -= threshold
+
+    # no negative values
+    image[image < 0] = 0
+
+    # calculate normalization factor
+    image = numpy.power(image, 0.85)
+    if normfactor is None:
+        normfactor = numpy.mean(image[image > threshold])*8
+
+    # convert into 8bit range
+    if isinstance(out, numpy.ndarray) and out.dtype == float_type:
+        checkOutput(out, image.shape)
+        numpy.multiply(image, float_type(65535/normfactor), out=out)
+        out *= (255/65535)
+        return out
+
+    processed_image = image*float_type(65535/normfactor)*(255/65535)
+
+    if out is not None:
+        return writeOutput(processed_image, out)
+
+    return processed_image
+
+
+@cuda.jit
+def Convolve2d(image, kernel, output):
+    """
+    GPU based 2d convolution method.
+
+    Parameters
+    ----------
+
+    image : 2D numpy array
+        Image for processing, written to GPU.
+
+    kernel : 2D numpy array
+        kernel to convolve image with, written to GPU
+
+    output : 2D numpy array
+        Output array, storing result of convolution, written to GPU.
+
+    Returns
+    -------
+    This method requires an output array as an argument, the results
+    of the compuation are stored there.
+    """
+
+    # create iterator
+    row, col = cuda.grid(2)
+
+    image_rows, image_cols = image.shape
+
+    delta_r = kernel.shape[0]//2
+    delta_c = kernel.shape[1]//2
+
+    # ignore rows/cols outside image
+    if (row >= image_rows) or (col >= image_cols):
+        return
+
+    tmp = 0
+    for i in range(kernel.shape[0]):
+        for j in range(kernel.shape[1]):
+            # result should be sum of kernel*image as kernel is varied
+            row_i = row - i + delta_r
+            col_j = col - j + delta_c
+            if (row_i >= 0) and (row_i < image_rows):
+                if (col_j >= 0) and (col_j < image_cols):
+                    tmp += kernel[i, j]*image[row_i, col_j]
+
+    output[row, col] = tmp
+
+
+def sharpenImage(input_image, alpha=0.5, precision='float64', out=None):
+    """
+    Image sharpening algorithm to amplify edges.
+
+    Parameters
+    ----------
+
+    input_image : 2D numpy array
+        Image to run sharpening algorithm on
+
+    alpha : float or int
+        Multiplicative constant for final result.
+
+    precision : str
+        Defaults to 'float64', floating point precision of the
+        convolution outputs, either 'float32' or 'float64'.
+
+    out : None, array like or tuple
+        Defaults to None, writable destination of the image shape, e.g.
+        a numpy.memmap slice, a whole h5py/zarr dataset or a (dataset,
+        index) tuple, see writeOutput.
+
+    Returns
+    --------
+
+    final_image : 2D numpy array
+        The sum of the input image and the resulting convolutions. This
+        is out when provided.
+    """
+    # create kernels to amplify edges
+    hkernel = numpy.array([[1, 1, 1], [0, 0, 0], [-1, -1, -1]])
+    vkernel = numpy.array([[1, 0, -1], [1, 0, -1], [1, 0, -1]])
+
+    # set grid/threads for GPU
+    blocks = (32, 32)
+    grid = (input_image.shape[0]//blocks[0] + 1,
+            input_image.shape[1]//blocks[1] + 1)
+
+    # run convolution
+    float_type = getPrecisionType(precision)
+    input_image = numpy.ascontiguousarray(input_image, dtype=float_type)
+    voutput = cuda.device_array(input_image.shape, dtype=float_type)
+    houtput = cuda.device_array(input_image.shape, dtype=float_type)
+    Convolve2d[grid, blocks](input_image, vkernel, voutput)
+    Convolve2d[grid, blocks](input_image, hkernel, houtput)
+
+    voutput = voutput.copy_to_host()
+    houtput = houtput.copy_to_host()
+
+    # calculate final result
+    if isinstance(out, numpy.ndarray) and out.dtype == float_type:
+        checkOutput(out, input_image.shape)
+        numpy.add(input_image, alpha*numpy.sqrt(voutput**2 + houtput**2),
+                  out=out)
+        return out
+
+    final_image = input_image + alpha*numpy.sqrt(voutput**2 + houtput**2)
+
+    if out is not None:
+        return writeOutput(final_image, out)
+
+    return final_image
+
+
+def getColorSettings(key='HE'):
+
+    """Returns color parameters for false coloring data.
+
+    Parameters
+    ----------
+
+    key : str
+        Defaults to 'HE'. Which RGB settings to use, when 'HE' will use
+        RGB settings for virtual H&E staining.
+
+        'IHC' will return color settings for virtual IHC/DAB staining.
+
+
+    Returns
+    -------
+    color_dict : dict
+        Dictionary with keys ('nuclei', 'cyto') or ('nuclei', 'anti'),
+        which correspond to lists containing empirically derived
+        RGB constants for false coloring.
+
+
+    """
+
+    color_dict = {
+                    'HE': {'nuclei': [0.17, 0.27, 0.105],
+                           'cyto': [0.05, 1.0, 0.54]},
+
+                    'IHC': {'nuclei': [0.65, 0.45, 0.15],
+                            'anti': [0.4, 0.7, 0.9]}
+                }
+
+    return color_dict[key]
+
+
+def applyCLAHE(image, clahe=None,
+               tileGridSize=(8, 8),
+               input_dtype=numpy.uint16,
+               clipLimit=0.048):
+    """
+    Applies Contrast Limited Adaptive Histogram Equalization algorithm
+    from OpenCV.
+
+    Parameters
+    ----------
+
+    image : 2D numpy array
+        Image for histogram equalization
+
+    clahe : None or cv2.CLAHE object
+        CV2 object to use for equalization
 
     tileGridSize : tuple
         Tuple of ints representing the windowsize for CLAHE,
@@ -609,6 +1522,544 @@ def applyCLAHE(image, clahe=None,
     return final_image.astype(input_dtype)
 
 
+def getCLAHETileLUTs(image, tileGridSize=(8, 8),
+                     clipLimit=0.048,
+                     input_dtype=numpy.uint16):
+    """
+    Calculates the clipped histogram lookup tables for every CLAHE tile
+    of an image, reading one row of tiles at a time. Follows the tile
+    layout, clipping and redistribution used by OpenCV's CLAHE so that
+    the tables can be shared between blocks of a tiled equalization.
+
+    Parameters
+    ----------
+
+    image : 2D numpy array, numpy.memmap or h5py dataset
+        Image for histogram equalization, only slices of one tile row
+        are read into memory at a time.
+
+    tileGridSize : tuple
+        Tuple of ints (tiles along columns, tiles along rows), same
+        convention as cv2.createCLAHE.
+
+    clipLimit : float
+        Contrast limit for each tile, same convention as
+        cv2.createCLAHE.
+
+    input_dtype : numpy dtype
+        Either numpy.uint8 or numpy.uint16, sets the histogram size.
+
+    Returns
+    -------
+
+    luts : 3D numpy array
+        Lookup tables in the shape [tile_rows, tile_cols, histSize].
+
+    tileSize : tuple
+        (rows, cols) size of a single tile in pixels.
+
+    image_max : int
+        Maximum value of the image, used for renormalization.
+
+    """
+
+    histSize = int(numpy.iinfo(input_dtype).max) + 1
+    tilesX, tilesY = tileGridSize
+    rows, cols = image.shape[:2]
+
+    # OpenCV pads both axes whenever either axis does not divide evenly
+    # into the tile grid, an axis which divides gets one extra row or
+    # column per tile
+    pad_rows, pad_cols = 0, 0
+    if rows % tilesY or cols % tilesX:
+        pad_rows = tilesY - (rows % tilesY)
+        pad_cols = tilesX - (cols % tilesX)
+    tile_rows = (rows + pad_rows)//tilesY
+    tile_cols = (cols + pad_cols)//tilesX
+    tileSizeTotal = tile_rows*tile_cols
+
+    lutScale = numpy.float32(histSize - 1)/numpy.float32(tileSizeTotal)
+
+    limit = 0
+    if clipLimit > 0.0:
+        limit = max(int(clipLimit*tileSizeTotal/histSize), 1)
+
+    luts = numpy.zeros((tilesY, tilesX, histSize), dtype=input_dtype)
+    image_max = 0
+
+    def reflect(index, size):
+        # padding indices as cv2.BORDER_REFLECT_101
+        return numpy.where(index < size, index, 2*(size - 1) - index)
+
+    col_index = reflect(numpy.arange(cols + pad_cols), cols)
+
+    for ty in range(tilesY):
+
+        # read tile row, including the rows needed for reflected padding
+        row_index = reflect(numpy.arange(ty*tile_rows, (ty + 1)*tile_rows),
+                            rows)
+        read_start, read_stop = row_index.min(), row_index.max() + 1
+        strip = numpy.asarray(image[read_start:read_stop]).astype(
+                                                                input_dtype)
+        image_max = max(image_max, int(strip.max()))
+
+        strip = strip[row_index - read_start][:, col_index]
+
+        for tx in range(tilesX):
+            tile = strip[:, tx*tile_cols:(tx + 1)*tile_cols]
+            hist = numpy.bincount(tile.ravel(),
+                                  minlength=histSize).astype(numpy.int64)
+
+            # clip histogram and redistribute clipped pixels
+            if limit > 0:
+                clipped = int(numpy.sum(hist[hist > limit] - limit))
+                hist = numpy.minimum(hist, limit)
+
+                redistBatch = clipped//histSize
+                residual = clipped - redistBatch*histSize
+                hist += redistBatch
+
+                if residual != 0:
+                    residualStep = max(histSize//residual, 1)
+                    hist[0:histSize:residualStep][:residual] += 1
+
+            cumulative = numpy.cumsum(hist).astype(numpy.float32)
+            luts[ty, tx] = numpy.clip(numpy.rint(cumulative*lutScale),
+                                      0, histSize - 1)
+
+    return luts, (tile_rows, tile_cols), image_max
+
+
+def applyTiledCLAHE(image, tileGridSize=(8, 8),
+                    input_dtype=numpy.uint16,
+                    clipLimit=0.048,
+                    blockSize=1,
+                    out=None):
+    """
+    Block-wise version of applyCLAHE for sections which are too large to
+    hold in memory. Tile lookup tables are calculated once for the whole
+    image by getCLAHETileLUTs, the image is then equalized in blocks of
+    whole tile rows which interpolate across block boundaries using the
+    shared tables, so there are no seams between blocks. Output matches
+    applyCLAHE to within rounding.
+
+    Parameters
+    ----------
+
+    image : 2D numpy array, numpy.memmap or h5py dataset
+        Image for histogram equalization.
+
+    tileGridSize : tuple
+        Tuple of ints representing the number of CLAHE tiles, same
+        convention as applyCLAHE.
+
+    input_dtype : numpy dtype
+        Either numpy.uint8 or numpy.uint16.
+
+    clipLimit : float
+        Contrast limit for each tile.
+
+    blockSize : int
+        Defaults to 1, number of tile rows equalized per block. Peak
+        memory scales with blockSize times the tile row size.
+
+    out : None or 2D array
+        Defaults to None, writable array (e.g. numpy.memmap or h5py
+        dataset) of the image shape to store the result in. If None a
+        new array is allocated.
+
+    Returns
+    -------
+
+    equalized_image : 2D array
+        Image with equalized histogram, this is out when provided.
+
+    """
+
+    luts, tileSize, image_max = getCLAHETileLUTs(image,
+                                                 tileGridSize=tileGridSize,
+                                                 clipLimit=clipLimit,
+                                                 input_dtype=input_dtype)
+    tilesX, tilesY = tileGridSize
+    rows, cols = image.shape[:2]
+
+    if out is None:
+        out = numpy.zeros((rows, cols), dtype=input_dtype)
+
+    # column interpolation weights are shared by every block
+    inv_tw = numpy.float32(1.0)/numpy.float32(tileSize[1])
+    txf = numpy.arange(cols, dtype=numpy.float32)*inv_tw - numpy.float32(0.5)
+    tx1 = numpy.floor(txf).astype(int)
+    xa = (txf - tx1).astype(numpy.float32)
+    xa1 = numpy.float32(1.0) - xa
+    tx2 = numpy.minimum(tx1 + 1, tilesX - 1)
+    tx1 = numpy.maximum(tx1, 0)
+
+    inv_th = numpy.float32(1.0)/numpy.float32(tileSize[0])
+    equalized_max = 0
+
+    # equalize blocks aligned to tile rows
+    for r0 in range(0, rows, blockSize*tileSize[0]):
+        r1 = min(r0 + blockSize*tileSize[0], rows)
+        block = numpy.asarray(image[r0:r1]).astype(input_dtype)
+
+        tyf = numpy.arange(r0, r1, dtype=numpy.float32)*inv_th - \
+            numpy.float32(0.5)
+        ty1 = numpy.floor(tyf).astype(int)
+        ya = (tyf - ty1).astype(numpy.float32)[:, None]
+        ya1 = numpy.float32(1.0) - ya
+        ty2 = numpy.minimum(ty1 + 1, tilesY - 1)[:, None]
+        ty1 = numpy.maximum(ty1, 0)[:, None]
+
+        top = luts[ty1, tx1, block]*xa1 + luts[ty1, tx2, block]*xa
+        bottom = luts[ty2, tx1, block]*xa1 + luts[ty2, tx2, block]*xa
+        equalized = numpy.rint(top*ya1 + bottom*ya).astype(input_dtype)
+
+        equalized_max = max(equalized_max, int(equalized.max()))
+        out[r0:r1] = equalized
+
+    # renormalize to original image levels
+    for r0 in range(0, rows, blockSize*tileSize[0]):
+        r1 = min(r0 + blockSize*tileSize[0], rows)
+        block = numpy.asarray(out[r0:r1])
+        out[r0:r1] = (image_max*(block/equalized_max)).astype(input_dtype)
+
+    return out
+
+
+def getTissueTiles(image, tileSize=256, threshold=50, scale=1):
+    """
+    Classifies the tiles of a section as tissue or empty background
+    from their maximum intensity. The section can come from any
+    pyramid level, so the low resolution level already loaded for
+    getIntensityMap makes this nearly free.
+
+    Parameters
+    ----------
+
+    image : 2D numpy array
+        Section at any resolution level.
+
+    tileSize : int
+        Defaults to 256, lateral tile size in full resolution pixels.
+
+    threshold : float
+        Defaults to 50, tiles with a maximum at or below this value are
+        empty.
+
+    scale : int
+        Defaults to 1, downsampling factor of image relative to full
+        resolution.
+
+    Returns
+    -------
+
+    tissue_tiles : 2D numpy array
+        Boolean mask with one entry per full resolution tile, True
+        where there is tissue.
+
+    """
+
+    image = numpy.asarray(image)
+    ds_tile = max(1, int(tileSize//scale))
+
+    rows = int(numpy.ceil(image.shape[0]/ds_tile))
+    cols = int(numpy.ceil(image.shape[1]/ds_tile))
+
+    # pad to whole tiles and take the maximum of every tile
+    padded = numpy.zeros((rows*ds_tile, cols*ds_tile), dtype=image.dtype)
+    padded[:image.shape[0], :image.shape[1]] = image
+    tile_max = padded.reshape(rows, ds_tile, cols, ds_tile).max(axis=(1, 3))
+
+    return tile_max > threshold
+
+
+def getTissueRegions(tissue_tiles, shape, tileSize=256):
+    """
+    Splits the tissue of a section into rectangular regions, one per run
+    of adjacent tissue tiles in a tile row, so that sparse sections are
+    read and processed in a few large calls instead of one per tile.
+
+    Parameters
+    ----------
+
+    tissue_tiles : 2D numpy array
+        Boolean mask from getTissueTiles.
+
+    shape : tuple
+        (X, Y) shape of the full resolution section.
+
+    tileSize : int
+        Defaults to 256, lateral tile size in pixels.
+
+    Returns
+    -------
+
+    regions : list of tuples
+        (row_start, row_stop, col_start, col_stop) in pixels, clipped
+        to shape.
+
+    """
+
+    regions = []
+    for tile_row, row_tiles in enumerate(tissue_tiles):
+        r0 = tile_row*tileSize
+        r1 = min(r0 + tileSize, shape[0])
+        if r0 >= r1:
+            continue
+
+        # find runs of adjacent tissue tiles
+        edges = numpy.diff(numpy.concatenate(([0], row_tiles.astype(int),
+                                              [0])))
+        for start, stop in zip(numpy.where(edges == 1)[0],
+                               numpy.where(edges == -1)[0]):
+            c0 = int(start)*tileSize
+            c1 = min(int(stop)*tileSize, shape[1])
+            if c0 < c1:
+                regions.append((r0, r1, c0, c1))
+
+    return regions
+
+
+def applyToTissue(function, image, tissue_tiles, tileSize=256, halo=1,
+                  dtype=None):
+    """
+    Applies a per pixel or neighbourhood operation, e.g. background
+    subtraction and sharpenImage, only to the tissue regions of a
+    section. Every region is extended by halo pixels of its
+    neighbourhood, so a 3x3 filter like sharpenImage gives the same
+    values as on the whole section when the neighbouring tiles were
+    read (see readSparseSection). Empty tiles are left zero.
+
+    Parameters
+    ----------
+
+    function : callable
+        function(region) -> array of the region shape.
+
+    image : 2D numpy array
+        Section, empty tiles are not read.
+
+    tissue_tiles : 2D numpy array
+        Boolean mask from getTissueTiles.
+
+    tileSize : int
+        Defaults to 256, lateral tile size in pixels.
+
+    halo : int
+        Defaults to 1, pixels of context added around every region,
+        the radius of the filter applied by function.
+
+    dtype : None or numpy dtype
+        Defaults to None, dtype of the result, None uses the dtype
+        returned by function.
+
+    Returns
+    -------
+
+    processed : 2D numpy array
+        Section with processed tissue regions and zero empty tiles.
+
+    """
+
+    rows, cols = image.shape[:2]
+    processed = None
+
+    for r0, r1, c0, c1 in getTissueRegions(tissue_tiles, (rows, cols),
+                                           tileSize=tileSize):
+        h0, h1 = max(r0 - halo, 0), min(r1 + halo, rows)
+        w0, w1 = max(c0 - halo, 0), min(c1 + halo, cols)
+
+        result = function(image[h0:h1, w0:w1])
+        if processed is None:
+            processed = numpy.zeros((rows, cols),
+                                    dtype=dtype or result.dtype)
+
+        processed[r0:r1, c0:c1] = result[r0 - h0:r1 - h0, c0 - w0:c1 - w0]
+
+    if processed is None:
+        processed = numpy.zeros((rows, cols), dtype=dtype or image.dtype)
+
+    return processed
+
+
+def getTissueBoundingBox(tissue_tiles, shape, tileSize=256, pad=1):
+    """
+    Finds the tile aligned bounding box of the tissue in a section, so
+    that only that crop has to be read and colored at full resolution.
+
+    Parameters
+    ----------
+
+    tissue_tiles : 2D numpy array
+        Boolean mask from getTissueTiles.
+
+    shape : tuple
+        (X, Y) shape of the full resolution section.
+
+    tileSize : int
+        Defaults to 256, lateral tile size in pixels.
+
+    pad : int
+        Defaults to 1, number of tiles added on every side of the
+        tissue, keeps sharpening and CLAHE at tissue borders unchanged.
+
+    Returns
+    -------
+
+    bbox : None or tuple
+        (row_start, row_stop, col_start, col_stop) in full resolution
+        pixels, None if there is no tissue.
+
+    """
+
+    rows = numpy.where(tissue_tiles.any(axis=1))[0]
+    cols = numpy.where(tissue_tiles.any(axis=0))[0]
+
+    if rows.size == 0:
+        return None
+
+    r0 = max(int(rows[0]) - pad, 0)*tileSize
+    r1 = min((int(rows[-1]) + 1 + pad)*tileSize, shape[0])
+    c0 = max(int(cols[0]) - pad, 0)*tileSize
+    c1 = min((int(cols[-1]) + 1 + pad)*tileSize, shape[1])
+
+    if r0 >= r1 or c0 >= c1:
+        return None
+
+    return r0, r1, c0, c1
+
+
+def placeCrop(RGB_crop, bbox, shape, value=255, out=None):
+    """
+    Places a colored crop into a constant canvas of the full section
+    shape, white by default.
+
+    Parameters
+    ----------
+
+    RGB_crop : 3D numpy array
+        Colored crop [X, Y, C].
+
+    bbox : tuple
+        (row_start, row_stop, col_start, col_stop) of the crop from
+        getTissueBoundingBox.
+
+    shape : tuple
+        (X, Y) shape of the full section.
+
+    value : int
+        Defaults to 255, fill value outside of the crop.
+
+    out : None or array like
+        Defaults to None, writable uint8 [X, Y, 3] destination.
+
+    Returns
+    -------
+
+    RGB_image : 3D numpy array
+        Full section [X, Y, C]. This is out when provided.
+
+    """
+
+    shape = tuple(shape[:2]) + (RGB_crop.shape[2],)
+    r0, r1, c0, c1 = bbox
+
+    if isinstance(out, numpy.ndarray):
+        checkOutput(out, shape)
+        RGB_image = out
+        RGB_image[:] = value
+    else:
+        RGB_image = numpy.full(shape, value, dtype=numpy.uint8)
+
+    RGB_image[r0:r1, c0:c1] = RGB_crop
+
+    if out is not None and RGB_image is not out:
+        return writeOutput(RGB_image, out)
+
+    return RGB_image
+
+
+def sparseFalseColor(nuclei, cyto, tissue_tiles, tileSize=256, out=None,
+                     color_function=None, **kwargs):
+    """
+    Colors only the tissue regions of a section, empty tiles are set to
+    white without being processed. Every run of adjacent tissue tiles in
+    a tile row (see getTissueRegions) is colored with one call of
+    color_function. nuclei and cyto are only sliced per region, so they
+    can be h5py datasets or memmaps. Fixed normfactors or flat fields
+    should be given, a None normfactor is calculated separately for
+    every region.
+
+    Parameters
+    ----------
+
+    nuclei : 2D array
+        Nuclear channel image.
+
+    cyto : 2D array
+        Cytoplasm channel image.
+
+    tissue_tiles : 2D numpy array
+        Boolean mask from getTissueTiles.
+
+    tileSize : int
+        Defaults to 256, lateral tile size in pixels.
+
+    out : None or array like
+        Defaults to None, writable uint8 [X, Y, 3] destination.
+
+    color_function : None or callable
+        Defaults to None, which uses falseColor. Called as
+        color_function(nuclei_region, cyto_region, out=RGB_region,
+        **kwargs), e.g. rapidFalseColor.
+
+    **kwargs
+        Keyword arguments for color_function. An offset keyword, as
+        used by rapidFalseColor to locate flat fields, is shifted to the
+        origin of every region, and tileSize is passed on when
+        color_function takes it.
+
+    Returns
+    -------
+
+    RGB_image : 3D numpy array
+        Virtual H&E image [X, Y, C]. This is out when provided.
+
+    """
+
+    if color_function is None:
+        color_function = falseColor
+
+    if 'tileSize' in inspect.signature(color_function).parameters:
+        kwargs['tileSize'] = tileSize
+
+    shape = tuple(nuclei.shape[:2]) + (3,)
+
+    if isinstance(out, numpy.ndarray):
+        checkOutput(out, shape)
+        RGB_image = out
+        RGB_image[:] = 255
+    else:
+        RGB_image = numpy.full(shape, 255, dtype=numpy.uint8)
+
+    for r0, r1, c0, c1 in getTissueRegions(tissue_tiles, shape[:2],
+                                           tileSize=tileSize):
+        region_kwargs = dict(kwargs)
+        if 'offset' in kwargs:
+            region_kwargs['offset'] = (kwargs['offset'][0] + r0,
+                                       kwargs['offset'][1] + c0)
+
+        color_function(numpy.asarray(nuclei[r0:r1, c0:c1]),
+                       numpy.asarray(cyto[r0:r1, c0:c1]),
+                       out=RGB_image[r0:r1, c0:c1], **region_kwargs)
+
+    if out is not None and RGB_image is not out:
+        return writeOutput(RGB_image, out)
+
+    return RGB_image
+
+
 def getBackgroundLevels(image, threshold=50):
     """
     Calculate foreground and background values based on image
@@ -647,7 +2098,8 @@ def getFlatField(*args):
     print('depreciated use getIntensityMap instead')
 
 
-def getIntensityMap(image, tileSize=256, blockSize=16, bgThreshold=50):
+def getIntensityMap(image, tileSize=256, blockSize=16, bgThreshold=50,
+                    precision='float64'):
 
     """
     Returns downsampled 3D intensity leveling map of image data by
@@ -668,6 +2120,13 @@ def getIntensityMap(image, tileSize=256, blockSize=16, bgThreshold=50):
         default is 16. The final size of the downsampled map will be the
         tileSize divided by blockSize.
 
+    bgThreshold : int
+        default is 50, threshold for getBackgroundLevels.
+
+    precision : str
+        default is 'float64', dtype of the intensity map, either
+        'float32' or 'float64'.
+
     Returns
     -------
 
@@ -692,7 +2151,8 @@ def getIntensityMap(image, tileSize=256, blockSize=16, bgThreshold=50):
                           int(tileSize/blockSize))
 
     intensityMap = numpy.zeros((len(rows)-1, len(stacks)-1,
-                                len(cols)-1), dtype=float)
+                                len(cols)-1),
+                               dtype=getPrecisionType(precision))
 
     for i in range(1, len(rows)):
         for j in range(1, len(stacks)):
@@ -713,7 +2173,55 @@ def getIntensityMap(image, tileSize=256, blockSize=16, bgThreshold=50):
     return intensityMap
 
 
-def interpolateDS(image, k, tileSize=256, beta=1.0):
+def getFlatFieldPlanes(k, n_planes, tileSize=256):
+    """
+    Finds the two planes of a downsampled intensity map which bracket
+    full resolution section k, and the linear weight between them.
+    Used by interpolateDS and FlatFieldCache.
+
+    Parameters
+    ----------
+
+    k : int
+        Index for image location in full res data
+
+    n_planes : int
+        Number of planes along axis 1 of the intensity map.
+
+    tileSize : int
+        Default = 256, block size for interpolation
+
+    Returns
+    -------
+
+    x0 : int
+        Index of the lower bracketing plane.
+
+    x1 : int
+        Index of the upper bracketing plane, equal to x0 when no
+        blending is needed.
+
+    weight : float
+        Weight of plane x1, the section is x0 + weight*(x1 - x0).
+
+    """
+
+    x0 = int(numpy.floor(k/tileSize))
+    x1 = int(numpy.ceil(k/tileSize))
+
+    if k >= int(n_planes*tileSize-tileSize):
+        return n_planes - 1, n_planes - 1, 0.0
+
+    elif k < int(tileSize/2):
+        return 0, 0, 0.0
+
+    elif x0 == x1:
+        return x1, x1, 0.0
+
+    return x0, x1, k/tileSize - x0
+
+
+def interpolateDS(image, k, tileSize=256, beta=1.0, precision='float64'):
     """
     Method for resizing downsampled data to be the same size as full
     resolution data. Used for interpolating flat field images.
@@ -734,6 +2242,10 @@ def interpolateDS(image, k, tileSize=256, beta=1.0):
         Default = 1.0, multiplicative constant for final interpolated
         data.
 
+    precision : str
+        Default = 'float64', dtype of the interpolated data, either
+        'float32' or 'float64'.
+
     Returns
     -------
 
@@ -742,27 +2254,21 @@ def interpolateDS(image, k, tileSize=256, beta=1.0):
 
     """
 
-    x0 = numpy.floor(k/tileSize)
-    x1 = numpy.ceil(k/tileSize)
-    x = k/tileSize
+    x0, x1, weight = getFlatFieldPlanes(k, image.shape[1],
+                                        tileSize=tileSize)
 
     # find region in downsampled data
-    if k < int(image.shape[1]*tileSize-tileSize):
-        if k < int(tileSize/2):
-            C_img = image[:, 0, :]
-
-        elif x0 == x1:
-            C_img = image[:, int(x1), :]
-        else:
-            img_norm0 = image[:, int(x0), :]
-            img_norm1 = image[:, int(x1), :]
-
-            # average between two indicies
-            C_img = img_norm0 + (x-x0)*(img_norm1 - img_norm0)/(x1-x0)
+    if x0 == x1:
+        C_img = image[:, x0, :]
     else:
-        C_img = image[:, image.shape[1]-1, :]
+        img_norm0 = image[:, x0, :]
+        img_norm1 = image[:, x1, :]
+
+        # average between two indicies
+        C_img = img_norm0 + weight*(img_norm1 - img_norm0)
 
     # interpolate flat fields
+    C_img = numpy.asarray(C_img, dtype=getPrecisionType(precision))
     C_final = beta*nd.interpolation.zoom(C_img, tileSize, order=1,
                                          mode='nearest')
 
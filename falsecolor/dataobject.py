@@ -28,11 +28,39 @@ Rob Serafin
 """
 
 import os
+import time
 from skimage.io import imread
 import numpy
 from pathos.multiprocessing import ProcessingPool
-import h5py as hp
 from functools import partial
+from falsecolor.memory import planProcessImages, formatMemory
+from falsecolor.readers import H5Reader
+from falsecolor.cache import getFileIdentity, getCachedIntensityMap, \
+    getCachedBackgroundLevels
+
+
+def timedCall(func, index, *args):
+    """
+    Runs func(*args) in a pool worker and returns the result with its
+    index, the worker process id and the start and stop times. Used by
+    DataObject.scheduleImages.
+    """
+
+    start = time.time()
+    result = func(*args)
+
+    return index, result, os.getpid(), start, time.time()
+
+
+def timedChunk(func, start, *channels):
+    """
+    Runs timedCall on a chunk of consecutive images in a pool worker,
+    start is the index of the first image. Used by
+    DataObject.scheduleImages.
+    """
+
+    return [timedCall(func, start + i, *args)
+            for i, args in enumerate(zip(*channels))]
 
 
 class DataObject(object):
@@ -105,7 +133,8 @@ class DataObject(object):
         ----------
 
         folder : str or pathlike
-            Folder to grab image data from
+            Folder with exactly one HDF5 file, or the HDF5 file to grab
+            image data from
 
         dataID : int
             Resolution of data to grab from HDF5 file. Defaults to zero.
@@ -130,22 +159,14 @@ class DataObject(object):
             Second channel image data from HDF5 file
         """
 
-        data_name = [os.path.join(folder, f) for f in os.listdir(folder)
-                     if f.endswith('h5')]
-
         if start_index == stop_index:
-
-            with hp.File(data_name[0], 'r') as f:
-                nuclei = f['t00000'][channelIDs[0]][str(dataID)]['cells'][:]
-                cyto = f['t00000'][channelIDs[1]][str(dataID)]['cells'][:]
-            f.close()
-
+            index = slice(None)
         else:
+            index = slice(start_index, stop_index)
 
-            with hp.File(data_name[0], 'r') as f:
-                nuclei = f['t00000'][channelIDs[0]][str(dataID)]['cells'][start_index:stop_index]
-                cyto = f['t00000'][channelIDs[1]][str(dataID)]['cells'][start_index:stop_index]
-            f.close()
+        with H5Reader(folder) as reader:
+            nuclei = reader.getVolume(channelIDs[0], dataID)[index]
+            cyto = reader.getVolume(channelIDs[1], dataID)[index]
 
         return nuclei, cyto
 
@@ -196,6 +217,62 @@ class DataObject(object):
 
         self.imageSet = numpy.asarray(dataset)
 
+    def getIntensityMaps(self, folder=None, dataID=4,
+                         channelIDs=['s00', 's01'],
+                         tileSize=256, blockSize=16, bgThreshold=50,
+                         precision='float64', cache=None):
+        """
+        Intensity maps and background levels of every channel of an
+        HDF5 dataset, loaded from the persistent cache when they were
+        computed before.
+
+        Parameters
+        ----------
+
+        folder : str or pathlike
+            HDF5 file or folder with one HDF5 file, defaults to None.
+            If None DataObject will use self.directory.
+
+        dataID : int
+            Downsampled resolution level, defaults to 4.
+
+        channelIDs : list
+            keys for data entry for HDF5
+
+        tileSize, blockSize, bgThreshold, precision
+            See getIntensityMap.
+
+        cache : None or ResultCache
+            Defaults to None, which uses the default cache folder.
+
+        Returns
+        -------
+
+        flat_fields : list
+            (intensityMap, background) per channel.
+
+        """
+
+        flat_fields = []
+        with H5Reader(folder or self.directory) as reader:
+            identity = getFileIdentity(reader.filename)
+
+            for channel in channelIDs:
+                volume = reader.getVolume(channel, dataID)
+                intensityMap = getCachedIntensityMap(
+                                    volume, identity, tileSize=tileSize,
+                                    blockSize=blockSize,
+                                    bgThreshold=bgThreshold,
+                                    precision=precision, cache=cache,
+                                    channel=channel, level=dataID)
+                background = getCachedBackgroundLevels(
+                                    volume, identity, threshold=bgThreshold,
+                                    cache=cache, channel=channel,
+                                    level=dataID)[1]
+                flat_fields.append((intensityMap, background))
+
+        return flat_fields
+
     def setupProcessing(self, ncpus):
         """
         Creates processing pool with specified ncpus for DataObject.
@@ -222,7 +299,129 @@ class DataObject(object):
         """
         self.pool = None
 
-    def processImages(self, runnable_dict, imageSet, dtype=None):
+    def scheduleImages(self, func, imageSet, target_chunk_time=0.1):
+        """
+        Processes images with dynamic dispatch from one queue, each idle
+        worker takes the next chunk of images so cheap (e.g. empty) and
+        expensive images balance out. Two chunks per worker are kept in
+        flight and every new chunk is sized from the running mean
+        latency of the finished images to take about target_chunk_time
+        seconds, but small enough that every worker gets at least four
+        of the remaining chunks. Chunks hold a single image until the
+        first latency is measured, there is no barrier between the
+        measurement and the rest of the images.
+
+        Parameters
+        ----------
+
+        func : callable
+            Method to run on every image.
+
+        imageSet : sequence
+            One sequence of images per argument of func.
+
+        target_chunk_time : float
+            Defaults to 0.1, seconds of work per chunk, amortizes the
+            dispatch overhead of fast methods.
+
+        Returns
+        -------
+
+        results : list
+            Results in the order of imageSet.
+
+        records : list
+            (index, pid, start, stop) of every image.
+
+        chunksize : int
+            Largest chunk size used.
+
+        """
+
+        n_images = len(imageSet[0]) if len(imageSet) else 0
+        if n_images == 0:
+            return [], [], 0
+
+        ncpus = self.pool.ncpus
+        results = [None]*n_images
+        records = []
+
+        in_flight = []
+        next_image = 0
+        busy = 0.0
+        max_chunksize = 1
+
+        while next_image < n_images or in_flight:
+
+            # keep two chunks per worker queued, sized from the running
+            # mean latency
+            while next_image < n_images and len(in_flight) < 2*ncpus:
+                chunksize = 1
+                if records:
+                    latency = max(busy/len(records), 1e-6)
+                    remaining = n_images - next_image
+                    chunksize = int(max(1, min(
+                                    target_chunk_time/latency,
+                                    numpy.ceil(remaining/(4*ncpus)))))
+                max_chunksize = max(max_chunksize, chunksize)
+
+                stop = min(next_image + chunksize, n_images)
+                in_flight.append(self.pool.apipe(
+                            timedChunk, func, next_image,
+                            *[channel[next_image:stop]
+                              for channel in imageSet]))
+                next_image = stop
+
+            # collect every finished chunk, wait on the oldest otherwise
+            finished = [item for item in in_flight if item.ready()]
+            if not finished:
+                in_flight[0].wait(0.01)
+                continue
+
+            for item in finished:
+                in_flight.remove(item)
+                for index, result, pid, t0, t1 in item.get():
+                    results[index] = result
+                    records.append((index, pid, t0, t1))
+                    busy += t1 - t0
+
+        return results, records, max_chunksize
+
+    def getScheduleStats(self, records, wall_time, chunksize):
+        """
+        Summarizes worker utilization from scheduleImages records.
+
+        Returns
+        -------
+
+        stats : dict
+            'wall_time', 'chunksize', 'mean_latency', 'efficiency' (total
+            busy time / (wall_time*ncpus)) and per worker process id the
+            number of 'images', 'busy' seconds and 'utilization'.
+
+        """
+
+        wall_time = max(wall_time, 1e-9)
+
+        workers = {}
+        for index, pid, t0, t1 in records:
+            worker = workers.setdefault(pid, {'images': 0, 'busy': 0.0})
+            worker['images'] += 1
+            worker['busy'] += t1 - t0
+
+        for worker in workers.values():
+            worker['utilization'] = worker['busy']/wall_time
+
+        busy = sum(worker['busy'] for worker in workers.values())
+
+        return {'wall_time': wall_time,
+                'chunksize': chunksize,
+                'mean_latency': busy/max(len(records), 1),
+                'efficiency': busy/(wall_time*self.pool.ncpus),
+                'workers': workers}
+
+    def processImages(self, runnable_dict, imageSet, dtype=None,
+                      max_memory=None, schedule='dynamic'):
         """
         Method to batch process multiple images simultaneously. Can
         process multiple channels or one at a time. Method acts on
@@ -246,6 +445,17 @@ class DataObject(object):
             Defaults to None type, if not none data will be returned
             as specified type.
 
+        max_memory : None, int or str
+            Defaults to None, host memory budget such as '8G'. If given,
+            the pool size and the number of images sent to the pool at
+            once are chosen to fit, see planProcessImages.
+
+        schedule : str
+            Defaults to 'dynamic', 'dynamic' dispatches chunks to idle
+            workers with a chunk size from the measured latency and
+            stores utilization in self.schedule_stats, see
+            scheduleImages. 'static' uses pool.map.
+
         Returns
         -------
 
@@ -254,22 +464,65 @@ class DataObject(object):
             runnable_dict's method.
 
         """
+        batch_size = None
+        if max_memory is not None:
+            image = numpy.asarray(imageSet[0][0])
+            plan = planProcessImages(max_memory, image.shape,
+                                     len(imageSet[0]),
+                                     n_channels=len(imageSet),
+                                     input_dtype=image.dtype)
+            print('memory plan:', plan['ncpus'], 'cpus,',
+                  plan['batch_size'], 'images per batch, estimated peak',
+                  formatMemory(plan['estimate']))
+
+            batch_size = plan['batch_size']
+            self.setupProcessing(ncpus=plan['ncpus'])
+
         if self.pool is None:
             self.setupProcessing(ncpus=4)
 
-        
-
         processed_images = []
 
         if type(runnable_dict['kwargs']) == dict:
-            func = partial(runnable_dict['runnable'], 
+            func = partial(runnable_dict['runnable'],
                            **runnable_dict['kwargs'])
 
         else:
             func = runnable_dict['runnable']
-            
-            
-        processed_images.append(self.pool.map(func, *imageSet))
+
+        if schedule not in ['dynamic', 'static']:
+            raise ValueError("schedule must be 'dynamic' or 'static', "
+                             "got %r" % schedule)
+
+        if batch_size is None:
+            batch_size = len(imageSet[0])
+
+        # bound the images in flight in the pool
+        results = []
+        records = []
+        chunksize = 0
+        t_start = time.time()
+
+        for start in range(0, len(imageSet[0]), max(batch_size, 1)):
+            batch = [channel[start:start + batch_size]
+                     for channel in imageSet]
+
+            if schedule == 'static':
+                results.extend(self.pool.map(func, *batch))
+
+            else:
+                batch_results, batch_records, chunksize = \
+                    self.scheduleImages(func, batch)
+                results.extend(batch_results)
+                records.extend((index + start, pid, t0, t1)
+                               for index, pid, t0, t1 in batch_records)
+
+        if schedule == 'dynamic':
+            self.schedule_stats = self.getScheduleStats(
+                                    records, time.time() - t_start,
+                                    chunksize)
+
+        processed_images.append(results)
 
         if dtype is None:
             return numpy.asarray(processed_images)[0]
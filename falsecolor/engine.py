@@ -0,0 +1,436 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+"""
+
+import math
+import numpy
+from numba import cuda
+import falsecolor.coloring as fc
+
+
+class FalseColorEngine(object):
+    def __init__(self, shape,
+                 nuc_settings=None,
+                 cyto_settings=None,
+                 color_key='HE',
+                 nuc_normfactor=None,
+                 cyto_normfactor=None,
+                 run_FlatField_nuc=False,
+                 run_FlatField_cyto=False,
+                 nuc_threshold=50,
+                 cyto_threshold=50,
+                 nuc_background=None,
+                 cyto_background=None,
+                 use_gpu=True,
+                 TPB=(32, 32),
+                 tileSize=256,
+                 precision='float64'):
+        """
+        Reusable false coloring object for many sections of the same
+        shape. Buffers, block grids and constants are set up once so
+        coloring successive sections does not allocate new arrays.
+
+        With use_gpu=True sections are colored as in rapidFalseColor,
+        otherwise as in falseColor.
+
+        Attributes
+        ----------
+
+        shape : tuple
+            (X, Y) shape of every section to be colored.
+
+        nuc_settings : None or list
+            RGB constants for nuclear channel, if None they are taken
+            from getColorSettings(color_key).
+
+        cyto_settings : None or list
+            RGB constants for cytoplasm channel, if None they are taken
+            from getColorSettings(color_key).
+
+        color_key : str
+            Defaults to 'HE', key for getColorSettings.
+
+        nuc_normfactor : None, float or array
+            Nuclear normalization. If None the default of the matching
+            coloring method is used (8500 on GPU, 5000 on CPU). With
+            run_FlatField_nuc this is the full resolution flat field,
+            or a downsampled intensity map when sections are colored
+            with a section_index.
+
+        cyto_normfactor : None, float or array
+            Cytoplasm normalization, as nuc_normfactor (defaults 2000).
+
+        run_FlatField_nuc : bool
+            GPU only, defaults to False, apply flat field to nuclei.
+
+        run_FlatField_cyto : bool
+            GPU only, defaults to False, apply flat field to cyto.
+
+        nuc_threshold : int
+            Defaults to 50, background threshold for nuclear channel.
+
+        cyto_threshold : int
+            Defaults to 50, background threshold for cytoplasm channel.
+
+        nuc_background : None or float
+            GPU only, fixed nuclear background level. If None it is
+            calculated for every section with getBackgroundLevels.
+
+        cyto_background : None or float
+            GPU only, fixed cytoplasm background level.
+
+        use_gpu : bool
+            Defaults to True, color sections with the CUDA kernels.
+
+        TPB : tuple (int,int)
+            THREADS PER BLOCK for GPU kernels.
+
+        tileSize : int
+            Defaults to 256, block size of downsampled intensity maps.
+
+        precision : str
+            Defaults to 'float64', either 'float32' or 'float64'.
+
+        """
+
+        self.shape = tuple(shape[:2])
+        self.use_gpu = use_gpu
+        self.float_type = fc.getPrecisionType(precision)
+        self.tileSize = tileSize
+
+        if nuc_settings is None or cyto_settings is None:
+            color_settings = fc.getColorSettings(key=color_key)
+            if nuc_settings is None:
+                nuc_settings = color_settings['nuclei']
+            if cyto_settings is None:
+                cyto_settings = color_settings['cyto']
+
+        self.nuc_settings = list(nuc_settings)
+        self.cyto_settings = list(cyto_settings)
+
+        self.nuc_threshold = nuc_threshold
+        self.cyto_threshold = cyto_threshold
+
+        # reused result, overwritten by every call without out
+        self.RGB_image = numpy.zeros(self.shape + (3,), dtype=numpy.uint8)
+
+        if use_gpu:
+            self.setupGPU(nuc_normfactor, cyto_normfactor,
+                          run_FlatField_nuc, run_FlatField_cyto,
+                          nuc_background, cyto_background, TPB)
+        else:
+            self.setupCPU(nuc_normfactor, cyto_normfactor)
+
+    def setupCPU(self, nuc_normfactor, cyto_normfactor):
+        """
+        Allocates host buffers and constants for falseColor style
+        coloring.
+
+        Parameters
+        ----------
+
+        nuc_normfactor : None or float
+
+        cyto_normfactor : None or float
+
+        """
+
+        if nuc_normfactor is None:
+            nuc_normfactor = 5000
+        if cyto_normfactor is None:
+            cyto_normfactor = 2000
+
+        # same constants as falseColor beta_dict
+        k_nuclei = 0.08
+        k_cyto = 0.0120
+
+        self.nuc_scale = self.float_type(65535/nuc_normfactor)
+        self.cyto_scale = self.float_type(65535/cyto_normfactor)
+
+        self.nuc_constants = [c*k_nuclei for c in self.nuc_settings]
+        self.cyto_constants = [c*k_cyto for c in self.cyto_settings]
+
+        self.nuclei = numpy.zeros(self.shape, dtype=self.float_type)
+        self.cyto = numpy.zeros(self.shape, dtype=self.float_type)
+        self.tmp_nuc = numpy.zeros(self.shape, dtype=self.float_type)
+        self.tmp_cyto = numpy.zeros(self.shape, dtype=self.float_type)
+
+    def setupGPU(self, nuc_normfactor, cyto_normfactor,
+                 run_FlatField_nuc, run_FlatField_cyto,
+                 nuc_background, cyto_background, TPB):
+        """
+        Allocates device buffers, block grid and constants for
+        rapidFalseColor style coloring.
+
+        Parameters
+        ----------
+
+        nuc_normfactor : None, float or array
+
+        cyto_normfactor : None, float or array
+
+        run_FlatField_nuc : bool
+
+        run_FlatField_cyto : bool
+
+        nuc_background : None or float
+
+        cyto_background : None or float
+
+        TPB : tuple (int,int)
+
+        """
+
+        if nuc_normfactor is None:
+            nuc_normfactor = 8500
+        if cyto_normfactor is None:
+            cyto_normfactor = 2000
+
+        self.TPB = TPB
+        self.blockspergrid = (int(math.ceil(self.shape[0]/TPB[0])),
+                              int(math.ceil(self.shape[1]/TPB[1])))
+
+        self.run_FlatField_nuc = run_FlatField_nuc
+        self.run_FlatField_cyto = run_FlatField_cyto
+        self.nuc_background = nuc_background
+        self.cyto_background = cyto_background
+
+        # multiplicative constants as in rapidFalseColor
+        self.k_nuclei = 1.0 if run_FlatField_nuc else 0.08
+        self.k_cyto = 1.0 if run_FlatField_cyto else 0.012
+
+        # flat fields are transferred once
+        self.nuc_norm_mem = None
+        self.cyto_norm_mem = None
+
+        if run_FlatField_nuc:
+            nuc_normfactor = numpy.ascontiguousarray(nuc_normfactor,
+                                                     dtype=self.float_type)
+            self.nuc_norm_mem = cuda.to_device(nuc_normfactor)
+        if run_FlatField_cyto:
+            cyto_normfactor = numpy.ascontiguousarray(cyto_normfactor,
+                                                      dtype=self.float_type)
+            self.cyto_norm_mem = cuda.to_device(cyto_normfactor)
+
+        self.nuc_normfactor = nuc_normfactor
+        self.cyto_normfactor = cyto_normfactor
+
+        # host staging and device buffers
+        self.nuclei = cuda.pinned_array(self.shape, dtype=self.float_type)
+        self.cyto = cuda.pinned_array(self.shape, dtype=self.float_type)
+        self.nuc_global_mem = cuda.device_array(self.shape,
+                                                dtype=self.float_type)
+        self.cyto_global_mem = cuda.device_array(self.shape,
+                                                 dtype=self.float_type)
+        self.pre_nuc_output = cuda.device_array(self.shape,
+                                                dtype=self.float_type)
+        self.pre_cyto_output = cuda.device_array(self.shape,
+                                                 dtype=self.float_type)
+        self.output_global = cuda.device_array((3,) + self.shape,
+                                               dtype=numpy.uint8)
+        self.output_host = cuda.pinned_array((3,) + self.shape,
+                                             dtype=numpy.uint8)
+
+    def colorCPU(self, nuclei, cyto, out):
+        """
+        Colors one section on the CPU into out, see falseColor.
+
+        Parameters
+        ----------
+
+        nuclei : 2D numpy array
+
+        cyto : 2D numpy array
+
+        out : 3D numpy array [X, Y, 3]
+
+        """
+
+        # background subtraction as in preProcess
+        for image, buffer, threshold, scale in [
+                (nuclei, self.nuclei, self.nuc_threshold, self.nuc_scale),
+                (cyto, self.cyto, self.cyto_threshold, self.cyto_scale)]:
+
+            numpy.copyto(buffer, image, casting='unsafe')
+            buffer -= threshold
+            numpy.maximum(buffer, 0, out=buffer)
+            numpy.power(buffer, 0.85, out=buffer)
+            buffer *= scale
+            buffer *= (255/65535)
+
+        # Beer's law exponential for each RGB channel
+        for i in range(3):
+            numpy.multiply(self.cyto, self.cyto_constants[i],
+                           out=self.tmp_cyto)
+            numpy.negative(self.tmp_cyto, out=self.tmp_cyto)
+            numpy.exp(self.tmp_cyto, out=self.tmp_cyto)
+
+            numpy.multiply(self.nuclei, self.nuc_constants[i],
+                           out=self.tmp_nuc)
+            numpy.negative(self.tmp_nuc, out=self.tmp_nuc)
+            numpy.exp(self.tmp_nuc, out=self.tmp_nuc)
+
+            numpy.multiply(self.tmp_cyto, self.tmp_nuc, out=self.tmp_nuc)
+            self.tmp_nuc *= 255
+
+            numpy.copyto(out[:, :, i], self.tmp_nuc, casting='unsafe')
+
+    def colorGPU(self, nuclei, cyto, out, section_index=None):
+        """
+        Colors one section on the GPU into out, see rapidFalseColor.
+
+        Parameters
+        ----------
+
+        nuclei : 2D numpy array
+
+        cyto : 2D numpy array
+
+        out : 3D numpy array [X, Y, 3]
+
+        section_index : None or int
+            Section index when flat fields are downsampled intensity
+            maps.
+
+        """
+
+        grid = self.blockspergrid
+        TPB = self.TPB
+
+        numpy.copyto(self.nuclei, nuclei, casting='unsafe')
+        numpy.copyto(self.cyto, cyto, casting='unsafe')
+        self.nuc_global_mem.copy_to_device(self.nuclei)
+        self.cyto_global_mem.copy_to_device(self.cyto)
+
+        for (run_FlatField, image, global_mem, pre_output, background,
+             threshold, normfactor, norm_mem) in [
+                (self.run_FlatField_nuc, self.nuclei, self.nuc_global_mem,
+                 self.pre_nuc_output, self.nuc_background,
+                 self.nuc_threshold, self.nuc_normfactor,
+                 self.nuc_norm_mem),
+                (self.run_FlatField_cyto, self.cyto, self.cyto_global_mem,
+                 self.pre_cyto_output, self.cyto_background,
+                 self.cyto_threshold, self.cyto_normfactor,
+                 self.cyto_norm_mem)]:
+
+            # use intensity leveling
+            if run_FlatField:
+                if section_index is not None:
+                    x0, x1, weight = fc.getFlatFieldPlanes(
+                                            section_index,
+                                            normfactor.shape[1],
+                                            tileSize=self.tileSize)
+                    scale_row, scale_col = fc.getIntensityMapScale(
+                                            normfactor,
+                                            tileSize=self.tileSize)
+                    fc.rapidFieldDivisionDS[grid, TPB](global_mem, norm_mem,
+                                                       x0, x1, weight,
+                                                       scale_row, scale_col,
+                                                       0, 0, pre_output)
+                else:
+                    fc.rapidFieldDivision[grid, TPB](global_mem, norm_mem,
+                                                     pre_output)
+
+            # otherwise use standard background subtraction
+            else:
+                if background is None:
+                    background = fc.getBackgroundLevels(
+                                            image, threshold=threshold)[1]
+
+                fc.rapidPreProcess[grid, TPB](global_mem, background,
+                                              normfactor, pre_output)
+
+        # iterate through output and assign values based on RGB settings
+        for i in range(3):
+            fc.rapidGetRGBframe[grid, TPB](self.pre_nuc_output,
+                                           self.pre_cyto_output,
+                                           self.output_global[i],
+                                           self.nuc_settings[i],
+                                           self.cyto_settings[i],
+                                           self.k_nuclei,
+                                           self.k_cyto)
+
+        self.output_global.copy_to_host(self.output_host)
+
+        # reorder to [X,Y,C]
+        numpy.copyto(out, numpy.moveaxis(self.output_host, 0, -1))
+
+    def color(self, nuclei, cyto, section_index=None, out=None):
+        """
+        False colors one section.
+
+        Parameters
+        ----------
+
+        nuclei : 2D numpy array
+            Nuclear channel image, must match the engine shape.
+
+        cyto : 2D numpy array
+            Cytoplasm channel image, must match the engine shape.
+
+        section_index : None or int
+            GPU only, index of the section when flat fields are
+            downsampled intensity maps.
+
+        out : None, array like or tuple
+            Defaults to None, uint8 [X, Y, 3] destination for the
+            result, e.g. a numpy.memmap slice, a whole h5py/zarr
+            dataset or a (dataset, index) tuple, see writeOutput. If
+            None the engine's RGB_image buffer is used, which
+            is overwritten by the next call.
+
+        Returns
+        -------
+
+        RGB_image : 3D numpy array
+            Combined false colored image in the standard RGB format
+            [X, Y, C].
+
+        """
+
+        if nuclei.shape[:2] != self.shape or cyto.shape[:2] != self.shape:
+            raise ValueError('section shape %s does not match engine '
+                             'shape %s' % (nuclei.shape, self.shape))
+
+        # non numpy destinations are written once from RGB_image
+        if out is None or not isinstance(out, numpy.ndarray):
+            destination = self.RGB_image
+        else:
+            fc.checkOutput(out, self.shape + (3,))
+            destination = out
+
+        if self.use_gpu:
+            self.colorGPU(nuclei, cyto, destination,
+                          section_index=section_index)
+        else:
+            self.colorCPU(nuclei, cyto, destination)
+
+        if out is not None and destination is not out:
+            return fc.writeOutput(destination, out)
+
+        return destination
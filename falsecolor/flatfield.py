@@ -0,0 +1,160 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+"""
+
+import threading
+import numpy
+import scipy.ndimage as nd
+from falsecolor.coloring import getFlatFieldPlanes, getPrecisionType
+
+
+class FlatFieldCache(object):
+    def __init__(self, intensityMap, tileSize=256, beta=1.0,
+                 precision='float64'):
+        """
+        Flat field provider for consecutive sections. Keeps the full
+        resolution versions of the two intensity map planes which
+        bracket the current section, so each new section is a single
+        linear blend and zooming only happens when k crosses into a new
+        pair of planes. Returns the same values as interpolateDS.
+        Safe to share between pipeline threads.
+
+        Attributes
+        ----------
+
+        intensityMap : 3D numpy array
+            Downsampled intensity map from getIntensityMap.
+
+        tileSize : int
+            Default = 256, block size for interpolation.
+
+        beta : float
+            Default = 1.0, multiplicative constant for the interpolated
+            data.
+
+        precision : str
+            Default = 'float64', dtype of the cached planes and returned
+            flat fields, either 'float32' or 'float64'.
+
+        """
+
+        self.intensityMap = numpy.asarray(intensityMap,
+                                          dtype=getPrecisionType(precision))
+        self.tileSize = tileSize
+        self.beta = beta
+
+        # zoomed planes keyed by plane index
+        self.planes = {}
+
+        # bracketing pair and their difference for blending
+        self.bracket = None
+        self.delta = None
+        self.lock = threading.Lock()
+
+    def getPlane(self, index):
+        """
+        Returns the zoomed full resolution version of one intensity map
+        plane, zooming it only if it is not already cached.
+
+        Parameters
+        ----------
+
+        index : int
+            Plane index along axis 1 of the intensity map.
+
+        Returns
+        -------
+
+        plane : 2D numpy array
+            Full resolution plane scaled by beta.
+
+        """
+
+        if index not in self.planes:
+            self.planes[index] = self.beta*nd.zoom(
+                                            self.intensityMap[:, index, :],
+                                            self.tileSize, order=1,
+                                            mode='nearest')
+
+        return self.planes[index]
+
+    def getSection(self, k, out=None):
+        """
+        Returns the full resolution flat field for section k.
+
+        Parameters
+        ----------
+
+        k : int
+            Index for image location in full res data.
+
+        out : None or 2D numpy array
+            Defaults to None, array to write the flat field into. If
+            None a new array is allocated.
+
+        Returns
+        -------
+
+        C_final : 2D numpy array
+            Rescaled downsampled data for section k.
+
+        """
+
+        x0, x1, weight = getFlatFieldPlanes(k, self.intensityMap.shape[1],
+                                            tileSize=self.tileSize)
+
+        with self.lock:
+
+            # rezoom only when k moves to a new pair of planes
+            if self.bracket != (x0, x1):
+                base = self.getPlane(x0)
+                if x1 != x0:
+                    self.delta = self.getPlane(x1) - base
+                else:
+                    self.delta = None
+
+                # drop planes which are no longer bracketing
+                for index in list(self.planes):
+                    if index not in (x0, x1):
+                        del self.planes[index]
+
+                self.bracket = (x0, x1)
+
+            base = self.planes[x0]
+
+            if out is None:
+                out = numpy.empty_like(base)
+
+            # blend in place
+            if self.delta is None:
+                numpy.copyto(out, base)
+            else:
+                numpy.multiply(self.delta, weight, out=out)
+                out += base
+
+        return out
@@ -0,0 +1,401 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+def hashParameters(params):
+    """
+    Returns a sha256 hex digest of a dict of run parameters, independent
+    of key order.
+    """
+
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def getFileChecksum(filename, block_size=2**20):
+    """
+    Returns the sha256 hex digest of a file.
+
+    Parameters
+    ----------
+
+    filename : str or pathlike
+
+    block_size : int
+        Defaults to 1 MB, bytes read at a time.
+
+    Returns
+    -------
+
+    checksum : str
+
+    """
+
+    checksum = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            checksum.update(block)
+
+    return checksum.hexdigest()
+
+
+def writeJSONAtomic(filename, data):
+    """
+    Writes data as JSON so that filename always holds either the old or
+    the new contents, even if the process dies while writing. The data
+    goes to a temporary file in the same directory which then replaces
+    filename.
+
+    Parameters
+    ----------
+
+    filename : str or pathlike
+
+    data : dict
+
+    """
+
+    tmp_filename = '%s.%d.%d.tmp' % (filename, os.getpid(),
+                                     threading.get_ident())
+
+    with open(tmp_filename, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_filename, filename)
+
+
+def getJournalFilename(filename):
+    """
+    Returns the journal file of a manifest.
+    """
+
+    return '%s.journal' % filename
+
+
+def readManifest(filename):
+    """
+    Reads a manifest and the sections recorded in its journal since it
+    was last saved.
+
+    Parameters
+    ----------
+
+    filename : str or pathlike
+        Manifest JSON file.
+
+    Returns
+    -------
+
+    data : None or dict
+        Manifest contents, None if the manifest does not exist.
+
+    """
+
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename) as f:
+        data = json.load(f)
+
+    journal = getJournalFilename(filename)
+    if os.path.exists(journal):
+        with open(journal) as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # line cut short by a crash
+                    continue
+
+                if item.get('params_hash') == data['params_hash']:
+                    data['sections'][item['k']] = item['entry']
+
+    return data
+
+
+class RunManifest(object):
+    def __init__(self, filename, params=None, reset=False,
+                 save_interval=60):
+        """
+        Records which sections of a run are finished, with the checksum
+        and size of every output file and the parameters of the run, so
+        an interrupted run can be restarted without redoing finished
+        sections. Finished sections are appended to a journal next to
+        the manifest, which is compacted into the manifest file by save
+        at most every save_interval seconds and by close, so recording
+        costs the same for every section of a long run. The manifest
+        file is replaced atomically on save and record is safe to call
+        from pipeline writer threads.
+
+        Attributes
+        ----------
+
+        filename : str or pathlike
+            Manifest JSON file, loaded if it exists.
+
+        params : None or dict
+            Defaults to None, parameters which determine the output of
+            the run. If an existing manifest was written with different
+            parameters a ValueError is raised, unless reset is True.
+
+        reset : bool
+            Defaults to False, discard the sections of an existing
+            manifest.
+
+        save_interval : float
+            Defaults to 60, minimum number of seconds between compacting
+            saves. Sections are journaled as they finish, so a crash
+            only loses the sections in flight.
+
+        """
+
+        self.filename = filename
+
+        # stored the way they are read back from JSON
+        self.params = json.loads(json.dumps(params or {}, default=str))
+        self.params_hash = hashParameters(self.params)
+        self.journal = getJournalFilename(filename)
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+
+        # keeps an older snapshot from replacing a newer one and journal
+        # appends from being lost while the journal is compacted
+        self.save_lock = threading.Lock()
+        self.last_save = time.time()
+
+        self.sections = {}
+        self.created = time.time()
+
+        data = None if reset else readManifest(filename)
+        if data is not None:
+            if data['params_hash'] != self.params_hash:
+                changed = sorted(key for key in set(data['params']) |
+                                 set(self.params)
+                                 if data['params'].get(key) !=
+                                 self.params.get(key))
+                raise ValueError('parameters of %s changed (%s), use reset '
+                                 'to start over'
+                                 % (filename, ', '.join(changed)))
+
+            self.sections = data['sections']
+            self.created = data['created']
+
+        # new manifests are written right away so their journal can be
+        # replayed, a reset drops the old sections and journal so a
+        # crash can not bring them back
+        if data is None:
+            self.save()
+
+    def toDict(self):
+        """
+        Returns the manifest contents as a JSON serializable dict.
+        """
+
+        with self.lock:
+            return {'params': self.params,
+                    'params_hash': self.params_hash,
+                    'created': self.created,
+                    'updated': time.time(),
+                    'sections': dict(self.sections)}
+
+    def save(self):
+        """
+        Writes the manifest, see writeJSONAtomic, and empties the
+        journal.
+        """
+
+        folder = os.path.dirname(os.path.abspath(self.filename))
+        os.makedirs(folder, exist_ok=True)
+
+        with self.save_lock:
+            writeJSONAtomic(self.filename, self.toDict())
+            open(self.journal, 'w').close()
+            self.last_save = time.time()
+
+    def close(self):
+        """
+        Compacts the journal into the manifest at the end of a run.
+        """
+
+        self.save()
+
+    def record(self, k, filename=None):
+        """
+        Marks section k as finished.
+
+        Parameters
+        ----------
+
+        k : int
+            Section index.
+
+        filename : None or str
+            Defaults to None, output file of the section, its checksum
+            and size are stored. None marks a section finished without
+            output, e.g. a section without tissue.
+
+        """
+
+        entry = {'file': None, 'time': time.time()}
+        if filename is not None:
+            entry.update({'file': os.path.abspath(filename),
+                          'sha256': getFileChecksum(filename),
+                          'bytes': os.path.getsize(filename)})
+
+        line = json.dumps({'k': str(k), 'entry': entry,
+                           'params_hash': self.params_hash})
+
+        with self.save_lock:
+            with open(self.journal, 'a') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+            with self.lock:
+                self.sections[str(k)] = entry
+
+            # one writer thread compacts, the others keep journaling
+            save = time.time() - self.last_save >= self.save_interval
+            if save:
+                self.last_save = time.time()
+
+        if save:
+            self.save()
+
+    def isComplete(self, k, verify=False):
+        """
+        Returns True if section k is recorded and its output file still
+        exists with the recorded size.
+
+        Parameters
+        ----------
+
+        k : int
+            Section index.
+
+        verify : bool
+            Defaults to False, also recompute the checksum of the
+            output file.
+
+        """
+
+        entry = self.sections.get(str(k))
+        if entry is None:
+            return False
+
+        if entry['file'] is None:
+            return True
+
+        if not os.path.exists(entry['file']) or \
+                os.path.getsize(entry['file']) != entry['bytes']:
+            return False
+
+        if verify:
+            return getFileChecksum(entry['file']) == entry['sha256']
+
+        return True
+
+    def getPending(self, indices, verify=False):
+        """
+        Returns the section indices which still have to be processed.
+
+        Parameters
+        ----------
+
+        indices : iterable
+            Section indices of the run.
+
+        verify : bool
+            Defaults to False, see isComplete.
+
+        Returns
+        -------
+
+        pending : list
+
+        """
+
+        return [k for k in indices if not self.isComplete(k, verify=verify)]
+
+
+def mergeManifests(filenames, output, reset=False):
+    """
+    Merges the manifests of several shards of a run into one manifest,
+    e.g. after every shard of a sharded run has finished.
+
+    Parameters
+    ----------
+
+    filenames : list
+        Manifest files to merge, missing files are ignored.
+
+    output : str or pathlike
+        Merged manifest file. Sections already recorded in it are kept.
+
+    reset : bool
+        Defaults to False, discard the sections already recorded in
+        output.
+
+    Returns
+    -------
+
+    manifest : RunManifest
+        The merged manifest.
+
+    """
+
+    data = [readManifest(filename) for filename in filenames]
+    data = [item for item in data if item is not None]
+
+    if not data:
+        raise ValueError('no manifests to merge')
+
+    for item in data[1:]:
+        if item['params_hash'] != data[0]['params_hash']:
+            raise ValueError('can not merge manifests of runs with '
+                             'different parameters')
+
+    manifest = RunManifest(output, params=data[0]['params'], reset=reset)
+    manifest.created = min([manifest.created] +
+                           [item['created'] for item in data])
+
+    for item in data:
+        manifest.sections.update(item['sections'])
+
+    manifest.save()
+
+    return manifest
@@ -0,0 +1,510 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+"""
+
+import os
+import sys
+import tracemalloc
+import numpy
+from falsecolor.coloring import getPrecisionType
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# binary units accepted by parseMemory
+MEMORY_UNITS = {'': 1, 'B': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30,
+                'T': 2**40}
+
+
+def parseMemory(value):
+    """
+    Converts a memory size to bytes.
+
+    Parameters
+    ----------
+
+    value : int, float or str
+        Size in bytes or a string with a binary unit, e.g. '512M',
+        '8G' or '1.5GB'.
+
+    Returns
+    -------
+
+    n_bytes : int
+
+    """
+
+    if isinstance(value, str):
+        text = value.strip().upper()
+        if text.endswith('IB'):
+            text = text[:-2]
+        elif text.endswith('B') and len(text) > 1 and text[-2].isalpha():
+            text = text[:-1]
+
+        unit = text[-1] if text and text[-1].isalpha() else ''
+        if unit not in MEMORY_UNITS:
+            raise ValueError('unknown memory unit in %r' % value)
+
+        return int(float(text[:len(text) - len(unit)])*MEMORY_UNITS[unit])
+
+    return int(value)
+
+
+def formatMemory(n_bytes):
+    """
+    Formats a number of bytes for printing, e.g. '1.50 GB'.
+    """
+
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n_bytes) < 1024:
+            return '%.2f %s' % (n_bytes, unit)
+        n_bytes /= 1024
+
+    return '%.2f TB' % n_bytes
+
+
+def getSectionWorkingSet(shape, n_channels=2, input_dtype=numpy.uint16,
+                         precision='float64'):
+    """
+    Estimates host memory per section for every SectionPipeline stage,
+    from the temporaries made by the preprocessing and coloring
+    functions in falsecolor.coloring.
+
+    Parameters
+    ----------
+
+    shape : tuple
+        (X, Y) shape of a section.
+
+    n_channels : int
+        Defaults to 2, number of channels per section.
+
+    input_dtype : numpy dtype
+        Defaults to numpy.uint16, dtype of the raw data.
+
+    precision : str
+        Defaults to 'float64', 'float32' or 'float64'.
+
+    Returns
+    -------
+
+    working_set : dict
+        For every stage ('read', 'preprocess', 'color', 'write') a
+        tuple (work, item) of bytes, where work is held by a busy worker
+        and item is the size of one result waiting in the next queue.
+
+    """
+
+    n_pixels = int(numpy.prod(shape))
+    raw = n_pixels*numpy.dtype(input_dtype).itemsize
+    single = n_pixels*numpy.dtype(getPrecisionType(precision)).itemsize
+    RGB = 3*n_pixels
+
+    return {
+        # one raw section per channel, queued one channel at a time
+        'read': (n_channels*raw, raw),
+
+        # raw input, float copy, clipped copy, two convolution results,
+        # squared sum temporaries and the sharpened result
+        'preprocess': (raw + 7*single, single),
+
+        # float channels, RGB frames copied from the GPU and reordered
+        'color': (n_channels*single + 2*RGB, RGB),
+
+        # RGB image and its encoded copy
+        'write': (2*RGB, 0),
+        }
+
+
+def estimatePipelineMemory(working_set, read_workers=1,
+                           preprocess_workers=2, color_workers=1,
+                           write_workers=1, queue_size=4, n_channels=2,
+                           fixed=0):
+    """
+    Estimates peak host memory of a SectionPipeline.
+
+    Parameters
+    ----------
+
+    working_set : dict
+        Result of getSectionWorkingSet.
+
+    read_workers, preprocess_workers, color_workers, write_workers : int
+        Number of threads per stage.
+
+    queue_size : int
+        Defaults to 4, bound of the queues between stages.
+
+    n_channels : int
+        Defaults to 2, number of channels per section.
+
+    fixed : int
+        Defaults to 0, bytes held for the whole run, e.g. intensity
+        maps and the downsampled data.
+
+    Returns
+    -------
+
+    estimate : int
+        Peak bytes.
+
+    """
+
+    workers = {'read': read_workers, 'preprocess': preprocess_workers,
+               'color': color_workers, 'write': write_workers}
+
+    estimate = fixed
+    for stage, (work, item) in working_set.items():
+        estimate += workers[stage]*work + queue_size*item
+
+    # sections waiting for their last channel to be preprocessed
+    estimate += (preprocess_workers + queue_size)*n_channels * \
+        working_set['preprocess'][1]
+
+    return estimate
+
+
+def planPipeline(max_memory, shape, n_channels=2,
+                 input_dtype=numpy.uint16,
+                 precision='float64',
+                 fixed=0,
+                 max_workers=None,
+                 max_queue=8):
+    """
+    Chooses SectionPipeline worker counts and queue depth which fit a
+    memory budget. Starts from one worker per stage and a queue of one,
+    then adds preprocessing workers, prefetch depth and writers while
+    the estimate stays within max_memory.
+
+    Parameters
+    ----------
+
+    max_memory : int or str
+        Host memory budget, see parseMemory.
+
+    shape : tuple
+        (X, Y) shape of a section.
+
+    n_channels : int
+        Defaults to 2, number of channels per section.
+
+    input_dtype : numpy dtype
+        Defaults to numpy.uint16, dtype of the raw data.
+
+    precision : str
+        Defaults to 'float64', 'float32' or 'float64'.
+
+    fixed : int
+        Defaults to 0, bytes held for the whole run.
+
+    max_workers : None or int
+        Defaults to None, upper bound for the threads of one stage. If
+        None the number of cpus is used.
+
+    max_queue : int
+        Defaults to 8, upper bound for queue_size.
+
+    Returns
+    -------
+
+    plan : dict
+        Keyword arguments for SectionPipeline ('read_workers',
+        'preprocess_workers', 'color_workers', 'write_workers',
+        'queue_size') and the peak 'estimate' in bytes.
+
+    """
+
+    max_memory = parseMemory(max_memory)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    working_set = getSectionWorkingSet(shape, n_channels=n_channels,
+                                       input_dtype=input_dtype,
+                                       precision=precision)
+
+    plan = {'read_workers': 1, 'preprocess_workers': 1, 'color_workers': 1,
+            'write_workers': 1, 'queue_size': 1}
+
+    def estimate(plan):
+        return estimatePipelineMemory(working_set, n_channels=n_channels,
+                                      fixed=fixed, **plan)
+
+    if estimate(plan) > max_memory:
+        raise ValueError('max_memory of %s is below the minimum of %s for '
+                         'sections of shape %s'
+                         % (formatMemory(max_memory),
+                            formatMemory(estimate(plan)), tuple(shape)))
+
+    # increments in order of benefit, each up to its limit
+    steps = [('preprocess_workers', min(n_channels, max_workers)),
+             ('queue_size', min(2, max_queue)),
+             ('write_workers', min(2, max_workers)),
+             ('queue_size', min(4, max_queue)),
+             ('read_workers', min(2, max_workers)),
+             ('preprocess_workers', min(2*n_channels, max_workers)),
+             ('queue_size', max_queue)]
+
+    for key, limit in steps:
+        while plan[key] < limit:
+            plan[key] += 1
+            if estimate(plan) > max_memory:
+                plan[key] -= 1
+                break
+
+    plan['estimate'] = estimate(plan)
+
+    return plan
+
+
+def planChunkPixels(max_memory, n_threads=1, precision='float64',
+                    min_pixels=2**10, max_pixels=2**24):
+    """
+    Chooses the chunk_pixels of falseColorStack for a memory budget.
+    Every pixel of a chunk needs about seven floats of temporaries.
+
+    Parameters
+    ----------
+
+    max_memory : int or str
+        Memory budget for the temporaries, see parseMemory.
+
+    n_threads : int
+        Defaults to 1, number of threads coloring chunks.
+
+    precision : str
+        Defaults to 'float64', 'float32' or 'float64'.
+
+    min_pixels, max_pixels : int
+        Bounds for the result.
+
+    Returns
+    -------
+
+    chunk_pixels : int
+        Power of two number of pixels per chunk.
+
+    """
+
+    itemsize = numpy.dtype(getPrecisionType(precision)).itemsize
+    n_pixels = parseMemory(max_memory)//(7*itemsize*max(n_threads, 1))
+    n_pixels = min(max(n_pixels, min_pixels), max_pixels)
+
+    return int(2**numpy.floor(numpy.log2(n_pixels)))
+
+
+def planProcessImages(max_memory, image_shape, n_images, n_channels=2,
+                      input_dtype=numpy.uint16,
+                      output_itemsize=8,
+                      ncpus=None):
+    """
+    Chooses the pool size and batch size of DataObject.processImages
+    for a memory budget. The results of every image are kept, so
+    max_memory has to hold them plus one batch in flight, where every
+    worker receives a pickled copy of its input and makes float
+    temporaries.
+
+    Parameters
+    ----------
+
+    max_memory : int or str
+        Host memory budget, see parseMemory.
+
+    image_shape : tuple
+        Shape of one image of one channel.
+
+    n_images : int
+        Number of images per channel.
+
+    n_channels : int
+        Defaults to 2, number of channel arguments per call.
+
+    input_dtype : numpy dtype
+        Defaults to numpy.uint16, dtype of the image data.
+
+    output_itemsize : int
+        Defaults to 8, bytes per pixel of one result.
+
+    ncpus : None or int
+        Defaults to None, upper bound for the pool size. If None the
+        number of cpus is used.
+
+    Returns
+    -------
+
+    plan : dict
+        'ncpus', 'batch_size' and the peak 'estimate' in bytes.
+
+    """
+
+    max_memory = parseMemory(max_memory)
+    if ncpus is None:
+        ncpus = os.cpu_count() or 1
+
+    n_pixels = int(numpy.prod(image_shape))
+    raw = n_channels*n_pixels*numpy.dtype(input_dtype).itemsize
+    result = n_pixels*output_itemsize
+
+    # results are collected and copied into one array at the end
+    fixed = 2*n_images*result
+
+    # pickled inputs, float temporaries and the pickled result
+    per_image = 2*raw + 4*n_channels*n_pixels*8 + 2*result
+
+    available = max_memory - fixed
+    if available < per_image:
+        raise ValueError('max_memory of %s is below the minimum of %s for '
+                         '%d images of shape %s'
+                         % (formatMemory(max_memory),
+                            formatMemory(fixed + per_image), n_images,
+                            tuple(image_shape)))
+
+    in_flight = int(min(available//per_image, n_images))
+    ncpus = max(1, min(ncpus, in_flight))
+
+    # whole multiples of the pool size keep every worker busy
+    batch_size = max(ncpus, (in_flight//ncpus)*ncpus)
+
+    return {'ncpus': ncpus, 'batch_size': batch_size,
+            'estimate': fixed + batch_size*per_image}
+
+
+def getPeakRSS():
+    """
+    Returns the peak resident set size of this process in bytes, or
+    None if it is not available on this platform.
+    """
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return peak
+    return peak*1024
+
+
+class MemoryMonitor(object):
+    def __init__(self, estimate=None, trace=True):
+        """
+        Measures peak memory of a run to compare against an estimate.
+        Allocations made by numpy are traced with tracemalloc, the peak
+        resident set size of the process is read at the end.
+
+        Attributes
+        ----------
+
+        estimate : None or int
+            Defaults to None, estimated peak bytes, e.g. from
+            planPipeline.
+
+        trace : bool
+            Defaults to True, trace allocations with tracemalloc. This
+            slows down allocation heavy python code.
+
+        """
+
+        self.estimate = estimate
+        self.trace = trace
+        self.started_tracing = False
+        self.result = None
+
+    def start(self):
+        """
+        Starts measuring.
+        """
+
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+        # reset_peak needs python 3.9
+        if tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+        return self
+
+    def stop(self):
+        """
+        Stops measuring.
+
+        Returns
+        -------
+
+        result : dict
+            'estimate', 'traced_peak' and 'rss_peak' in bytes, None for
+            values which were not measured.
+
+        """
+
+        traced_peak = None
+        if tracemalloc.is_tracing():
+            traced_peak = tracemalloc.get_traced_memory()[1]
+
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+        self.result = {'estimate': self.estimate,
+                       'traced_peak': traced_peak,
+                       'rss_peak': getPeakRSS()}
+
+        return self.result
+
+    def report(self):
+        """
+        Returns the measured peaks against the estimate as a string.
+        """
+
+        if self.result is None:
+            self.stop()
+
+        lines = []
+        for key, name in [('estimate', 'estimated peak'),
+                          ('traced_peak', 'traced peak'),
+                          ('rss_peak', 'process peak RSS')]:
+            if self.result[key] is not None:
+                lines.append('%s: %s' % (name,
+                                         formatMemory(self.result[key])))
+
+        if self.result['estimate'] and self.result['traced_peak']:
+            lines.append('traced/estimate: %.2f'
+                         % (self.result['traced_peak'] /
+                            self.result['estimate']))
+
+        return '\n'.join(lines)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,628 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+"""
+
+import queue
+import threading
+from collections import Counter
+import numpy
+import scipy.ndimage as nd
+import falsecolor.coloring as fc
+from falsecolor.profiling import Profiler
+
+
+# marks the end of a stage's input
+STOP = object()
+
+
+class SectionPipeline(object):
+    def __init__(self, read, color,
+                 preprocess=None,
+                 write=None,
+                 read_workers=1,
+                 preprocess_workers=2,
+                 color_workers=1,
+                 write_workers=1,
+                 queue_size=4,
+                 profiler=None,
+                 store=None):
+        """
+        Streaming section processing pipeline. Reading, per channel
+        preprocessing, coloring and writing run concurrently in worker
+        threads connected by bounded queues, so section throughput is
+        set by the slowest stage instead of the sum of all stages.
+        numpy, OpenCV, h5py and the GPU kernels release the GIL for the
+        heavy work, so threads overlap I/O and compute.
+
+        Attributes
+        ----------
+
+        read : callable
+            read(k) -> sequence of channel images for section k, or None
+            to skip the section (e.g. no tissue). Skipped sections are
+            not preprocessed, colored or written and yield (k, None).
+
+        color : callable
+            color(channels, k) -> RGB image for section k.
+
+        preprocess : None or sequence of callables
+            Defaults to None, one callable per channel,
+            preprocess[j](image, k) -> preprocessed image. Channels are
+            preprocessed in parallel. None entries pass the channel
+            through unchanged.
+
+        write : None or callable
+            Defaults to None, write(k, RGB_image) -> result. If None the
+            RGB image itself is the result of the section.
+
+        read_workers : int
+            Defaults to 1, number of prefetching read threads.
+
+        preprocess_workers : int
+            Defaults to 2, number of threads preprocessing channels.
+
+        color_workers : int
+            Defaults to 1, number of coloring threads.
+
+        write_workers : int
+            Defaults to 1, number of encoding/writing threads.
+
+        queue_size : int
+            Defaults to 4, maximum number of items waiting between two
+            stages, bounds memory use.
+
+        profiler : None or Profiler
+            Defaults to None, records a span per stage and item, the
+            depth of every queue and the bytes read.
+
+        store : None or PreprocessedStore
+            Defaults to None, sections found in the store are loaded
+            instead of read and go straight to coloring, other sections
+            are saved to it once preprocessed.
+
+        """
+
+        self.read = read
+        self.color = color
+        self.preprocess = preprocess
+        self.write = write
+
+        self.read_workers = read_workers
+        self.preprocess_workers = preprocess_workers
+        self.color_workers = color_workers
+        self.write_workers = write_workers
+        self.queue_size = queue_size
+
+        if profiler is None:
+            profiler = Profiler(enabled=False)
+        self.profiler = profiler
+        self.store = store
+
+        self.threads = []
+        self.error = None
+        self.stopped = threading.Event()
+
+    def putItem(self, out_queue, item):
+        """
+        Puts an item on a bounded queue, giving up if the pipeline is
+        stopped so workers never block forever.
+
+        Parameters
+        ----------
+
+        out_queue : queue.Queue
+
+        item : object
+
+        Returns
+        -------
+
+        success : bool
+            False if the pipeline was stopped before the item was put.
+        """
+
+        while not self.stopped.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def getItem(self, in_queue):
+        """
+        Gets an item from a queue, returns STOP if the pipeline is
+        stopped.
+
+        Parameters
+        ----------
+
+        in_queue : queue.Queue
+
+        Returns
+        -------
+
+        item : object
+        """
+
+        while not self.stopped.is_set():
+            try:
+                return in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return STOP
+
+    def startStage(self, name, function, n_workers, in_queue, out_queue,
+                   n_next):
+        """
+        Starts the worker threads of one stage. Each worker applies
+        function to items from in_queue and puts every item it returns
+        on out_queue. When the last worker finishes, n_next STOP markers
+        are sent downstream.
+
+        Parameters
+        ----------
+
+        name : str
+            Stage name, used for thread names.
+
+        function : callable
+            function(item) -> list of downstream items.
+
+        n_workers : int
+            Number of threads for the stage.
+
+        in_queue : queue.Queue
+
+        out_queue : queue.Queue
+
+        n_next : int
+            Number of workers in the next stage.
+
+        """
+
+        alive = [n_workers]
+        lock = threading.Lock()
+
+        def worker():
+            try:
+                while True:
+                    item = self.getItem(in_queue)
+                    if item is STOP:
+                        break
+
+                    with self.profiler.span(name):
+                        results = function(item)
+
+                    for result in results:
+                        if not self.putItem(out_queue, result):
+                            return
+                        self.profiler.gauge('queue.' + name,
+                                            out_queue.qsize())
+
+            except BaseException as error:
+                self.error = error
+                self.stopped.set()
+
+            finally:
+                with lock:
+                    alive[0] -= 1
+                    last = alive[0] == 0
+
+                if last:
+                    for i in range(n_next):
+                        self.putItem(out_queue, STOP)
+
+        for i in range(n_workers):
+            thread = threading.Thread(target=worker, daemon=True,
+                                      name='%s-%d' % (name, i))
+            self.threads.append(thread)
+            thread.start()
+
+    def readStage(self, k):
+        """
+        Reads section k and fans its channels out to preprocessing.
+        """
+
+        # preprocessed sections skip preprocessing
+        if self.store is not None:
+            channels = self.store.load(k)
+            if channels is not None:
+                self.profiler.count('sections_from_store')
+                if self.preprocess is None:
+                    return [(k, channels)]
+                return [(k, None, channels)]
+
+        channels = self.read(k)
+
+        # skipped sections pass through the remaining stages
+        if channels is None:
+            self.profiler.count('sections_skipped')
+            if self.preprocess is None:
+                return [(k, None)]
+            return [(k, None, None)]
+
+        channels = list(channels)
+        self.profiler.count('bytes_read',
+                            sum(getattr(image, 'nbytes', 0)
+                                for image in channels))
+
+        if self.preprocess is None:
+            return [(k, channels)]
+
+        with self.lock:
+            self.pending[k] = [None]*len(channels)
+            self.remaining[k] = len(channels)
+
+        return [(k, j, image) for j, image in enumerate(channels)]
+
+    def preprocessStage(self, item):
+        """
+        Preprocesses one channel of one section, returns the section
+        once all of its channels are done.
+        """
+
+        k, j, image = item
+
+        # skipped or stored sections
+        if j is None:
+            return [(k, image)]
+
+        if self.preprocess[j] is not None:
+            image = self.preprocess[j](image, k)
+
+        with self.lock:
+            self.pending[k][j] = image
+            self.remaining[k] -= 1
+            if self.remaining[k] > 0:
+                return []
+
+            channels = self.pending.pop(k)
+            del self.remaining[k]
+
+        if self.store is not None:
+            with self.profiler.span('store', k=k):
+                self.store.save(k, channels)
+
+        return [(k, channels)]
+
+    def colorStage(self, item):
+        """
+        Colors one preprocessed section.
+        """
+
+        k, channels = item
+
+        if channels is None:
+            return [(k, None)]
+
+        return [(k, self.color(channels, k))]
+
+    def writeStage(self, item):
+        """
+        Writes one colored section.
+        """
+
+        k, RGB_image = item
+
+        if self.write is None or RGB_image is None:
+            return [(k, RGB_image)]
+
+        return [(k, self.write(k, RGB_image))]
+
+    def run(self, indices, ordered=True):
+        """
+        Processes sections and yields their results as they complete.
+
+        Parameters
+        ----------
+
+        indices : iterable
+            Section indices to process, each at most once.
+
+        ordered : bool
+            Defaults to True, yield results in the order of indices.
+            Otherwise results are yielded as soon as they are written.
+
+        Returns
+        -------
+
+        results : generator
+            Yields (k, result) for every section, where result is the
+            return value of write, or the RGB image if write is None.
+
+        """
+
+        indices = list(indices)
+
+        # sections are tracked by their index between stages
+        if len(set(indices)) != len(indices):
+            duplicates = sorted(k for k, count in Counter(indices).items()
+                                if count > 1)
+            raise ValueError('duplicate section indices %s' % duplicates)
+
+        self.threads = []
+        self.error = None
+        self.stopped.clear()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.remaining = {}
+
+        index_queue = queue.Queue(maxsize=self.queue_size)
+        read_queue = queue.Queue(maxsize=self.queue_size)
+        color_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+        result_queue = queue.Queue(maxsize=self.queue_size)
+
+        # without preprocessing the read stage feeds coloring directly
+        if self.preprocess is None:
+            self.startStage('read', self.readStage, self.read_workers,
+                            index_queue, color_queue, self.color_workers)
+        else:
+            self.startStage('read', self.readStage, self.read_workers,
+                            index_queue, read_queue,
+                            self.preprocess_workers)
+            self.startStage('preprocess', self.preprocessStage,
+                            self.preprocess_workers, read_queue,
+                            color_queue, self.color_workers)
+
+        self.startStage('color', self.colorStage, self.color_workers,
+                        color_queue, write_queue, self.write_workers)
+        self.startStage('write', self.writeStage, self.write_workers,
+                        write_queue, result_queue, 1)
+
+        def feed():
+            for k in indices:
+                if not self.putItem(index_queue, k):
+                    return
+            for i in range(self.read_workers):
+                self.putItem(index_queue, STOP)
+
+        feeder = threading.Thread(target=feed, daemon=True, name='feed')
+        self.threads.append(feeder)
+        feeder.start()
+
+        order = {k: i for i, k in enumerate(indices)}
+        finished = {}
+        next_position = 0
+
+        try:
+            while True:
+                item = self.getItem(result_queue)
+
+                if item is STOP:
+                    break
+
+                if not ordered:
+                    yield item
+                    continue
+
+                # reorder buffer, bounded by the items in flight
+                finished[order[item[0]]] = item
+                while next_position in finished:
+                    yield finished.pop(next_position)
+                    next_position += 1
+
+            if self.error is not None:
+                raise self.error
+
+        finally:
+            self.stopped.set()
+            for thread in self.threads:
+                thread.join()
+
+
+def readSparseSection(read_region, shape, tissue_tiles, tileSize=256,
+                      dtype=numpy.uint16, halo=1):
+    """
+    Reads only the tiles of a section which contain tissue, plus a halo
+    of neighbouring tiles so that sharpening at tissue borders sees real
+    data. Runs of adjacent tiles in a tile row are read in one call,
+    everything else is left as zeros.
+
+    Parameters
+    ----------
+
+    read_region : callable
+        read_region(row_start, row_stop, col_start, col_stop) -> 2D
+        array, e.g. a slice of an h5py dataset.
+
+    shape : tuple
+        (X, Y) shape of the full section.
+
+    tissue_tiles : 2D numpy array
+        Boolean tile mask from getTissueTiles, True where there is
+        tissue.
+
+    tileSize : int
+        Defaults to 256, lateral tile size in pixels.
+
+    dtype : numpy dtype
+        Defaults to numpy.uint16, dtype of the returned section.
+
+    halo : int
+        Defaults to 1, number of neighbouring tiles to read around each
+        tissue tile.
+
+    Returns
+    -------
+
+    section : 2D numpy array
+        Section with tissue tiles read and empty tiles zero.
+
+    """
+
+    section = numpy.zeros(shape, dtype=dtype)
+
+    if halo > 0:
+        tissue_tiles = nd.binary_dilation(tissue_tiles, iterations=halo)
+
+    for r0, r1, c0, c1 in fc.getTissueRegions(tissue_tiles, shape,
+                                              tileSize=tileSize):
+        section[r0:r1, c0:c1] = read_region(r0, r1, c0, c1)
+
+    return section
+
+
+def planSectionTiles(lowres_channels, indices, shape, tileSize=256,
+                     thresholds=50, scale=16, section_scale=16):
+    """
+    Plans the full resolution tissue tiles of a set of sections from a
+    coarse pyramid level, before any full resolution data is read. Each
+    section is covered by the union of the tissue in its two bracketing
+    coarse planes, in every channel.
+
+    Parameters
+    ----------
+
+    lowres_channels : sequence of 3D arrays
+        Coarse level (X, Z, Y) of every channel, e.g. the
+        '/t00000/s00/4/cells' datasets of a BigDataViewer file.
+
+    indices : iterable
+        Full resolution section indices along axis 1.
+
+    shape : tuple
+        (X, Y) shape of the full resolution sections.
+
+    tileSize : int
+        Defaults to 256, lateral tile size in full resolution pixels.
+
+    thresholds : float or sequence of floats
+        Defaults to 50, tissue threshold of every channel, see
+        getTissueTiles.
+
+    scale : int
+        Defaults to 16, lateral downsampling factor of the coarse level.
+
+    section_scale : int
+        Defaults to 16, downsampling factor of the coarse level along
+        axis 1.
+
+    Returns
+    -------
+
+    tissue_tiles : dict
+        Maps every section index to a boolean tile mask on the tile
+        grid of the full resolution section, True where there is tissue.
+
+    """
+
+    n_planes = lowres_channels[0].shape[1]
+    if numpy.isscalar(thresholds):
+        thresholds = [thresholds]*len(lowres_channels)
+
+    grid = (int(numpy.ceil(shape[0]/tileSize)),
+            int(numpy.ceil(shape[1]/tileSize)))
+
+    # tissue tiles of each coarse plane, computed once
+    plane_tiles = {}
+
+    def getPlaneTiles(index):
+        if index not in plane_tiles:
+            tissue_tiles = numpy.zeros(grid, dtype=bool)
+            for lowres, threshold in zip(lowres_channels, thresholds):
+                tiles = fc.getTissueTiles(lowres[:, index, :],
+                                          tileSize=tileSize,
+                                          threshold=threshold, scale=scale)
+
+                # match the tile grid of the section
+                rows = min(grid[0], tiles.shape[0])
+                cols = min(grid[1], tiles.shape[1])
+                tissue_tiles[:rows, :cols] |= tiles[:rows, :cols]
+            plane_tiles[index] = tissue_tiles
+
+        return plane_tiles[index]
+
+    section_tiles = {}
+    for k in indices:
+        x0 = min(int(k//section_scale), n_planes - 1)
+        x1 = min(x0 + 1, n_planes - 1)
+        section_tiles[k] = getPlaneTiles(x0) | getPlaneTiles(x1)
+
+    return section_tiles
+
+
+def planSectionCrops(lowres_channels, indices, shape, tileSize=256,
+                     thresholds=50, scale=16, section_scale=16, pad=1):
+    """
+    Plans full resolution tissue crops for a set of sections from a
+    coarse pyramid level, before any full resolution data is read. Each
+    section is covered by the union of the tissue in its two bracketing
+    coarse planes, in every channel.
+
+    Parameters
+    ----------
+
+    lowres_channels : sequence of 3D arrays
+        Coarse level (X, Z, Y) of every channel, e.g. the
+        '/t00000/s00/4/cells' datasets of a BigDataViewer file.
+
+    indices : iterable
+        Full resolution section indices along axis 1.
+
+    shape : tuple
+        (X, Y) shape of the full resolution sections.
+
+    tileSize : int
+        Defaults to 256, lateral tile size in full resolution pixels.
+
+    thresholds : float or sequence of floats
+        Defaults to 50, tissue threshold of every channel, see
+        getTissueTiles.
+
+    scale : int
+        Defaults to 16, lateral downsampling factor of the coarse level.
+
+    section_scale : int
+        Defaults to 16, downsampling factor of the coarse level along
+        axis 1.
+
+    pad : int
+        Defaults to 1, number of tiles added around the tissue.
+
+    Returns
+    -------
+
+    crops : dict
+        Maps every section index to its (row_start, row_stop,
+        col_start, col_stop) crop, or None for sections without tissue.
+
+    """
+
+    section_tiles = planSectionTiles(lowres_channels, indices, shape,
+                                     tileSize=tileSize,
+                                     thresholds=thresholds, scale=scale,
+                                     section_scale=section_scale)
+
+    crops = {}
+    for k, tissue_tiles in section_tiles.items():
+        crops[k] = fc.getTissueBoundingBox(tissue_tiles, shape,
+                                           tileSize=tileSize, pad=pad)
+
+    return crops
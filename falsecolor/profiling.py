@@ -0,0 +1,314 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+"""
+
+import os
+import json
+import time
+import threading
+
+
+class Span(object):
+    def __init__(self, profiler, name, args):
+        """
+        Times one named block of code, created by Profiler.span.
+        """
+
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, time.perf_counter(),
+                             self.args)
+
+
+class NullSpan(object):
+    """
+    Span of a disabled Profiler, does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Profiler(object):
+    def __init__(self, enabled=True):
+        """
+        Collects named timing spans, counters and gauges from any
+        thread of a run, e.g. the stages of a SectionPipeline. Results
+        are available as a summary, a JSON file or a Chrome trace that
+        can be opened in chrome://tracing or Perfetto.
+
+        Attributes
+        ----------
+
+        enabled : bool
+            Defaults to True, if False spans, counters and gauges are
+            not recorded, so a disabled profiler can always be passed.
+
+        """
+
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Removes everything recorded so far and restarts the clock.
+        """
+
+        self.t0 = time.perf_counter()
+        self.spans = []
+        self.counters = {}
+        self.gauges = []
+
+    def span(self, name, **args):
+        """
+        Returns a context manager which records the time spent in its
+        block under name, for the calling thread.
+
+        Parameters
+        ----------
+
+        name : str
+            Span name, e.g. 'read' or 'sharpen'.
+
+        **args
+            Extra values stored with the span, e.g. k=section_index.
+
+        Returns
+        -------
+
+        span : context manager
+
+        """
+
+        if not self.enabled:
+            return NULL_SPAN
+
+        return Span(self, name, args)
+
+    def record(self, name, start, stop, args=None):
+        """
+        Records a span from perf_counter start and stop times.
+        """
+
+        if not self.enabled:
+            return
+
+        thread = threading.current_thread().name
+        with self.lock:
+            self.spans.append((name, start - self.t0, stop - start, thread,
+                               args or {}))
+
+    def count(self, name, value=1):
+        """
+        Adds value to the counter name, e.g. bytes read.
+        """
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """
+        Records the current value of name, e.g. a queue depth.
+        """
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.gauges.append((name, time.perf_counter() - self.t0,
+                                value))
+
+    def wrap(self, name, function):
+        """
+        Returns function wrapped in a span called name.
+        """
+
+        if not self.enabled or function is None:
+            return function
+
+        def wrapped(*args, **kwargs):
+            with self.span(name):
+                return function(*args, **kwargs)
+
+        return wrapped
+
+    def summary(self):
+        """
+        Summarizes everything recorded.
+
+        Returns
+        -------
+
+        summary : dict
+            'wall_time' in seconds, 'spans' with count, total, mean, min
+            and max seconds per span name, 'workers' with the same per
+            span name and thread, 'counters' and 'gauges' with count,
+            mean and max per gauge name.
+
+        """
+
+        with self.lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+            gauges = list(self.gauges)
+
+        def statistics(durations):
+            return {'count': len(durations),
+                    'total': sum(durations),
+                    'mean': sum(durations)/len(durations),
+                    'min': min(durations),
+                    'max': max(durations)}
+
+        by_name = {}
+        by_worker = {}
+        for name, start, duration, thread, args in spans:
+            by_name.setdefault(name, []).append(duration)
+            by_worker.setdefault(name, {}).setdefault(thread, []).append(
+                                                                duration)
+
+        by_gauge = {}
+        for name, t, value in gauges:
+            by_gauge.setdefault(name, []).append(value)
+
+        return {
+            'wall_time': time.perf_counter() - self.t0,
+            'spans': {name: statistics(durations)
+                      for name, durations in by_name.items()},
+            'workers': {name: {thread: statistics(durations)
+                               for thread, durations in threads.items()}
+                        for name, threads in by_worker.items()},
+            'counters': counters,
+            'gauges': {name: {'count': len(values),
+                              'mean': sum(values)/len(values),
+                              'max': max(values)}
+                       for name, values in by_gauge.items()},
+            }
+
+    def report(self):
+        """
+        Returns the summary as a table, slowest spans first.
+        """
+
+        summary = self.summary()
+        lines = ['wall time: %.3f s' % summary['wall_time'],
+                 '%-16s %8s %12s %12s %12s'
+                 % ('span', 'count', 'total (s)', 'mean (ms)', 'max (ms)')]
+
+        for name, stats in sorted(summary['spans'].items(),
+                                  key=lambda item: -item[1]['total']):
+            lines.append('%-16s %8d %12.3f %12.3f %12.3f'
+                         % (name, stats['count'], stats['total'],
+                            1000*stats['mean'], 1000*stats['max']))
+
+        for name, value in sorted(summary['counters'].items()):
+            lines.append('%s: %s' % (name, value))
+
+        for name, stats in sorted(summary['gauges'].items()):
+            lines.append('%s: mean %.2f, max %s'
+                         % (name, stats['mean'], stats['max']))
+
+        return '\n'.join(lines)
+
+    def saveJSON(self, filename):
+        """
+        Saves the summary as JSON.
+
+        Parameters
+        ----------
+
+        filename : str or pathlike
+
+        """
+
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def getChromeTrace(self):
+        """
+        Returns everything recorded in the Chrome trace event format,
+        spans as complete events and gauges as counter events, with
+        times in microseconds.
+        """
+
+        with self.lock:
+            spans = list(self.spans)
+            gauges = list(self.gauges)
+
+        pid = os.getpid()
+        thread_ids = {}
+        events = []
+
+        for name, start, duration, thread, args in spans:
+            if thread not in thread_ids:
+                thread_ids[thread] = len(thread_ids)
+                events.append({'name': 'thread_name', 'ph': 'M',
+                               'pid': pid, 'tid': thread_ids[thread],
+                               'args': {'name': thread}})
+
+            events.append({'name': name, 'ph': 'X', 'pid': pid,
+                           'tid': thread_ids[thread],
+                           'ts': 1e6*start, 'dur': 1e6*duration,
+                           'args': {key: str(value)
+                                    for key, value in args.items()}})
+
+        for name, t, value in gauges:
+            events.append({'name': name, 'ph': 'C', 'pid': pid,
+                           'ts': 1e6*t, 'args': {name: value}})
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def saveChromeTrace(self, filename):
+        """
+        Saves a Chrome trace, see getChromeTrace.
+
+        Parameters
+        ----------
+
+        filename : str or pathlike
+
+        """
+
+        with open(filename, 'w') as f:
+            json.dump(self.getChromeTrace(), f)
@@ -0,0 +1,515 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+Readers for multi channel, multi resolution volumes. BigDataViewer HDF5
+files, Zarr (including OME-Zarr) and N5 containers are exposed the same
+way: channels and resolution levels are numbered from 0 and every
+volume is indexed like the BigDataViewer datasets used by the scripts,
+e.g. volume[r0:r1, k, c0:c1] for part of section k.
+
+"""
+
+import os
+import re
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+import h5py as hp
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+def findH5File(folder):
+    """
+    Returns the HDF5 file of a folder.
+
+    Parameters
+    ----------
+
+    folder : str or pathlike
+
+    Returns
+    -------
+
+    filename : str
+
+    """
+
+    filenames = sorted(f for f in os.listdir(folder) if f.endswith('.h5'))
+
+    if not filenames:
+        raise ValueError('no .h5 file in %s' % folder)
+
+    if len(filenames) > 1:
+        raise ValueError('more than one .h5 file in %s (%s), pass the '
+                         'file name' % (folder, ', '.join(filenames)))
+
+    return os.path.join(folder, filenames[0])
+
+
+def getChunkSlices(start, stop, chunk):
+    """
+    Splits the range start:stop at multiples of chunk.
+    """
+
+    edges = list(range((start//chunk + 1)*chunk, stop, chunk))
+    return [slice(a, b) for a, b in zip([start] + edges, edges + [stop])]
+
+
+class ChunkedVolume(object):
+    def __init__(self, dataset, prefix=(), n_threads=1):
+        """
+        Read only 3D view of an HDF5, Zarr or N5 dataset. Reads which
+        cover more than one chunk of the dataset are split on the chunk
+        grid and the chunks are fetched concurrently.
+
+        Attributes
+        ----------
+
+        dataset : h5py or zarr array
+            Dataset with at least three dimensions.
+
+        prefix : tuple
+            Defaults to (), fixed indices of the leading dimensions of
+            dataset, e.g. (time, channel) of an OME-Zarr array.
+
+        n_threads : int
+            Defaults to 1, threads fetching chunks. Zarr and N5 chunks
+            are decompressed in parallel, h5py serializes calls into
+            the HDF5 library so HDF5 reads gain little.
+
+        """
+
+        self.dataset = dataset
+        self.prefix = tuple(prefix)
+        self.n_threads = n_threads
+
+        self.shape = tuple(dataset.shape[len(self.prefix):])
+        self.dtype = dataset.dtype
+        self.ndim = len(self.shape)
+
+        chunks = dataset.chunks
+        self.chunks = None if chunks is None else \
+            tuple(chunks[len(self.prefix):])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+
+        if Ellipsis in index:
+            i = index.index(Ellipsis)
+            fill = (slice(None),)*(self.ndim - len(index) + 1)
+            index = index[:i] + fill + index[i + 1:]
+        index = index + (slice(None),)*(self.ndim - len(index))
+
+        # integer indices are read as one element ranges and dropped
+        ranges = []
+        squeeze = []
+        for axis, item in enumerate(index):
+            if isinstance(item, (int, numpy.integer)):
+                n = self.shape[axis]
+                item = int(item)
+                if item >= n or item < -n:
+                    raise IndexError('index %d is out of bounds for axis %d '
+                                     'with size %d' % (item, axis, n))
+                if item < 0:
+                    item += n
+                ranges.append(slice(item, item + 1))
+                squeeze.append(axis)
+            elif isinstance(item, slice) and item.step in (None, 1):
+                start, stop, step = item.indices(self.shape[axis])
+                ranges.append(slice(start, max(start, stop)))
+            else:
+                # fancy indexing and strides go to the dataset directly
+                return self.dataset[self.prefix + index]
+
+        data = self.readRegion(ranges)
+
+        return data[tuple(0 if axis in squeeze else slice(None)
+                          for axis in range(self.ndim))]
+
+    def readRegion(self, ranges):
+        """
+        Reads a box of the volume, one thread per chunk.
+
+        Parameters
+        ----------
+
+        ranges : list of slices
+            Slice with step 1 for every dimension.
+
+        Returns
+        -------
+
+        data : numpy array
+
+        """
+
+        shape = tuple(r.stop - r.start for r in ranges)
+
+        if self.chunks is None or self.n_threads <= 1 or 0 in shape:
+            return numpy.asarray(self.dataset[self.prefix + tuple(ranges)])
+
+        pieces = list(itertools.product(*[getChunkSlices(r.start, r.stop, c)
+                                          for r, c in zip(ranges,
+                                                          self.chunks)]))
+        if len(pieces) == 1:
+            return numpy.asarray(self.dataset[self.prefix + tuple(ranges)])
+
+        data = numpy.empty(shape, dtype=self.dtype)
+
+        def readPiece(piece):
+            local = tuple(slice(p.start - r.start, p.stop - r.start)
+                          for p, r in zip(piece, ranges))
+            data[local] = self.dataset[self.prefix + piece]
+
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            # list raises the first exception of any piece
+            list(executor.map(readPiece, pieces))
+
+        return data
+
+
+class VolumeReader(object):
+    def __init__(self, n_threads=1):
+        """
+        Base class of the volume readers. Subclasses fill self.volumes,
+        a list per channel of the datasets of every resolution level,
+        each as a (dataset, prefix) pair, self.channels, the channel
+        names, and self.timepoints, the timepoints in the container.
+
+        Attributes
+        ----------
+
+        n_threads : int
+            Defaults to 1, threads fetching chunks, see ChunkedVolume.
+
+        """
+
+        self.n_threads = n_threads
+        self.channels = []
+        self.volumes = []
+        self.timepoints = [0]
+
+    @property
+    def n_levels(self):
+        return min(len(levels) for levels in self.volumes)
+
+    def getChannelIndex(self, channel):
+        """
+        Returns the index of a channel given by index or name.
+        """
+
+        if isinstance(channel, str):
+            if channel not in self.channels:
+                raise KeyError('unknown channel %s, available channels are '
+                               '%s' % (channel, ', '.join(self.channels)))
+            return self.channels.index(channel)
+
+        return channel
+
+    def getVolume(self, channel, level=0):
+        """
+        Returns one channel at one resolution level.
+
+        Parameters
+        ----------
+
+        channel : int or str
+            Channel index or name.
+
+        level : int
+            Defaults to 0, resolution level, 0 is full resolution.
+
+        Returns
+        -------
+
+        volume : ChunkedVolume
+
+        """
+
+        dataset, prefix = self.volumes[self.getChannelIndex(channel)][level]
+        return ChunkedVolume(dataset, prefix=prefix, n_threads=self.n_threads)
+
+    def getScale(self, level, channel=0):
+        """
+        Returns the downsampling factor of a level per dimension,
+        relative to full resolution.
+        """
+
+        full = self.getVolume(channel, 0).shape
+        shape = self.getVolume(channel, level).shape
+
+        return tuple(int(round(a/b)) for a, b in zip(full, shape))
+
+    def readSections(self, start_index, stop_index, channels=(0, 1),
+                     level=0, axis=1):
+        """
+        Reads a range of sections of several channels. The chunks of
+        all channels are fetched by the same number of threads per
+        channel, channels are read one after the other.
+
+        Parameters
+        ----------
+
+        start_index, stop_index : int
+            Sections to read.
+
+        channels : tuple
+            Defaults to (0, 1), channel indices or names.
+
+        level : int
+            Defaults to 0, resolution level.
+
+        axis : int
+            Defaults to 1, section axis of the volumes.
+
+        Returns
+        -------
+
+        data : list of 3D numpy arrays
+            One array per channel.
+
+        """
+
+        index = [slice(None)]*3
+        index[axis] = slice(start_index, stop_index)
+
+        return [self.getVolume(channel, level)[tuple(index)]
+                for channel in channels]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class H5Reader(VolumeReader):
+    def __init__(self, filename, timepoint='t00000', n_threads=1):
+        """
+        Reader for BigDataViewer HDF5 files, with the layout
+        <timepoint>/<channel>/<level>/cells.
+
+        Attributes
+        ----------
+
+        filename : str or pathlike
+            HDF5 file, or a folder with exactly one HDF5 file.
+
+        timepoint : str or int
+            Defaults to 't00000', group name or number of the
+            timepoint.
+
+        n_threads : int
+            Defaults to 1, see ChunkedVolume.
+
+        """
+
+        super().__init__(n_threads=n_threads)
+
+        if os.path.isdir(filename):
+            filename = findH5File(filename)
+
+        self.filename = filename
+        self.file = hp.File(filename, 'r')
+
+        self.timepoints = sorted(int(key[1:]) for key in self.file.keys()
+                                 if re.match(r't\d+$', key))
+
+        if not isinstance(timepoint, str):
+            timepoint = 't%05d' % timepoint
+        group = self.file[timepoint]
+        self.channels = sorted(group.keys())
+        self.volumes = [[(group[channel][level]['cells'], ())
+                         for level in sorted(group[channel].keys(), key=int)]
+                        for channel in self.channels]
+
+    def close(self):
+        self.file.close()
+
+
+class ZarrReader(VolumeReader):
+    def __init__(self, path, timepoint=0, n_threads=4):
+        """
+        Reader for Zarr and N5 containers. Supported layouts are
+        OME-Zarr multiscale images, with channels on the 'c' axis, the
+        BigDataViewer layout t00000/<channel>/<level>/cells and the
+        BigStitcher N5 layout setup<n>/timepoint<t>/s<level>.
+
+        Attributes
+        ----------
+
+        path : str or pathlike
+            Container, N5 if it ends with .n5.
+
+        timepoint : int
+            Defaults to 0.
+
+        n_threads : int
+            Defaults to 4, see ChunkedVolume.
+
+        """
+
+        if zarr is None:
+            raise ImportError('reading Zarr or N5 data requires zarr, '
+                              'install it with pip install zarr')
+
+        super().__init__(n_threads=n_threads)
+
+        self.path = path
+        if str(path).rstrip('/').endswith('.n5'):
+            if not hasattr(zarr, 'N5Store'):
+                raise ImportError('reading N5 requires zarr<3')
+            self.root = zarr.open_group(zarr.N5Store(path), mode='r')
+        else:
+            self.root = zarr.open_group(path, mode='r')
+
+        keys = list(self.root.group_keys())
+
+        if 'multiscales' in self.root.attrs:
+            self.setupOMEZarr(timepoint)
+
+        elif 't%05d' % timepoint in keys:
+            self.timepoints = sorted(int(key[1:]) for key in keys
+                                     if re.match(r't\d+$', key))
+            group = self.root['t%05d' % timepoint]
+            self.channels = sorted(group.group_keys())
+            self.volumes = [[(group[channel][level]['cells'], ())
+                             for level in sorted(group[channel].group_keys(),
+                                                 key=int)]
+                            for channel in self.channels]
+
+        elif any(re.match(r'setup\d+$', key) for key in keys):
+            self.channels = sorted((key for key in keys
+                                    if re.match(r'setup\d+$', key)),
+                                   key=lambda key: int(key[5:]))
+            self.timepoints = sorted(
+                        int(key[9:]) for key in
+                        self.root[self.channels[0]].group_keys()
+                        if re.match(r'timepoint\d+$', key))
+
+            self.volumes = []
+            for channel in self.channels:
+                group = self.root[channel]['timepoint%d' % timepoint]
+                levels = sorted(group.array_keys(),
+                                key=lambda key: int(key[1:]))
+                self.volumes.append([(group[level], ()) for level in levels])
+
+        else:
+            raise ValueError('unknown layout of %s' % path)
+
+    def setupOMEZarr(self, timepoint):
+        """
+        Finds channels and levels of an OME-Zarr multiscale image.
+        """
+
+        multiscale = self.root.attrs['multiscales'][0]
+        paths = [dataset['path'] for dataset in multiscale['datasets']]
+        datasets = [self.root[path] for path in paths]
+
+        axes = multiscale.get('axes')
+        if axes is None:
+            axes = 'tczyx'[-datasets[0].ndim:]
+        axes = [axis['name'] if isinstance(axis, dict) else axis
+                for axis in axes]
+
+        if 't' in axes:
+            self.timepoints = list(range(datasets[0].shape[axes.index('t')]))
+
+        n_channels = 1
+        if 'c' in axes:
+            n_channels = datasets[0].shape[axes.index('c')]
+
+        labels = [channel.get('label', str(c)) for c, channel in
+                  enumerate(self.root.attrs.get('omero', {})
+                            .get('channels', []))]
+        if len(labels) != n_channels:
+            labels = [str(c) for c in range(n_channels)]
+        self.channels = labels
+
+        # leading t and c axes are fixed, the spatial axes follow
+        leading = [axis for axis in axes if axis in ('t', 'c')]
+        if axes[:len(leading)] != leading:
+            raise ValueError('OME-Zarr axes %s are not supported' % axes)
+
+        self.volumes = []
+        for c in range(n_channels):
+            prefix = tuple(timepoint if axis == 't' else c
+                           for axis in leading)
+            self.volumes.append([(dataset, prefix) for dataset in datasets])
+
+
+def openVolume(path, n_threads=None, **kwargs):
+    """
+    Opens a volume with the reader matching its format.
+
+    Parameters
+    ----------
+
+    path : str or pathlike
+        HDF5 file or folder with one HDF5 file, Zarr or N5 container.
+
+    n_threads : None or int
+        Defaults to None, threads fetching chunks, None keeps the
+        default of the reader.
+
+    **kwargs
+        Passed to the reader.
+
+    Returns
+    -------
+
+    reader : VolumeReader
+
+    """
+
+    if n_threads is not None:
+        kwargs['n_threads'] = n_threads
+
+    name = str(path).rstrip('/')
+    is_container = os.path.isdir(path) and \
+        any(os.path.exists(os.path.join(path, f))
+            for f in ('.zgroup', 'zarr.json', 'attributes.json'))
+
+    if name.endswith(('.zarr', '.n5')) or is_container:
+        return ZarrReader(path, **kwargs)
+
+    return H5Reader(path, **kwargs)
@@ -30,7 +30,55 @@ import os
 from skimage import io
 
 
-def saveProcess(queue):
+def saveImage(path, folder, filename, data, profiler=None):
+    """
+    Saves one image, creating the storage directory if needed. Used by
+    saveProcess and by pipeline write stages.
+
+    Parameters
+    ----------
+
+    path : str or pathlike
+        top level storage directory for data
+
+    folder : str
+        specific dir to save data in
+
+    filename : str
+        "file.tif" filename for data
+
+    data : numpy array
+        image to save
+
+    profiler : None or Profiler
+        Defaults to None, records an 'encode' span and the bytes
+        written.
+
+    Returns
+    -------
+
+    file_savename : str
+        Full path of the saved file.
+    """
+
+    storage_dir = os.path.join(path, folder)
+
+    os.makedirs(storage_dir, exist_ok=True)
+
+    file_savename = os.path.join(storage_dir, filename)
+
+    if profiler is None:
+        io.imsave(file_savename, data, check_contrast=False)
+
+    else:
+        with profiler.span('encode', filename=filename):
+            io.imsave(file_savename, data, check_contrast=False)
+        profiler.count('bytes_written', os.path.getsize(file_savename))
+
+    return file_savename
+
+
+def saveProcess(queue, verbose=False):
     """
     Parameters
     ----------
@@ -58,6 +106,9 @@ def saveProcess(queue):
                 token : None or str
                     token will be a str when thread stop is called
 
+    verbose : bool
+        Defaults to False, print every saved file.
+
     Returns
     -------
     """
@@ -71,14 +122,9 @@ def saveProcess(queue):
         else:
             (path, folder, filename, data, token) = message
 
-            storage_dir = os.path.join(path, folder)
-
-            if not os.path.exists(storage_dir):
-                os.mkdir(storage_dir)
-
-            file_savename = os.path.join(storage_dir, filename)
-            print(storage_dir, filename)
+            file_savename = saveImage(path, folder, filename, data)
 
-            io.imsave(file_savename, data)
+            if verbose:
+                print(file_savename)
 
             message = None
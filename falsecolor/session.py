@@ -0,0 +1,306 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy
+from falsecolor.coloring import getPrecisionType, preProcess, \
+    getColorSettings
+
+
+# attenuation constants of falseColor
+BETA_NUCLEI = 0.08
+BETA_CYTO = 0.0120
+
+
+def getParameterKey(value):
+    """
+    Returns a hashable memoization key for a parameter, arrays are
+    keyed by their shape, dtype and contents.
+    """
+
+    if isinstance(value, numpy.ndarray):
+        digest = hashlib.sha1(numpy.ascontiguousarray(value)).hexdigest()
+        return ('array', value.shape, str(value.dtype), digest)
+
+    if isinstance(value, dict):
+        return tuple(sorted((key, getParameterKey(item))
+                            for key, item in value.items()))
+
+    if isinstance(value, (list, tuple)):
+        return tuple(getParameterKey(item) for item in value)
+
+    return value
+
+
+class RecoloringSession(object):
+    def __init__(self, nuclei, cyto, preview_scales=(8, 1),
+                 precision='float64', max_entries=8,
+                 nuc_threshold=50,
+                 cyto_threshold=50,
+                 nuc_normfactor=5000,
+                 cyto_normfactor=2000,
+                 color_key='HE',
+                 color_settings=None):
+        """
+        Interactive recoloring of one section, e.g. while tuning color
+        settings in a notebook. The stages of falseColor are memoized
+        by their parameters: changing color settings only reruns the
+        exponential stage, changing the threshold or normfactor of one
+        channel only preprocesses that channel again. Renders are
+        progressive, a downsampled preview first and then full
+        resolution.
+
+        Attributes
+        ----------
+
+        nuclei, cyto : 2D numpy arrays
+            Full resolution channel images.
+
+        preview_scales : tuple
+            Defaults to (8, 1), downsampling factors rendered in order
+            by render, 1 is full resolution.
+
+        precision : str
+            Defaults to 'float64', 'float32' or 'float64'.
+
+        max_entries : int
+            Defaults to 8, results kept per stage, least recently used
+            results are dropped first.
+
+        nuc_threshold, cyto_threshold, nuc_normfactor, cyto_normfactor,
+        color_key, color_settings
+            Initial parameters, see falseColor. Normfactors may be
+            arrays of the section shape, e.g. flat fields.
+
+        """
+
+        self.images = {'nuclei': nuclei, 'cyto': cyto}
+        self.preview_scales = tuple(preview_scales)
+        self.precision = precision
+        self.max_entries = max_entries
+
+        self.params = {'nuc_threshold': nuc_threshold,
+                       'cyto_threshold': cyto_threshold,
+                       'nuc_normfactor': nuc_normfactor,
+                       'cyto_normfactor': cyto_normfactor,
+                       'color_key': color_key,
+                       'color_settings': color_settings}
+
+        # memoized results per stage and number of times each stage ran
+        self.memo = {'input': OrderedDict(),
+                     'preprocess': OrderedDict(),
+                     'color': OrderedDict()}
+        self.stats = {stage: 0 for stage in self.memo}
+
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    def update(self, **params):
+        """
+        Changes parameters, see falseColor for their meaning.
+        """
+
+        for key in params:
+            if key not in self.params:
+                raise KeyError('unknown parameter %s' % key)
+
+        self.params.update(params)
+
+    def memoize(self, stage, key, function):
+        """
+        Returns the result of function for key from the memo of stage,
+        computing it if it is not stored.
+        """
+
+        memo = self.memo[stage]
+        with self.lock:
+            if key in memo:
+                memo.move_to_end(key)
+                return memo[key]
+
+        result = function()
+
+        with self.lock:
+            memo[key] = result
+            self.stats[stage] += 1
+            while len(memo) > self.max_entries:
+                memo.popitem(last=False)
+
+        return result
+
+    def getInput(self, channel, scale):
+        """
+        Returns a channel downsampled by scale as floats.
+        """
+
+        def downsample():
+            image = self.images[channel][::scale, ::scale]
+            return numpy.asarray(image, dtype=getPrecisionType(
+                                                        self.precision))
+
+        return self.memoize('input', (channel, scale), downsample)
+
+    def getPreprocessed(self, channel, scale, threshold, normfactor):
+        """
+        Returns a preprocessed channel at one scale, see preProcess.
+        """
+
+        key = (channel, scale, getParameterKey(threshold),
+               getParameterKey(normfactor))
+
+        def run():
+            image = self.getInput(channel, scale).copy()
+
+            # flat fields are downsampled like the channel
+            factor = normfactor
+            if isinstance(factor, numpy.ndarray) and factor.ndim == 2:
+                factor = factor[::scale, ::scale]
+
+            return preProcess(image, threshold=threshold, normfactor=factor,
+                              precision=self.precision)
+
+        return self.memoize('preprocess', key, run)
+
+    def renderScale(self, scale):
+        """
+        Renders the current parameters at one scale.
+
+        Parameters
+        ----------
+
+        scale : int
+            Downsampling factor, 1 is full resolution.
+
+        Returns
+        -------
+
+        RGB_image : numpy array
+            uint8 image [X, Y, 3], equal to falseColor of the
+            downsampled channels.
+
+        """
+
+        params = dict(self.params)
+        color_settings = params['color_settings']
+        if color_settings is None:
+            color_settings = getColorSettings(key=params['color_key'])
+
+        nuclei = self.getPreprocessed('nuclei', scale,
+                                      params['nuc_threshold'],
+                                      params['nuc_normfactor'])
+        cyto = self.getPreprocessed('cyto', scale,
+                                    params['cyto_threshold'],
+                                    params['cyto_normfactor'])
+
+        key = (scale, getParameterKey(params['nuc_threshold']),
+               getParameterKey(params['nuc_normfactor']),
+               getParameterKey(params['cyto_threshold']),
+               getParameterKey(params['cyto_normfactor']),
+               getParameterKey(color_settings))
+
+        def run():
+            # same operations as falseColor
+            float_type = getPrecisionType(self.precision)
+            RGB_image = numpy.zeros((3,) + nuclei.shape, dtype=float_type)
+            for i in range(3):
+                tmp_c = color_settings['cyto'][i]*BETA_CYTO*cyto
+                tmp_n = color_settings['nuclei'][i]*BETA_NUCLEI*nuclei
+                RGB_image[i] = 255*numpy.multiply(numpy.exp(-tmp_c),
+                                                  numpy.exp(-tmp_n))
+
+            return numpy.moveaxis(RGB_image, 0, -1).astype(numpy.uint8)
+
+        return self.memoize('color', key, run)
+
+    def render(self, **params):
+        """
+        Updates parameters and renders progressively, every scale of
+        preview_scales in order.
+
+        Parameters
+        ----------
+
+        **params
+            Parameters to change first, see update.
+
+        Yields
+        ------
+
+        scale, RGB_image
+            Downsampling factor and rendered image.
+
+        """
+
+        self.update(**params)
+        for scale in self.preview_scales:
+            yield scale, self.renderScale(scale)
+
+    def renderInBackground(self, callback, **params):
+        """
+        Renders progressively in a thread and calls callback(scale,
+        RGB_image) for every finished scale, e.g. to update a notebook
+        figure. A newer call supersedes older renders, which stop before
+        their next scale.
+
+        Parameters
+        ----------
+
+        callback : callable
+
+        **params
+            Parameters to change first, see update.
+
+        Returns
+        -------
+
+        thread : threading.Thread
+
+        """
+
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+        self.update(**params)
+
+        def run():
+            for scale in self.preview_scales:
+                if self.generation != generation:
+                    return
+                RGB_image = self.renderScale(scale)
+                if self.generation != generation:
+                    return
+                callback(scale, RGB_image)
+
+        thread = threading.Thread(target=run, daemon=True,
+                                  name='render-%d' % generation)
+        thread.start()
+
+        return thread
@@ -0,0 +1,172 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+"""
+
+import os
+import multiprocessing
+import numpy
+
+
+def getShardIndices(indices, shard_index, n_shards, mode='block'):
+    """
+    Returns the section indices of one shard of a run.
+
+    Parameters
+    ----------
+
+    indices : iterable
+        Section indices of the whole run.
+
+    shard_index : int
+        Shard to return, 0 <= shard_index < n_shards.
+
+    n_shards : int
+        Number of shards, e.g. processes or nodes.
+
+    mode : str
+        Defaults to 'block', 'block' gives every shard a contiguous
+        range of sections, which keeps HDF5 chunk reads local.
+        'interleave' gives every shard every n_shards-th section, which
+        balances the load when tissue area changes along the specimen.
+
+    Returns
+    -------
+
+    shard : list
+
+    """
+
+    if not 0 <= shard_index < n_shards:
+        raise ValueError('shard_index must be in [0, %d), got %d'
+                         % (n_shards, shard_index))
+
+    indices = list(indices)
+
+    if mode == 'interleave':
+        return indices[shard_index::n_shards]
+
+    elif mode == 'block':
+        bounds = numpy.linspace(0, len(indices), n_shards + 1).astype(int)
+        return indices[bounds[shard_index]:bounds[shard_index + 1]]
+
+    raise ValueError("mode must be 'block' or 'interleave', got %r" % mode)
+
+
+def getShardFilename(filename, shard_index, n_shards):
+    """
+    Returns the per shard version of a file name, e.g. manifest.json
+    becomes manifest.shard002of008.json.
+    """
+
+    root, ext = os.path.splitext(filename)
+    return '%s.shard%03dof%03d%s' % (root, shard_index, n_shards, ext)
+
+
+def savePrecomputed(filename, **arrays):
+    """
+    Saves arrays shared by all shards of a run, e.g. intensity maps and
+    background levels, so they are computed once. The file is written
+    under a temporary name and moved into place, so shards starting at
+    the same time never read a partial file.
+
+    Parameters
+    ----------
+
+    filename : str or pathlike
+        .npz file.
+
+    **arrays
+        Arrays or scalars to save.
+
+    """
+
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+
+    tmp_filename = '%s.%d.tmp.npz' % (filename, os.getpid())
+    numpy.savez(tmp_filename, **arrays)
+    os.replace(tmp_filename, filename)
+
+
+def loadPrecomputed(filename):
+    """
+    Loads arrays saved by savePrecomputed.
+
+    Returns
+    -------
+
+    arrays : None or dict
+        None if filename does not exist.
+
+    """
+
+    if not os.path.exists(filename):
+        return None
+
+    with numpy.load(filename) as data:
+        return {key: data[key] for key in data.files}
+
+
+def runShardProcesses(target, n_shards, args=()):
+    """
+    Runs every shard of a run in its own process. Processes are spawned
+    rather than forked, so no HDF5 file handle or GPU context of the
+    parent is inherited and every worker opens its own.
+
+    Parameters
+    ----------
+
+    target : callable
+        Picklable target(shard_index, n_shards, *args), e.g. a module
+        level function.
+
+    n_shards : int
+        Number of processes.
+
+    args : tuple
+        Defaults to (), extra arguments for target.
+
+    """
+
+    context = multiprocessing.get_context('spawn')
+
+    processes = [context.Process(target=target,
+                                 args=(shard_index, n_shards) + tuple(args),
+                                 name='shard-%d' % shard_index)
+                 for shard_index in range(n_shards)]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join()
+
+    failed = [shard_index for shard_index, process in enumerate(processes)
+              if process.exitcode != 0]
+
+    if failed:
+        raise RuntimeError('shards %s failed' % failed)
@@ -0,0 +1,149 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+"""
+
+import os
+import json
+import zipfile
+import threading
+import numpy
+from falsecolor.manifest import hashParameters, writeJSONAtomic
+
+
+class PreprocessedStore(object):
+    def __init__(self, folder, params=None, compress=True):
+        """
+        Compressed on disk store of preprocessed sections, so reruns
+        which only change coloring parameters (color settings,
+        normalization factors) skip reading, CLAHE, background
+        subtraction and sharpening. Every section is one chunk, a .npz
+        file with one array per channel written atomically, so shards
+        and pipeline threads can fill the store concurrently and an
+        interrupted run leaves no partial sections.
+
+        Sections are stored in a subfolder named by the hash of params,
+        so stores of different preprocessing parameters never mix.
+
+        Attributes
+        ----------
+
+        folder : str or pathlike
+            Store folder.
+
+        params : None or dict
+            Defaults to None, everything the preprocessed sections
+            depend on, e.g. the dataset, timepoint, background levels,
+            sharpening alpha and precision.
+
+        compress : bool
+            Defaults to True, deflate compress the sections.
+
+        """
+
+        self.params = json.loads(json.dumps(params or {}, default=str))
+        self.key = hashParameters(self.params)[:16]
+        self.folder = os.path.join(folder, self.key)
+        self.compress = compress
+
+        os.makedirs(self.folder, exist_ok=True)
+
+        params_file = os.path.join(self.folder, 'params.json')
+        if not os.path.exists(params_file):
+            writeJSONAtomic(params_file, self.params)
+
+    def getFilename(self, k):
+        """
+        Returns the file of section k.
+        """
+
+        return os.path.join(self.folder, '{:0>6d}.npz'.format(k))
+
+    def has(self, k):
+        """
+        Returns True if section k is stored.
+        """
+
+        return os.path.exists(self.getFilename(k))
+
+    def save(self, k, channels):
+        """
+        Stores the preprocessed channels of section k.
+
+        Parameters
+        ----------
+
+        k : int
+            Section index.
+
+        channels : sequence of numpy arrays
+            Preprocessed channel images.
+
+        """
+
+        filename = self.getFilename(k)
+        tmp_filename = '%s.%d.%d.tmp.npz' % (filename, os.getpid(),
+                                             threading.get_ident())
+
+        arrays = {'channel_%d' % j: numpy.asarray(image)
+                  for j, image in enumerate(channels)}
+
+        if self.compress:
+            numpy.savez_compressed(tmp_filename, **arrays)
+        else:
+            numpy.savez(tmp_filename, **arrays)
+
+        os.replace(tmp_filename, filename)
+
+    def load(self, k):
+        """
+        Returns the stored channels of section k as a list, or None if
+        the section is not stored.
+        """
+
+        try:
+            with numpy.load(self.getFilename(k)) as data:
+                return [data['channel_%d' % j]
+                        for j in range(len(data.files))]
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+
+    def getIndices(self):
+        """
+        Returns the sorted indices of all stored sections.
+        """
+
+        return sorted(int(name[:-4]) for name in os.listdir(self.folder)
+                      if name.endswith('.npz') and name[:-4].isdigit())
+
+    def getSize(self):
+        """
+        Returns the size of all stored sections in bytes.
+        """
+
+        return sum(os.path.getsize(self.getFilename(k))
+                   for k in self.getIndices())
@@ -0,0 +1,274 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+"""
+
+import itertools
+import numpy
+from falsecolor.coloring import getPrecisionType, getColorSettings
+from falsecolor.session import BETA_NUCLEI, BETA_CYTO, getParameterKey
+
+
+def getParameterGrid(**params):
+    """
+    Returns every combination of parameter values, e.g.
+    getParameterGrid(k_nuclei=[0.06, 0.08], cyto_normfactor=[1500, 2000])
+    gives four variants for sweepFalseColor.
+
+    Parameters
+    ----------
+
+    **params
+        Lists of values per parameter.
+
+    Returns
+    -------
+
+    variants : list of dict
+
+    """
+
+    keys = sorted(params)
+    return [dict(zip(keys, values))
+            for values in itertools.product(*[params[key] for key in keys])]
+
+
+def getSweepNormfactor(image, normfactor, threshold, float_type):
+    """
+    Returns normfactor, computed from the whole image like preProcess
+    if it is None.
+    """
+
+    if normfactor is not None:
+        return normfactor
+
+    image = image.astype(float_type) - threshold
+    image[image < 0] = 0
+    image = numpy.power(image, 0.85)
+
+    return numpy.mean(image[image > threshold])*8
+
+
+def sweepFalseColor(nuclei, cyto, variants,
+                    nuc_threshold=50,
+                    cyto_threshold=50,
+                    nuc_normfactor=5000,
+                    cyto_normfactor=2000,
+                    color_key='HE',
+                    precision='float64',
+                    chunk_pixels=2**16):
+    """
+    Renders one section with many color parameters at once. Both
+    channels are background subtracted once, and every distinct
+    exponential plane (RGB constant times attenuation constant times
+    normfactor, per channel and color) is evaluated once per chunk of
+    pixels and shared by all variants which use it, e.g. a grid of 5
+    nuclear by 5 cytoplasm settings evaluates 10 instead of 50 planes
+    per color. Every variant equals the falseColor result with the same
+    parameters.
+
+    Parameters
+    ----------
+
+    nuclei, cyto : 2D numpy arrays
+        Channel images.
+
+    variants : list of dict
+        Parameters per variant, any of 'nuc_settings' and
+        'cyto_settings' (RGB constants), 'color_settings', 'k_nuclei',
+        'k_cyto', 'nuc_normfactor' and 'cyto_normfactor'. Missing
+        values come from color_key, the falseColor attenuation
+        constants and the normfactors passed to sweepFalseColor.
+
+    nuc_threshold, cyto_threshold : float
+        Defaults to 50, background thresholds shared by all variants.
+
+    nuc_normfactor, cyto_normfactor : None, float or 2D array
+        Defaults to 5000 and 2000, normfactors of variants without their
+        own. None is computed from the image like preProcess, arrays of
+        the section shape are flat fields as in falseColor. Variant
+        normfactors take the same forms.
+
+    color_key : str
+        Defaults to 'HE', settings of variants without their own.
+
+    precision : str
+        Defaults to 'float64', 'float32' or 'float64'.
+
+    chunk_pixels : int
+        Defaults to 2**16, pixels evaluated at a time, bounds the
+        memory of the intermediate planes.
+
+    Returns
+    -------
+
+    RGB_images : numpy array
+        uint8 array [variant, X, Y, 3].
+
+    """
+
+    float_type = getPrecisionType(precision)
+    default_settings = getColorSettings(key=color_key)
+
+    # unique exponential coefficients per channel, (coefficient, normfactor
+    # key), flat fields are keyed by their contents
+    planes = {'nuclei': {}, 'cyto': {}}
+    normfactors = {}
+    computed = {}
+    index = numpy.zeros((2, len(variants), 3), dtype=int)
+
+    for v, variant in enumerate(variants):
+        settings = variant.get('color_settings', default_settings)
+
+        for c, (channel, k_default, norm_default) in enumerate(
+                [('nuclei', BETA_NUCLEI, nuc_normfactor),
+                 ('cyto', BETA_CYTO, cyto_normfactor)]):
+
+            prefix = 'nuc' if channel == 'nuclei' else 'cyto'
+            constants = variant.get(prefix + '_settings', settings[channel])
+            beta = variant.get('k_' + channel, k_default)
+            normfactor = variant.get(prefix + '_normfactor', norm_default)
+            if normfactor is None:
+                if c not in computed:
+                    computed[c] = getSweepNormfactor(
+                                    [nuclei, cyto][c], None,
+                                    [nuc_threshold, cyto_threshold][c],
+                                    float_type)
+                normfactor = computed[c]
+
+            norm_key = getParameterKey(normfactor)
+            if norm_key not in normfactors:
+                if numpy.ndim(normfactor) > 0:
+                    if numpy.shape(normfactor) != nuclei.shape:
+                        raise ValueError(
+                            'normfactor arrays must have the section shape '
+                            '%s, got %s' % (nuclei.shape,
+                                            numpy.shape(normfactor)))
+                    normfactor = numpy.asarray(normfactor).reshape(-1)
+                normfactors[norm_key] = normfactor
+
+            for i in range(3):
+                key = (constants[i]*beta, norm_key)
+                index[c, v, i] = planes[channel].setdefault(
+                                            key, len(planes[channel]))
+
+    nuc_planes = sorted(planes['nuclei'], key=planes['nuclei'].get)
+    cyto_planes = sorted(planes['cyto'], key=planes['cyto'].get)
+
+    shape = nuclei.shape
+    RGB_images = numpy.empty((len(variants),) + shape + (3,),
+                             dtype=numpy.uint8)
+    output = RGB_images.reshape(len(variants), -1, 3)
+
+    nuclei = nuclei.reshape(-1)
+    cyto = cyto.reshape(-1)
+
+    def preProcessChunk(image, threshold):
+        # same operations as preProcess
+        image = image.astype(float_type)
+        image -= threshold
+        image[image < 0] = 0
+        return numpy.power(image, 0.85)
+
+    def getExponentials(image, coefficients, start, stop):
+        scaled = {}
+        result = numpy.empty((len(coefficients), image.size),
+                             dtype=float_type)
+        for p, (coefficient, norm_key) in enumerate(coefficients):
+            if norm_key not in scaled:
+                normfactor = normfactors[norm_key]
+                if numpy.ndim(normfactor) > 0:
+                    normfactor = normfactor[start:stop]
+                scaled[norm_key] = image*float_type(65535/normfactor) * \
+                    (255/65535)
+            result[p] = numpy.exp(-(coefficient*scaled[norm_key]))
+        return result
+
+    for start in range(0, nuclei.size, chunk_pixels):
+        stop = min(start + chunk_pixels, nuclei.size)
+
+        exp_nuclei = getExponentials(
+                        preProcessChunk(nuclei[start:stop], nuc_threshold),
+                        nuc_planes, start, stop)
+        exp_cyto = getExponentials(
+                        preProcessChunk(cyto[start:stop], cyto_threshold),
+                        cyto_planes, start, stop)
+
+        # every variant and color at once, [variant, color, pixel]
+        RGB = exp_cyto[index[1]]
+        RGB *= exp_nuclei[index[0]]
+        RGB *= 255
+        numpy.copyto(output[:, start:stop, :], numpy.moveaxis(RGB, 1, 2),
+                     casting='unsafe')
+
+    return RGB_images
+
+
+def makeContactSheet(images, n_cols=None, pad=8, value=255):
+    """
+    Tiles images into one image, e.g. the variants of sweepFalseColor.
+
+    Parameters
+    ----------
+
+    images : numpy array
+        Images [n, X, Y, 3] of equal size.
+
+    n_cols : None or int
+        Defaults to None, images per row. None gives a square grid.
+
+    pad : int
+        Defaults to 8, pixels between images.
+
+    value : int
+        Defaults to 255, padding value.
+
+    Returns
+    -------
+
+    sheet : numpy array
+        Image with image i at row i//n_cols and column i % n_cols.
+
+    """
+
+    images = numpy.asarray(images)
+    n = len(images)
+    if n_cols is None:
+        n_cols = int(numpy.ceil(numpy.sqrt(n)))
+    n_rows = int(numpy.ceil(n/n_cols))
+
+    height, width = images.shape[1:3]
+    sheet = numpy.full((n_rows*height + (n_rows - 1)*pad,
+                        n_cols*width + (n_cols - 1)*pad) + images.shape[3:],
+                       value, dtype=images.dtype)
+
+    for i, image in enumerate(images):
+        r0 = (i//n_cols)*(height + pad)
+        c0 = (i % n_cols)*(width + pad)
+        sheet[r0:r0 + height, c0:c0 + width] = image
+
+    return sheet
@@ -28,14 +28,17 @@ Rob Serafin
 """
 
 import os
-import FalseColor.Color as fc
-from FalseColor.SaveThread import saveProcess
+import falsecolor.coloring as fc
+from falsecolor.flatfield import FlatFieldCache
+from falsecolor.pipeline import SectionPipeline
+from falsecolor.savethread import saveImage
+from falsecolor.profiling import Profiler
+from falsecolor.manifest import RunManifest
+from falsecolor.readers import openVolume
+from falsecolor.cache import ResultCache, getFileIdentity, getCachedIntensityMap, getCachedBackgroundLevels
+from falsecolor.store import PreprocessedStore
 import numpy 
-from scipy import ndimage
-import copy
 import argparse
-import multiprocessing as mp
-import h5py as h5
 import time
 
 def main():
@@ -64,9 +67,41 @@ def main():
     parser.add_argument("Cyto_Normfactor", type = float, nargs = '?', default = 3.72)
     parser.add_argument("alpha", type = float, nargs = '?', default = 0.5, help = 'imaris file')
 
+    #floating point precision for preprocessing and coloring
+    parser.add_argument("--precision", type = str, default = 'float64', choices = ['float32', 'float64'])
+
+    #pipeline workers per stage and queue depth between stages
+    parser.add_argument("--read_workers", type = int, default = 1)
+    parser.add_argument("--preprocess_workers", type = int, default = 2)
+    parser.add_argument("--write_workers", type = int, default = 2)
+    parser.add_argument("--queue_size", type = int, default = 4)
+
+    #threads fetching the chunks of every read, input can be BigDataViewer HDF5, Zarr/OME-Zarr or N5
+    parser.add_argument("--read_threads", type = int, default = 4)
+
+    #intensity maps and background levels are cached across runs (default ~/.cache/falsecolor)
+    parser.add_argument("--cache_dir", type = str, default = None)
+    parser.add_argument("--cache_size", type = str, default = '4G')
+
+    #save preprocessed sections to a compressed store, reruns with the same preprocessing only color
+    parser.add_argument("--preprocessed_store", type = str, default = None)
+
+    #save per stage timings to <profile>.json and a chrome trace to <profile>_trace.json
+    parser.add_argument("--profile", type = str, default = None)
+
+    #finished sections are recorded in a manifest (default <filepath>/<savefolder>/manifest.json) and skipped on restart
+    parser.add_argument("--manifest", type = str, default = None)
+    parser.add_argument("--restart", action = 'store_true')
+    parser.add_argument("--verify", action = 'store_true')
+
     #get arguments
     args = parser.parse_args()
 
+    #arguments which change the saved sections
+    run_params = {key : value for key, value in vars(args).items()
+                  if key not in ['start_k', 'stop_k', 'skip_k', 'read_workers', 'preprocess_workers', 'read_threads', 'cache_dir', 'cache_size', 'preprocessed_store',
+                                 'write_workers', 'queue_size', 'profile', 'manifest', 'restart', 'verify']}
+
     #get path info
     filename = args.filename
     filepath = args.filepath
@@ -75,12 +110,11 @@ def main():
     #load data
     datapath = os.path.join(filepath, filename)
 
-    f = h5.File(datapath,'r')
+    reader = openVolume(datapath, n_threads = args.read_threads)
 
     #downsampled data for flat fielding
-    ds_key = list(f['t00000/s00'].keys())
-    nuclei_ds = f['/t00000/s00/3/cells']
-    cyto_ds = f['/t00000/s01/3/cells']
+    nuclei_ds = reader.getVolume(0, 3)
+    cyto_ds = reader.getVolume(1, 3)
 
     #indices to pseudo color, if stop_k = 0 the entire dataset from start_k 
     #on will be processed, at intervals of skip_k
@@ -95,29 +129,45 @@ def main():
     nuc_norm_constant = args.Nuclei_Normfactor
     cyto_norm_constant = args.Cyto_Normfactor
 
+    #floating point type for preprocessing and coloring
+    precision = args.precision
+    float_type = fc.getPrecisionType(precision)
+
     if stop_k != 0:
         stop_k += start_k
 
     elif stop_k == 0:
         stop_k = nuclei_ds.shape[1]*16
 
+    #the downsampled depth rounds up, never run past the full resolution sections
+    stop_k = min(stop_k, reader.getVolume(0, 0).shape[1])
+
     print('Reading data from index:', start_k,'to ' ,stop_k, 'at stepsize = ', skip_k)
 
-    #calculate flat field
-    M_nuc,bkg_nuc = fc.getFlatField(nuclei_ds)
-    M_cyt,bkg_cyt = fc.getFlatField(cyto_ds)
+    #calculate flat field, or load it from the cache
+    cache = ResultCache(args.cache_dir, max_size = args.cache_size)
+    identity = getFileIdentity(datapath)
+
+    M_nuc = getCachedIntensityMap(nuclei_ds, identity, precision = precision, cache = cache, channel = 0, level = 3)
+    M_cyt = getCachedIntensityMap(cyto_ds, identity, precision = precision, cache = cache, channel = 1, level = 3)
 
-    dataQueue = mp.Queue()
-    save_thread = mp.Process(target = saveProcess,args = [dataQueue])
-    save_thread.start()
+    bkg_nuc = getCachedBackgroundLevels(nuclei_ds, identity, cache = cache, channel = 0, level = 3)[1]
+    bkg_cyt = getCachedBackgroundLevels(cyto_ds, identity, cache = cache, channel = 1, level = 3)[1]
+
+    #cached full res flat field, rezoomed only at tile boundaries
+    flat_cyt = FlatFieldCache(M_cyt, tileSize = 256, beta = cyto_norm_constant,
+                              precision = precision)
 
     #create reference to full res data
-    nuclei_hires = f['/t00000/s00/0/cells']
-    cyto_hires = f['/t00000/s01/0/cells']
+    nuclei_hires = reader.getVolume(0, 0)
+    cyto_hires = reader.getVolume(1, 0)
 
     #block size for Image data
     tileSize = 256
 
+    #spans, counters and queue depths, disabled without --profile
+    profiler = Profiler(enabled = args.profile is not None)
+
     #settings for RGB conversion
     settings_dict = fc.getColorSettings()
     nuclei_RGBsettings = settings_dict['nuclei']
@@ -125,72 +175,99 @@ def main():
     print(nuclei_RGBsettings)
     print(cyto_RGBsettings)
 
+    def readSection(k):
+        #get image data from both channels in blocks that are multiples of tileSize
+        nuclei = nuclei_hires[0:tileSize*M_nuc.shape[0],k,0:tileSize*M_nuc.shape[2]]
+        cyto = cyto_hires[0:tileSize*M_cyt.shape[0],k,0:tileSize*M_cyt.shape[2]]
+        return nuclei.astype(numpy.uint16), cyto
 
-    for k in range(start_k, stop_k, skip_k):
-        if k == stop_k:
-            break
-        else:
-
-            t_start = time.time()
-
-            print('on section: ',k)
-
-            #get image data from both channels in blocks that are multiples of tileSize
-            #subtract background and reset values > 0 and < 2**16
-            print('Reading Data')
-            t_nuc = time.time()
-            nuclei = nuclei_hires[0:tileSize*M_nuc.shape[0],k,0:tileSize*M_nuc.shape[2]]
-            nuclei = nuclei.astype(numpy.uint16)
-            print(nuclei.shape)
-            #Execute CLAHE on Nuclei
+    def preprocessNuclei(nuclei, k):
+        #Execute CLAHE on Nuclei
+        with profiler.span('CLAHE', k = k):
             nuclei = fc.applyCLAHE(nuclei, tileGridSize = (8,8), clipLimit = 1.5)
-            nuclei = nuclei.astype(float)
+
+        #subtract background and reset values > 0 and < 2**16
+        with profiler.span('background', k = k):
+            nuclei = nuclei.astype(float_type)
             nuclei -= 0.5*bkg_nuc
             nuclei = numpy.clip(nuclei,0,65535)
-            print('read time nuclei', time.time()-t_nuc)
 
-            t_cyt = time.time()
-            cyto = cyto_hires[0:tileSize*M_cyt.shape[0],k,0:tileSize*M_cyt.shape[2]]
-            cyto = cyto.astype(float)
+        with profiler.span('sharpen', k = k):
+            return fc.sharpenImage(nuclei, alpha = alpha, precision = precision)
+
+    def preprocessCyto(cyto, k):
+        with profiler.span('background', k = k):
+            cyto = cyto.astype(float_type)
             cyto -= 3*bkg_cyt
             cyto = numpy.clip(cyto,0,65535)
-            print('read time cyto', time.time() - t_cyt)
-
-
-
-
-            # sharpen images
-            print('sharpening')
-            nuclei = fc.sharpenImage(nuclei, alpha = alpha)
-            cyto = fc.sharpenImage(cyto, alpha = alpha)
-
-            #interpolate downsampled images to full res size to use as flat fielding mask
-            C_nuc, C_cyt = fc.interpolateDS(M_nuc, M_cyt, k)
-
-            print('False Coloring')
-
-            #Execute false coloring method
-            RGB_image = fc.rapidFalseColor(nuclei, cyto, nuclei_RGBsettings, cyto_RGBsettings,
-                                            cyto_normfactor = cyto_norm_constant*C_cyt,
-                                            # nuc_normfactor = nuc_norm_constant*C_nuc,
-                                            run_FlatField_cyto = True, 
-                                            run_FlatField_nuc = False)
-
-            #append data to queue
-            save_file = '{:0>6d}'.format(k) + args.format
-            message = [filepath,save_dir,save_file,RGB_image,None]
-            t0 = time.time()
-            dataQueue.put(message)
-
-            nuclei = None
-            cyto = None
-            print('runtime:', time.time() - t_start)
 
-    #stop data queue
-    stop_message = [None,None,None,None,'stop']
-    dataQueue.put(stop_message)
-    save_thread.join()
-    f.close()
+        with profiler.span('sharpen', k = k):
+            return fc.sharpenImage(cyto, alpha = alpha, precision = precision)
+
+    def colorSection(channels, k):
+        nuclei, cyto = channels
+
+        #interpolate downsampled images to full res size to use as flat fielding mask
+        with profiler.span('flat-field', k = k):
+            C_cyt = flat_cyt.getSection(k)
+
+        #Execute false coloring method
+        return fc.rapidFalseColor(nuclei, cyto, nuclei_RGBsettings, cyto_RGBsettings,
+                                  cyto_normfactor = C_cyt,
+                                  # nuc_normfactor = nuc_norm_constant*C_nuc,
+                                  run_FlatField_cyto = True, 
+                                  run_FlatField_nuc = False,
+                                  precision = precision)
+
+    def writeSection(k, RGB_image):
+        save_file = '{:0>6d}'.format(k) + args.format
+        file_savename = saveImage(filepath, save_dir, save_file, RGB_image, profiler = profiler)
+        manifest.record(k, file_savename)
+        return file_savename
+
+    #skip sections finished by an earlier run with the same parameters
+    manifest_file = args.manifest
+    if manifest_file is None:
+        manifest_file = os.path.join(filepath, save_dir, 'manifest.json')
+
+    manifest = RunManifest(manifest_file, params = run_params, reset = args.restart)
+    indices = manifest.getPending(range(start_k, stop_k, skip_k), verify = args.verify)
+    print(len(range(start_k, stop_k, skip_k)) - len(indices), 'sections already finished in', manifest_file)
+
+    #preprocessed sections of earlier runs, keyed by everything the preprocessing depends on
+    store = None
+    if args.preprocessed_store is not None:
+        store = PreprocessedStore(args.preprocessed_store,
+                                  params = {'identity': identity, 'preprocess': 'CLAHE-background-sharpen',
+                                            'tileGridSize': (8,8), 'clipLimit': 1.5,
+                                            'bkg_nuc': bkg_nuc, 'bkg_cyt': bkg_cyt,
+                                            'alpha': alpha, 'precision': precision})
+        print('preprocessed store:', store.folder)
+
+    #read, CLAHE, sharpen, color and save sections concurrently
+    pipeline = SectionPipeline(readSection, colorSection,
+                               preprocess = [preprocessNuclei, preprocessCyto],
+                               write = writeSection,
+                               read_workers = args.read_workers,
+                               preprocess_workers = args.preprocess_workers,
+                               write_workers = args.write_workers,
+                               queue_size = args.queue_size,
+                               profiler = profiler,
+                               store = store)
+
+    t_start = time.time()
+    for k, save_file in pipeline.run(indices):
+        print('saved section', k, save_file, 'elapsed:', time.time() - t_start)
+
+    # compact the journal of finished sections into the manifest
+    manifest.close()
+
+    if args.profile is not None:
+        print(profiler.report())
+        profiler.saveJSON(args.profile + '.json')
+        profiler.saveChromeTrace(args.profile + '_trace.json')
+
+    reader.close()
 
 if __name__ == '__main__':
     t_overall = time.time()
@@ -0,0 +1,141 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+Colors every dataset and timepoint below a folder with color_script.py,
+in one pool of worker processes that lives for the whole batch. Options
+which are not batch options are passed on to color_script.py, every
+dataset and timepoint is saved to <savefolder>/<name>_t<timepoint>.
+
+    python scripts/batch_script.py /data/specimens /data/colored tif 0 0 \
+        --workers 4 --crop --max_memory 16G
+
+"""
+
+import os
+import sys
+import time
+import argparse
+from functools import partial
+from falsecolor.catalog import scanDatasets, loadCatalog, runBatch
+import color_script
+
+
+def colorEntry(entry, savefolder, format, section_args, script_args):
+    """
+    Colors one catalog entry with color_script.main in a batch worker.
+    """
+
+    name = os.path.splitext(os.path.basename(entry['path']))[0]
+    folder = os.path.join(savefolder, '%s_t%05d' % (name, entry['timepoint']))
+
+    color_script.main([os.path.dirname(entry['path']),
+                       os.path.basename(entry['path']),
+                       folder, format] + list(section_args) +
+                      list(script_args) +
+                      ['--timepoint', str(entry['timepoint'])])
+
+    return folder
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    # folder scanned for .h5 files and .zarr/.n5 containers
+    parser.add_argument("root")
+
+    # every dataset and timepoint is saved to a subfolder
+    parser.add_argument("savefolder")
+    parser.add_argument("format", type=str)
+
+    # sections to color, see color_script.py
+    parser.add_argument("start_k", type=int)
+    parser.add_argument("stop_k", type=int)
+    parser.add_argument("skip_k", type=int, nargs='?', default=1)
+
+    # worker processes, each colors one dataset at a time
+    parser.add_argument("--workers", type=int, default=1)
+
+    # the catalog is reused unless --rescan, by default
+    # <savefolder>/catalog.json
+    parser.add_argument("--catalog", type=str, default=None)
+    parser.add_argument("--rescan", action='store_true')
+
+    # only color datasets whose path matches, and some timepoints
+    parser.add_argument("--pattern", type=str, default=None)
+    parser.add_argument("--timepoints", type=int, nargs='+', default=None)
+
+    args, script_args = parser.parse_known_args()
+
+    savefolder = os.path.abspath(args.savefolder)
+    catalog_file = args.catalog
+    if catalog_file is None:
+        catalog_file = os.path.join(savefolder, 'catalog.json')
+
+    if os.path.exists(catalog_file) and not args.rescan:
+        catalog = loadCatalog(catalog_file)
+    else:
+        catalog = scanDatasets(args.root)
+        os.makedirs(os.path.dirname(os.path.abspath(catalog_file)),
+                    exist_ok=True)
+        catalog.save(catalog_file)
+
+    for error in catalog.errors:
+        print('could not read', error['path'], error['error'])
+
+    catalog = catalog.filter(pattern=args.pattern,
+                             timepoints=args.timepoints)
+    print('coloring', len(catalog), 'datasets with', args.workers,
+          'workers')
+
+    t_start = time.time()
+
+    def report(entry, folder, error):
+        if error is None:
+            print('finished', entry['path'], 't%05d' % entry['timepoint'],
+                  'elapsed:', time.time() - t_start)
+        else:
+            print('FAILED', entry['path'], 't%05d' % entry['timepoint'])
+            print(error)
+
+    target = partial(colorEntry, savefolder=savefolder, format=args.format,
+                     section_args=[str(args.start_k), str(args.stop_k),
+                                   str(args.skip_k)],
+                     script_args=script_args)
+
+    results = runBatch(target, catalog, n_workers=args.workers,
+                       callback=report)
+
+    failed = [entry for entry, folder, error in results if error is not None]
+    print('finished', len(results) - len(failed), 'of', len(results),
+          'datasets in', time.time() - t_start, 's')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,410 @@
+"""
+#===============================================================================
+#
+#  License: GPL
+#
+#
+#  Copyright (c) 2019 Rob Serafin, Liu Lab,
+#  The University of Washington Department of Mechanical Engineering
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License 2
+#  as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+#===============================================================================
+
+Rob Serafin
+3/25/2020
+
+Benchmarks the falsecolor hot paths on synthetic uint16 sections and on
+the TIFFs in example/Paper Data. Reports throughput in MPix/s and peak
+traced memory, stores machine tagged baselines and flags regressions.
+
+    python scripts/benchmark.py --sizes 512 1024 2048 --save
+    python scripts/benchmark.py --sizes 512 1024 2048 --compare
+
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+import platform
+import argparse
+import numpy
+from skimage.io import imread
+from numba import cuda
+import falsecolor.coloring as fc
+from falsecolor.process import getRGBStats
+from falsecolor.dataobject import DataObject
+from falsecolor.memory import MemoryMonitor, formatMemory
+
+
+# bundled two channel sections
+PAPER_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'example', 'Paper Data', 'Figures',
+                          'Figure 4')
+
+DEFAULT_BASELINE_DIR = os.path.join(os.path.dirname(
+                                    os.path.abspath(__file__)),
+                                    'benchmark_baselines')
+
+
+def makeSection(size, seed=0, base=512):
+    """
+    Creates a synthetic two channel section, a random base tile of
+    nuclei like spots on a smooth cytoplasm background repeated to the
+    requested size, so 16k sections are cheap to create.
+
+    Parameters
+    ----------
+
+    size : int
+        Lateral size of the square section.
+
+    seed : int
+        Defaults to 0, random seed.
+
+    base : int
+        Defaults to 512, size of the repeated tile.
+
+    Returns
+    -------
+
+    nuclei, cyto : 2D numpy arrays, dtype uint16
+
+    """
+
+    rng = numpy.random.RandomState(seed)
+    base = min(base, size)
+
+    # smooth cytoplasm with noise
+    rows, cols = numpy.mgrid[0:base, 0:base]/base
+    cyto = 800 + 600*numpy.sin(2*numpy.pi*rows)*numpy.cos(2*numpy.pi*cols)
+    cyto += rng.normal(0, 50, (base, base))
+
+    # disk shaped nuclei
+    nuclei = rng.normal(100, 20, (base, base))
+    for r, c in rng.randint(0, base, (base//8, 2)):
+        disk = (rows*base - r)**2 + (cols*base - c)**2 < 36
+        nuclei[disk] += rng.uniform(2000, 12000)
+
+    reps = int(numpy.ceil(size/base))
+    nuclei = numpy.tile(nuclei, (reps, reps))[:size, :size]
+    cyto = numpy.tile(cyto, (reps, reps))[:size, :size]
+
+    return (numpy.clip(nuclei, 0, 65535).astype(numpy.uint16),
+            numpy.clip(cyto, 0, 65535).astype(numpy.uint16))
+
+
+def loadPaperData():
+    """
+    Loads the nuclei (s00) and cytoplasm (s01) sections of every
+    example/Paper Data/Figures/Figure 4 panel.
+
+    Returns
+    -------
+
+    sections : dict
+        Maps 'paper_<panel>' to (nuclei, cyto).
+
+    """
+
+    sections = {}
+    for folder in sorted(glob.glob(os.path.join(PAPER_DATA, '*'))):
+        nuclei = glob.glob(os.path.join(folder, 's00_*.tif'))
+        cyto = glob.glob(os.path.join(folder, 's01_*.tif'))
+        if nuclei and cyto:
+            sections['paper_' + os.path.basename(folder)] = (
+                            imread(nuclei[0]), imread(cyto[0]))
+
+    return sections
+
+
+def getBenchmarks(nuclei, cyto, ncpus=2):
+    """
+    Sets up every benchmark for one section. Inputs derived from the
+    section, e.g. the RGB image for segmentation, are computed here so
+    only the benchmarked call is timed.
+
+    Parameters
+    ----------
+
+    nuclei, cyto : 2D numpy arrays
+        Section to benchmark.
+
+    ncpus : int
+        Defaults to 2, pool size for DataObject.processImages.
+
+    Returns
+    -------
+
+    benchmarks : dict
+        Maps names to (function, n_pixels), function runs the benchmark
+        once and n_pixels is the number of input pixels it processes.
+
+    """
+
+    n_pixels = nuclei.size
+
+    # downsampled volume as read from pyramid level 4
+    volume = numpy.repeat(nuclei[::16, None, ::16], 4, axis=1)
+    intensity_map = fc.getIntensityMap(volume)
+
+    # RGB input of the post processing benchmarks, made on first use
+    cache = {}
+
+    def RGB():
+        if 'RGB' not in cache:
+            cache['RGB'] = fc.falseColor(nuclei, cyto)
+        return cache['RGB']
+
+    def processImages():
+        data = DataObject('.', setupPool=True, ncpus=ncpus)
+        stack = [numpy.stack([nuclei]*ncpus), numpy.stack([cyto]*ncpus)]
+        data.processImages({'runnable': fc.falseColor, 'kwargs': None},
+                           stack)
+
+    benchmarks = {
+        'falseColor': (lambda: fc.falseColor(nuclei, cyto), n_pixels),
+        'preProcess': (lambda: fc.preProcess(nuclei), n_pixels),
+        'getBackgroundLevels': (lambda: fc.getBackgroundLevels(nuclei),
+                                n_pixels),
+        'getIntensityMap': (lambda: fc.getIntensityMap(volume),
+                            volume.size),
+        'interpolateDS': (lambda: fc.interpolateDS(intensity_map, 100),
+                          intensity_map.shape[0]*intensity_map.shape[2] *
+                          256**2),
+        'applyCLAHE': (lambda: fc.applyCLAHE(nuclei), n_pixels),
+        'segmentNuclei': (lambda: fc.segmentNuclei(RGB()), n_pixels),
+        'maskEmpty': (lambda: fc.maskEmpty(RGB()), n_pixels),
+        'getRGBStats': (lambda: getRGBStats(RGB()), n_pixels),
+        'processImages': (processImages, ncpus*n_pixels),
+        }
+
+    # convolution kernels need a GPU or the CUDA simulator
+    if cuda.is_available():
+        benchmarks['sharpenImage'] = (lambda: fc.sharpenImage(nuclei),
+                                      n_pixels)
+
+    return benchmarks
+
+
+def runBenchmark(function, n_pixels, repeat=3, measure_memory=True):
+    """
+    Times a benchmark and measures its peak traced memory.
+
+    Parameters
+    ----------
+
+    function : callable
+        Runs the benchmark once.
+
+    n_pixels : int
+        Number of input pixels, for throughput.
+
+    repeat : int
+        Defaults to 3, number of timed runs, the fastest is kept.
+
+    measure_memory : bool
+        Defaults to True, run once more under tracemalloc. Memory of
+        pool worker processes is not included.
+
+    Returns
+    -------
+
+    result : dict
+        'seconds', 'mpix_per_s' and 'peak_memory' in bytes.
+
+    """
+
+    # warm up caches and jit compilation
+    function()
+
+    times = []
+    for i in range(repeat):
+        t_start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t_start)
+
+    peak = None
+    if measure_memory:
+        monitor = MemoryMonitor()
+        monitor.start()
+        function()
+        peak = monitor.stop()['traced_peak']
+
+    seconds = min(times)
+
+    return {'seconds': seconds,
+            'mpix_per_s': n_pixels/seconds/1e6,
+            'peak_memory': peak}
+
+
+def getMachineTag():
+    """
+    Returns a file name safe tag for this machine, baselines are only
+    compared between runs with the same tag.
+    """
+
+    tag = '%s-%s-%dcpu' % (platform.node(), platform.machine(),
+                           os.cpu_count() or 1)
+    if cuda.is_available():
+        tag += '-gpu'
+
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', tag)
+
+
+def compareResults(results, baseline, tolerance=0.2):
+    """
+    Finds benchmarks which regressed against a baseline.
+
+    Parameters
+    ----------
+
+    results : dict
+        Results of this run, keyed by benchmark and section.
+
+    baseline : dict
+        Stored results with the same keys.
+
+    tolerance : float
+        Defaults to 0.2, allowed relative loss of throughput or gain of
+        peak memory.
+
+    Returns
+    -------
+
+    regressions : list of str
+        One message per regression.
+
+    """
+
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        reference = baseline[key]
+
+        if result['mpix_per_s'] < (1 - tolerance)*reference['mpix_per_s']:
+            regressions.append('%s: %.2f MPix/s, baseline %.2f MPix/s'
+                               % (key, result['mpix_per_s'],
+                                  reference['mpix_per_s']))
+
+        if result['peak_memory'] and reference.get('peak_memory') and \
+                result['peak_memory'] > \
+                (1 + tolerance)*reference['peak_memory']:
+            regressions.append('%s: peak %s, baseline %s'
+                               % (key, formatMemory(result['peak_memory']),
+                                  formatMemory(reference['peak_memory'])))
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    # synthetic section sizes, up to 16384
+    parser.add_argument("--sizes", type=int, nargs='+',
+                        default=[512, 1024, 2048])
+
+    # include example/Paper Data sections
+    parser.add_argument("--paper_data", action='store_true')
+
+    # subset of benchmarks to run, defaults to all
+    parser.add_argument("--benchmarks", type=str, nargs='+', default=None)
+
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--ncpus", type=int, default=2)
+    parser.add_argument("--no_memory", action='store_true')
+
+    # baselines are stored as <baseline_dir>/<machine tag>.json
+    parser.add_argument("--baseline_dir", type=str,
+                        default=DEFAULT_BASELINE_DIR)
+    parser.add_argument("--save", action='store_true')
+    parser.add_argument("--compare", action='store_true')
+    parser.add_argument("--tolerance", type=float, default=0.2)
+
+    args = parser.parse_args()
+
+    sections = {}
+    for size in args.sizes:
+        sections['synthetic_%d' % size] = makeSection(size)
+    if args.paper_data:
+        sections.update(loadPaperData())
+
+    results = {}
+    for section_name, (nuclei, cyto) in sections.items():
+        benchmarks = getBenchmarks(nuclei, cyto, ncpus=args.ncpus)
+
+        for name, (function, n_pixels) in benchmarks.items():
+            if args.benchmarks is not None and name not in args.benchmarks:
+                continue
+
+            key = '%s@%s' % (name, section_name)
+            results[key] = runBenchmark(function, n_pixels,
+                                        repeat=args.repeat,
+                                        measure_memory=not args.no_memory)
+
+            peak = results[key]['peak_memory']
+            print('%-40s %10.2f MPix/s %12s'
+                  % (key, results[key]['mpix_per_s'],
+                     formatMemory(peak) if peak is not None else '-'))
+
+    baseline_file = os.path.join(args.baseline_dir,
+                                 getMachineTag() + '.json')
+
+    status = 0
+    if args.compare:
+        if not os.path.exists(baseline_file):
+            print('no baseline for this machine:', baseline_file)
+
+        else:
+            with open(baseline_file) as f:
+                baseline = json.load(f)['results']
+
+            regressions = compareResults(results, baseline,
+                                         tolerance=args.tolerance)
+            for message in regressions:
+                print('REGRESSION', message)
+
+            if regressions:
+                status = 1
+            else:
+                print('no regressions against', baseline_file)
+
+    if args.save:
+        baseline = {}
+        if os.path.exists(baseline_file):
+            with open(baseline_file) as f:
+                baseline = json.load(f)['results']
+        baseline.update(results)
+
+        os.makedirs(args.baseline_dir, exist_ok=True)
+        with open(baseline_file, 'w') as f:
+            json.dump({'machine': {'tag': getMachineTag(),
+                                   'platform': platform.platform(),
+                                   'processor': platform.processor(),
+                                   'python': platform.python_version(),
+                                   'numpy': numpy.__version__,
+                                   'cpus': os.cpu_count()},
+                       'results': baseline}, f, indent=2, sort_keys=True)
+        print('saved baseline', baseline_file)
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
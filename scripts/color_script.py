@@ -28,16 +28,35 @@ Rob Serafin
 """
 
 import os
+import sys
 import falsecolor.coloring as fc
-from falsecolor.savethread import saveProcess
+from falsecolor.pipeline import SectionPipeline, readSparseSection, \
+    planSectionTiles, planSectionCrops
+from falsecolor.savethread import saveImage
+from falsecolor.memory import planPipeline, MemoryMonitor, formatMemory
+from falsecolor.profiling import Profiler
+from falsecolor.manifest import RunManifest, mergeManifests
+from falsecolor.sharding import getShardIndices, getShardFilename, \
+    runShardProcesses
+from falsecolor.cache import ResultCache, getFileIdentity, \
+    getCachedIntensityMap, getCachedBackgroundLevels
+from falsecolor.store import PreprocessedStore
+from falsecolor.readers import openVolume
 import numpy
 import argparse
-import h5py as h5
-import multiprocessing as mp
 import time
 
 
-def main():
+def runShard(shard_index, n_shards, argv):
+    """
+    Runs one shard of a sharded run in a worker process.
+    """
+
+    main(list(argv) + ['--shard_index', str(shard_index),
+                       '--n_shards', str(n_shards)])
+
+
+def main(argv=None):
 
     parser = argparse.ArgumentParser()
 
@@ -66,8 +85,88 @@ def main():
     parser.add_argument("alpha", type=float, nargs='?',
                         default=0.5, help='imaris file')
 
+    # floating point precision for preprocessing and coloring
+    parser.add_argument("--precision", type=str, default='float64',
+                        choices=['float32', 'float64'])
+
+    # pipeline workers per stage and queue depth between stages
+    parser.add_argument("--read_workers", type=int, default=1)
+    parser.add_argument("--preprocess_workers", type=int, default=2)
+    parser.add_argument("--write_workers", type=int, default=2)
+    parser.add_argument("--queue_size", type=int, default=4)
+
+    # threads fetching the chunks of every read, input can be
+    # BigDataViewer HDF5, Zarr/OME-Zarr or N5
+    parser.add_argument("--read_threads", type=int, default=4)
+    parser.add_argument("--timepoint", type=int, default=0)
+
+    # skip empty tiles and sections using the downsampled data, tiles
+    # with a maximum below tissue_threshold are empty (defaults to the
+    # channel background level)
+    parser.add_argument("--sparse", action='store_true')
+    parser.add_argument("--tissue_threshold", type=float, default=None)
+
+    # only read and color the tissue bounding box of every section,
+    # planned on a coarse pyramid level
+    parser.add_argument("--crop", action='store_true')
+    parser.add_argument("--crop_level", type=int, default=4)
+
+    # host memory budget such as 8G, chooses pipeline workers and queue
+    # depth to fit and reports the measured peak
+    parser.add_argument("--max_memory", type=str, default=None)
+
+    # save per stage timings to <profile>.json and a chrome trace to
+    # <profile>_trace.json
+    parser.add_argument("--profile", type=str, default=None)
+
+    # finished sections are recorded in a manifest, by default
+    # <filepath>/<savefolder>/manifest.json, and skipped when the run is
+    # restarted. --restart discards the manifest, --verify checks the
+    # checksums of finished sections
+    parser.add_argument("--manifest", type=str, default=None)
+    parser.add_argument("--restart", action='store_true')
+    parser.add_argument("--verify", action='store_true')
+
+    # split the sections across local worker processes, or process one
+    # shard of a run split across nodes with --shard_index/--n_shards
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--shard_index", type=int, default=None)
+    parser.add_argument("--n_shards", type=int, default=1)
+    parser.add_argument("--shard_mode", type=str, default='block',
+                        choices=['block', 'interleave'])
+
+    # merge the manifests of all --n_shards shards once every node is done
+    parser.add_argument("--merge_shards", action='store_true')
+
+    # intensity maps and background levels are cached across runs, by
+    # default in ~/.cache/falsecolor. Nodes of a sharded run should share
+    # the cache folder
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--cache_size", type=str, default='4G')
+
+    # save preprocessed sections to a compressed store, reruns with the
+    # same preprocessing (e.g. new normfactors) only color
+    parser.add_argument("--preprocessed_store", type=str, default=None)
+
     # get arguments
-    args = parser.parse_args()
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv)
+
+    if args.sparse and args.crop:
+        parser.error('--sparse and --crop can not be combined')
+
+    # arguments which change the saved sections
+    run_params = {key: value for key, value in vars(args).items()
+                  if key not in ['start_k', 'stop_k', 'skip_k',
+                                 'read_workers', 'preprocess_workers',
+                                 'write_workers', 'queue_size',
+                                 'read_threads', 'max_memory', 'profile',
+                                 'manifest', 'restart', 'verify',
+                                 'processes', 'shard_index', 'n_shards',
+                                 'shard_mode', 'merge_shards',
+                                 'cache_dir', 'cache_size',
+                                 'preprocessed_store']}
 
     # get path info
     filename = args.filename
@@ -77,11 +176,26 @@ def main():
     # load data
     datapath = os.path.join(filepath, filename)
 
-    f = h5.File(datapath, 'r')
+    manifest_file = args.manifest
+    if manifest_file is None:
+        manifest_file = os.path.join(filepath, save_dir, 'manifest.json')
+
+    if args.merge_shards:
+        mergeManifests([getShardFilename(manifest_file, shard_index,
+                                         args.n_shards)
+                        for shard_index in range(args.n_shards)],
+                       manifest_file)
+        print('merged', args.n_shards, 'shard manifests into',
+              manifest_file)
+        return
+
+    # every process or node opens its own file handle
+    reader = openVolume(datapath, n_threads=args.read_threads,
+                        timepoint=args.timepoint)
 
     # downsampled data for flat fielding
-    nuclei_ds = f['/t00000/s00/4/cells']
-    cyto_ds = f['/t00000/s01/4/cells']
+    nuclei_ds = reader.getVolume(0, 4)
+    cyto_ds = reader.getVolume(1, 4)
 
     # indices to pseudo color, if stop_k = 0 the entire dataset from
     # start_k on will be processed, at intervals of skip_k
@@ -99,33 +213,121 @@ def main():
     nuc_norm_constant = args.Nuclei_Normfactor
     cyto_norm_constant = args.Cyto_Normfactor
 
+    # floating point type for preprocessing and coloring
+    precision = args.precision
+    float_type = fc.getPrecisionType(precision)
+
     if stop_k != 0:
         stop_k += start_k
 
     elif stop_k == 0:
         stop_k = nuclei_ds.shape[1]*16
 
+    # the downsampled depth rounds up, never run past the full
+    # resolution sections
+    stop_k = min(stop_k, reader.getVolume(0, 0).shape[1])
+
     print('Reading data from index:', start_k, 'to ', stop_k,
           'at stepsize = ', skip_k)
 
-    # calculate flat field
-    M_nuc = fc.getIntensityMap(nuclei_ds)
-    M_cyto = fc.getIntensityMap(cyto_ds)
-
-    bkg_nuc = fc.getBackgroundLevels(nuclei_ds)[1]
-    bkg_cyto = fc.getBackgroundLevels(cyto_ds)[1]
-
-    dataQueue = mp.Queue()
-    save_thread = mp.Process(target=saveProcess, args=[dataQueue])
-    save_thread.start()
+    # flat fields and background levels are computed once and shared by
+    # all shards and later runs on the same data
+    cache = ResultCache(args.cache_dir, max_size=args.cache_size)
+    identity = getFileIdentity(datapath)
+
+    M_nuc = getCachedIntensityMap(nuclei_ds, identity, precision=precision,
+                                  cache=cache, channel=0, level=4,
+                                  timepoint=args.timepoint)
+    M_cyto = getCachedIntensityMap(cyto_ds, identity, precision=precision,
+                                   cache=cache, channel=1, level=4,
+                                   timepoint=args.timepoint)
+    bkg_nuc = getCachedBackgroundLevels(nuclei_ds, identity, cache=cache,
+                                        channel=0, level=4,
+                                        timepoint=args.timepoint)[1]
+    bkg_cyto = getCachedBackgroundLevels(cyto_ds, identity, cache=cache,
+                                         channel=1, level=4,
+                                         timepoint=args.timepoint)[1]
+
+    # start one worker process per shard and merge their manifests
+    if args.processes > 1 and args.shard_index is None:
+        reader.close()
+        runShardProcesses(runShard, args.processes, args=(argv,))
+
+        shard_files = [getShardFilename(manifest_file, shard_index,
+                                        args.processes)
+                       for shard_index in range(args.processes)]
+        mergeManifests(shard_files, manifest_file, reset=args.restart)
+        print('merged', len(shard_files), 'shard manifests into',
+              manifest_file)
+        return
+
+    # scaled intensity maps, interpolated per pixel while coloring
+    C_nuc = nuc_norm_constant*M_nuc
+    C_cyto = cyto_norm_constant*M_cyto
 
     # create reference to full res data
-    nuclei_hires = f['/t00000/s00/0/cells']
-    cyto_hires = f['/t00000/s01/0/cells']
+    nuclei_hires = reader.getVolume(0, 0)
+    cyto_hires = reader.getVolume(1, 0)
 
     # block size for Image data
     tileSize = 256
 
+    # spans, counters and queue depths, disabled without --profile
+    profiler = Profiler(enabled=args.profile is not None)
+
+    # section shape in multiples of tileSize
+    section_shape = (tileSize*M_nuc.shape[0], tileSize*M_nuc.shape[2])
+
+    nuc_tissue_threshold = bkg_nuc
+    cyto_tissue_threshold = bkg_cyto
+    if args.tissue_threshold is not None:
+        nuc_tissue_threshold = args.tissue_threshold
+        cyto_tissue_threshold = args.tissue_threshold
+
+    section_tiles = {}
+    if args.sparse:
+        # low resolution data is small enough to keep in memory
+        nuclei_lowres = nuclei_ds[:]
+        cyto_lowres = cyto_ds[:]
+
+        # plan the tissue tiles of all sections like the crops, from
+        # the bracketing low resolution planes
+        section_tiles = planSectionTiles(
+                    [nuclei_lowres, cyto_lowres],
+                    range(start_k, stop_k, skip_k), section_shape,
+                    tileSize=tileSize,
+                    thresholds=[nuc_tissue_threshold, cyto_tissue_threshold],
+                    scale=int(round(nuclei_hires.shape[0] /
+                                    nuclei_lowres.shape[0])),
+                    section_scale=int(round(nuclei_hires.shape[1] /
+                                            nuclei_lowres.shape[1])))
+
+        n_tiles = sum(tiles.sum() for tiles in section_tiles.values())
+        print('tissue tile fraction:',
+              n_tiles/max(sum(tiles.size
+                              for tiles in section_tiles.values()), 1))
+
+    crops = {}
+    if args.crop:
+        nuclei_coarse = reader.getVolume(0, args.crop_level)[:]
+        cyto_coarse = reader.getVolume(1, args.crop_level)[:]
+
+        # plan all crops before reading full resolution data
+        crops = planSectionCrops(
+                    [nuclei_coarse, cyto_coarse],
+                    range(start_k, stop_k, skip_k), section_shape,
+                    tileSize=tileSize,
+                    thresholds=[nuc_tissue_threshold, cyto_tissue_threshold],
+                    scale=int(round(nuclei_hires.shape[0] /
+                                    nuclei_coarse.shape[0])),
+                    section_scale=int(round(nuclei_hires.shape[1] /
+                                            nuclei_coarse.shape[1])))
+
+        n_pixels = sum((c[1] - c[0])*(c[3] - c[2])
+                       for c in crops.values() if c is not None)
+        print('crop fraction:',
+              n_pixels/(max(len(crops), 1)*section_shape[0]*section_shape[1]))
+
     # settings for RGB conversion
     settings_dict = fc.getColorSettings()
     nuclei_RGBsettings = settings_dict['nuclei']
@@ -133,70 +335,204 @@ def main():
     print(nuclei_RGBsettings)
     print(cyto_RGBsettings)
 
-    for k in range(start_k, stop_k, skip_k):
-        if k == stop_k:
-            break
+    def readSection(k):
+        # only read the tissue bounding box, skip empty sections
+        if args.crop:
+            if crops[k] is None:
+                return None
+
+            r0, r1, c0, c1 = crops[k]
+            nuclei = nuclei_hires[r0:r1, k, c0:c1].astype(numpy.uint16)
+            cyto = cyto_hires[r0:r1, k, c0:c1].astype(numpy.uint16)
+            return nuclei, cyto
+
+        # only read tiles with tissue, skip empty sections
+        if args.sparse:
+            tissue_tiles = section_tiles[k]
+            if not tissue_tiles.any():
+                return None
+
+            nuclei = readSparseSection(
+                lambda r0, r1, c0, c1: nuclei_hires[r0:r1, k, c0:c1],
+                section_shape, tissue_tiles, tileSize=tileSize)
+            cyto = readSparseSection(
+                lambda r0, r1, c0, c1: cyto_hires[r0:r1, k, c0:c1],
+                section_shape, tissue_tiles, tileSize=tileSize)
+            return nuclei, cyto
+
+        # get image data from both channels in blocks that are
+        # multiples of tileSize
+        nuclei = nuclei_hires[0:tileSize*M_nuc.shape[0], k,
+                              0:tileSize*M_nuc.shape[2]].astype(numpy.uint16)
+        cyto = cyto_hires[0:tileSize*M_cyto.shape[0], k,
+                          0:tileSize*M_cyto.shape[2]].astype(numpy.uint16)
+        return nuclei, cyto
+
+    def preprocessChannel(image, background, k):
+        # subtract background and reset values > 0 and < 2**16
+        with profiler.span('background', k=k):
+            image = image.astype(float_type)
+            image -= background
+            image = numpy.clip(image, 0, 65535)
+
+        # sharpen image
+        with profiler.span('sharpen', k=k):
+            return fc.sharpenImage(image, alpha=alpha, precision=precision)
+
+    def preprocessSection(image, background, k):
+        # empty tiles of sparse sections are neither preprocessed nor
+        # colored, tissue regions keep a one pixel halo for sharpening
+        if args.sparse:
+            return fc.applyToTissue(
+                        lambda region: preprocessChannel(region, background,
+                                                         k),
+                        image, section_tiles[k], tileSize=tileSize,
+                        halo=1, dtype=float_type)
+
+        return preprocessChannel(image, background, k)
+
+    def preprocessNuclei(nuclei, k):
+        return preprocessSection(nuclei, 0.5*bkg_nuc, k)
+
+    def preprocessCyto(cyto, k):
+        return preprocessSection(cyto, 3*bkg_cyto, k)
+
+    def colorSection(channels, k):
+        nuclei, cyto = channels
+
+        # location of the crop in the section
+        offset = (0, 0)
+        if args.crop:
+            offset = crops[k][:2]
+
+        color_kwargs = {'nuc_settings': nuclei_RGBsettings,
+                        'cyto_settings': cyto_RGBsettings,
+                        'nuc_normfactor': C_nuc,
+                        'cyto_normfactor': C_cyto,
+                        'run_FlatField_nuc': True,
+                        'run_FlatField_cyto': True,
+                        'section_index': k,
+                        'offset': offset,
+                        'precision': precision}
+
+        # only color tissue regions, empty tiles are constant white
+        if args.sparse:
+            return fc.sparseFalseColor(nuclei, cyto, section_tiles[k],
+                                       tileSize=tileSize,
+                                       color_function=fc.rapidFalseColor,
+                                       **color_kwargs)
+
+        # Execute false coloring method
+        RGB_image = fc.rapidFalseColor(nuclei, cyto, tileSize=tileSize,
+                                       **color_kwargs)
+
+        # place crop into a white section
+        if args.crop:
+            RGB_image = fc.placeCrop(RGB_image, crops[k], section_shape)
+
+        return RGB_image
+
+    def writeSection(k, RGB_image):
+        save_file = '{:0>6d}'.format(k) + args.format
+        file_savename = saveImage(filepath, save_dir, save_file, RGB_image,
+                                  profiler=profiler)
+        manifest.record(k, file_savename)
+        return file_savename
+
+    # this process only handles its shard and keeps its own manifest
+    indices = range(start_k, stop_k, skip_k)
+    merged_file = manifest_file
+    if args.shard_index is not None:
+        indices = getShardIndices(indices, args.shard_index, args.n_shards,
+                                  mode=args.shard_mode)
+        manifest_file = getShardFilename(manifest_file, args.shard_index,
+                                         args.n_shards)
+
+    # skip sections finished by an earlier run with the same parameters
+    manifest = RunManifest(manifest_file, params=run_params,
+                           reset=args.restart)
+    pending = manifest.getPending(indices, verify=args.verify)
+
+    # sections finished by earlier runs with a different number of
+    # shards are only recorded in the merged manifest
+    if merged_file != manifest_file and not args.restart and \
+            os.path.exists(merged_file):
+        merged = RunManifest(merged_file, params=run_params)
+        pending = merged.getPending(pending, verify=args.verify)
+
+    print(len(indices) - len(pending),
+          'sections already finished in', manifest_file)
+
+    pipeline_kwargs = {'read_workers': args.read_workers,
+                       'preprocess_workers': args.preprocess_workers,
+                       'write_workers': args.write_workers,
+                       'queue_size': args.queue_size}
+
+    # fit workers and queue depth to the memory budget
+    estimate = None
+    if args.max_memory is not None:
+        fixed = C_nuc.nbytes + C_cyto.nbytes
+        if args.sparse:
+            fixed += nuclei_lowres.nbytes + cyto_lowres.nbytes
+
+        plan = planPipeline(args.max_memory, section_shape,
+                            input_dtype=numpy.uint16,
+                            precision=precision, fixed=fixed)
+        estimate = plan.pop('estimate')
+        pipeline_kwargs.update(plan)
+        print('memory plan:', pipeline_kwargs,
+              'estimated peak:', formatMemory(estimate))
+
+    # preprocessed sections of earlier runs, keyed by everything the
+    # preprocessing depends on
+    store = None
+    if args.preprocessed_store is not None:
+        store = PreprocessedStore(
+                    args.preprocessed_store,
+                    params={'identity': identity,
+                            'timepoint': args.timepoint,
+                            'preprocess': 'background-sharpen',
+                            'bkg_nuc': bkg_nuc, 'bkg_cyto': bkg_cyto,
+                            'alpha': alpha, 'precision': precision,
+                            'section_shape': section_shape,
+                            'sparse': args.sparse, 'crop': args.crop,
+                            'crop_level': args.crop_level,
+                            'tissue_threshold': args.tissue_threshold})
+        print('preprocessed store:', store.folder)
+
+    # read, preprocess, color and save sections concurrently
+    pipeline = SectionPipeline(readSection, colorSection,
+                               preprocess=[preprocessNuclei, preprocessCyto],
+                               write=writeSection,
+                               profiler=profiler,
+                               store=store,
+                               **pipeline_kwargs)
+
+    monitor = MemoryMonitor(estimate=estimate,
+                            trace=args.max_memory is not None)
+
+    t_start = time.time()
+    monitor.start()
+    for k, save_file in pipeline.run(pending):
+        if save_file is None:
+            manifest.record(k)
+            print('skipped empty section', k)
         else:
+            print('saved section', k, save_file,
+                  'elapsed:', time.time() - t_start)
+
+    monitor.stop()
+    print(monitor.report())
+
+    # compact the journal of finished sections into the manifest
+    manifest.close()
+
+    if args.profile is not None:
+        print(profiler.report())
+        profiler.saveJSON(args.profile + '.json')
+        profiler.saveChromeTrace(args.profile + '_trace.json')
 
-            t_start = time.time()
-
-            print('on section: ', k)
-
-            # get image data from both channels in blocks that are
-            # multiples of tileSize
-            # subtract background and reset values > 0 and < 2**16
-            print('Reading Data')
-            t_nuc = time.time()
-            nuclei = nuclei_hires[0:tileSize*M_nuc.shape[0], k,
-                                  0:tileSize*M_nuc.shape[2]].astype(numpy.uint16)
-            nuclei = nuclei.astype(float)
-            nuclei -= 0.5*bkg_nuc
-            nuclei = numpy.clip(nuclei, 0, 65535)
-            print('read time nuclei', time.time()-t_nuc)
-
-            t_cyt = time.time()
-            cyto = cyto_hires[0:tileSize*M_cyto.shape[0], k,
-                              0:tileSize*M_cyto.shape[2]].astype(numpy.uint16)
-            cyto = cyto.astype(float)
-            cyto -= 3*bkg_cyto
-            cyto = numpy.clip(cyto, 0, 65535)
-            print('read time cyto', time.time() - t_cyt)
-
-            # sharpen images
-            print('sharpening')
-            nuclei = fc.sharpenImage(nuclei, alpha=alpha)
-            cyto = fc.sharpenImage(cyto, alpha=alpha)
-
-            # interpolate downsampled data to full res to use as leveling map
-            C_nuc = fc.interpolateDS(M_nuc, k, beta=nuc_norm_constant)
-            C_cyto = fc.interpolateDS(M_cyto, k, beta=cyto_norm_constant)
-
-            print('False Coloring')
-
-            # Execute false coloring method
-            RGB_image = fc.rapidFalseColor(nuclei, cyto,
-                                           nuclei_RGBsettings,
-                                           cyto_RGBsettings,
-                                           nuc_normfactor=C_nuc,
-                                           cyto_normfactor=C_cyto,
-                                           run_FlatField_nuc=True,
-                                           run_FlatField_cyto=True)
-
-            # append data to queue
-            save_file = '{:0>6d}'.format(k) + args.format
-            message = [filepath, save_dir, save_file, RGB_image, None]
-
-            dataQueue.put(message)
-
-            nuclei = None
-            cyto = None
-            print('runtime:', time.time() - t_start)
-
-    # stop data queue
-    stop_message = [None, None, None, None, 'stop']
-    dataQueue.put(stop_message)
-    save_thread.join()
-    f.close()
+    reader.close()
 
 
 if __name__ == '__main__':
@@ -19,6 +19,8 @@ setup(name='falsecolor',
                             'Virtual Staining',
                             'Histology'],
     install_requires = requires,
+    extras_require = {'dask': ['dask[array]>=2.9.0'],
+                      'zarr': ['zarr']},
     python_requires='>=3.6',
 
 )
@@ -0,0 +1,66 @@
+import numpy
+import pytest
+from falsecolor.coloring import preProcess, falseColorStack
+
+da = pytest.importorskip('dask.array')
+
+from falsecolor.chunked import getChunkedNormfactors, chunkedPreProcess, \
+    chunkedFalseColor
+
+
+def makeVolume(shape=(6, 64, 48), seed=0):
+    rng = numpy.random.RandomState(seed)
+    return rng.gamma(2, 300, size=shape).astype(numpy.uint16)
+
+
+def getNormfactor(image, threshold):
+    image = numpy.maximum(image.astype(numpy.float64) - threshold, 0)**0.85
+    return numpy.mean(image[image > threshold])*8
+
+
+def test_normfactors_per_section_threshold():
+    volume = makeVolume()
+    thresholds = numpy.linspace(20, 120, volume.shape[0])
+
+    result = getChunkedNormfactors(da.from_array(volume, chunks=(2, 32, 24)),
+                                   threshold=thresholds)
+    expected = [getNormfactor(image, t)
+                for image, t in zip(volume, thresholds)]
+
+    numpy.testing.assert_allclose(result, expected)
+
+
+@pytest.mark.parametrize('normfactor', [None, 3000])
+def test_preprocess_per_section_threshold(normfactor):
+    volume = makeVolume()
+    thresholds = numpy.linspace(20, 120, volume.shape[0])
+
+    result = chunkedPreProcess(da.from_array(volume, chunks=(4, 64, 48)),
+                               threshold=thresholds,
+                               normfactor=normfactor).compute()
+
+    for z, t in enumerate(thresholds):
+        expected = preProcess(volume[z], threshold=t, normfactor=normfactor)
+        numpy.testing.assert_allclose(result[z], expected)
+
+
+def test_falsecolor_per_section_threshold():
+    nuclei = makeVolume(seed=0)
+    cyto = makeVolume(seed=1)
+    nuc_thresholds = numpy.linspace(20, 120, nuclei.shape[0])
+    cyto_thresholds = numpy.linspace(80, 30, nuclei.shape[0])
+
+    result = chunkedFalseColor(da.from_array(nuclei, chunks=(4, 64, 48)),
+                               da.from_array(cyto, chunks=(4, 64, 48)),
+                               nuc_threshold=nuc_thresholds,
+                               cyto_threshold=cyto_thresholds,
+                               nuc_normfactor=None,
+                               cyto_normfactor=None).compute()
+
+    expected = falseColorStack(nuclei, cyto,
+                               nuc_threshold=nuc_thresholds,
+                               cyto_threshold=cyto_thresholds,
+                               nuc_normfactor=None,
+                               cyto_normfactor=None)
+
+    numpy.testing.assert_array_equal(result, expected)
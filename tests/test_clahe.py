@@ -0,0 +1,21 @@
+import numpy
+import pytest
+from falsecolor.coloring import applyCLAHE, applyTiledCLAHE
+
+
+@pytest.mark.parametrize('shape, tileGridSize', [
+    ((512, 512), (8, 8)),
+    ((500, 333), (8, 8)),
+    ((1000, 700), (8, 8)),
+    ((257, 259), (7, 9)),
+    ((700, 1000), (4, 16)),
+])
+def test_tiled_clahe_matches_applyCLAHE(shape, tileGridSize):
+    rng = numpy.random.RandomState(0)
+    image = rng.gamma(2, 800, size=shape).astype(numpy.uint16)
+
+    expected = applyCLAHE(image, tileGridSize=tileGridSize)
+    for blockSize in (1, 3):
+        result = applyTiledCLAHE(image, tileGridSize=tileGridSize,
+                                 blockSize=blockSize)
+        numpy.testing.assert_array_equal(result, expected)
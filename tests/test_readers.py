@@ -0,0 +1,34 @@
+import numpy
+import pytest
+import h5py
+from falsecolor.readers import ChunkedVolume
+
+
+@pytest.fixture
+def volume(tmp_path):
+    data = numpy.arange(8*100*6, dtype=numpy.uint16).reshape(8, 100, 6)
+    with h5py.File(str(tmp_path/'volume.h5'), 'w') as f:
+        f.create_dataset('cells', data=data, chunks=(4, 16, 6))
+
+    f = h5py.File(str(tmp_path/'volume.h5'), 'r')
+    yield data, ChunkedVolume(f['cells'], n_threads=2)
+    f.close()
+
+
+def test_integer_indices(volume):
+    data, chunked = volume
+
+    numpy.testing.assert_array_equal(chunked[0:4, 99, 0:4], data[0:4, 99, 0:4])
+    numpy.testing.assert_array_equal(chunked[0:4, -1, 0:4], data[0:4, -1, 0:4])
+    numpy.testing.assert_array_equal(chunked[-8, 5], data[-8, 5])
+
+
+@pytest.mark.parametrize('index', [(slice(0, 4), 100, slice(0, 4)),
+                                   (slice(0, 4), 102, slice(0, 4)),
+                                   (slice(0, 4), -101, slice(0, 4)),
+                                   (8,)])
+def test_out_of_range_index_raises(volume, index):
+    data, chunked = volume
+
+    with pytest.raises(IndexError):
+        chunked[index]